@@ -0,0 +1,326 @@
+#!/usr/bin/env python
+""" Benchmarks the cletus_archiver pipeline - scanning, policies and
+    compression - across codecs and worker counts.
+
+    A synthetic tree is generated once from a seed, so every run and every
+    release compresses exactly the same bytes:  many small files spread
+    over subdirectories plus a few huge files, each either text-like,
+    random or half of each.  Every combination gets a fresh copy of the tree
+    and runs in its own process, so that its cpu time and peak rss aren't
+    mixed up with the others'.  Files/s, MB/s, cpu seconds & peak rss are
+    printed and written to a json file, which a later run can be compared
+    against with --compare.
+
+    Usage:
+        python benchmarks/bench_cletus_archiver.py [--codecs gzip,xz] [--workers 1,2,4]
+                                                   [--processes] [--small-files N]
+                                                   [--huge-files N] [--huge-mb N]
+                                                   [--output results.json]
+                                                   [--compare old_results.json]
+
+    See the file "LICENSE" for the full license governing use of this file.
+    Copyright 2013, 2014, 2015, 2016 Ken Farmer
+"""
+from __future__ import absolute_import
+from __future__ import print_function
+from __future__ import division
+
+import os
+import sys
+import json
+import time
+import random
+import shutil
+import hashlib
+import logging
+import platform
+import resource
+import tempfile
+import argparse
+import subprocess
+import multiprocessing
+from os.path import dirname, join
+
+ROOT_DIR = dirname(dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT_DIR)
+sys.path.insert(0, join(ROOT_DIR, 'scripts'))
+import cletus._version
+import cletus_archiver as archiver
+
+BLOCK_SIZE = 1024 * 1024
+WORDS      = ('the quick brown fox jumps over lazy dog error warning info debug request '
+              'response user session timeout retry connected closed 200 404 500 GET POST '
+              'select insert update delete from where and or not null true false').split()
+
+
+
+def main():
+    args = get_args()
+    if args.run_one:
+        print(json.dumps(run_one(json.loads(args.run_one))))
+        return 0
+
+    codecs = [codec for codec in args.codecs.split(',') if codec in archiver.CODECS]
+    if not codecs:
+        print('none of the codecs are installed: %s' % args.codecs, file=sys.stderr)
+        return 2
+    workers_list = [int(workers) for workers in args.workers.split(',')]
+
+    temp_dir = tempfile.mkdtemp(prefix='bench_cletus_archiver.')
+    try:
+        tree_dir = join(temp_dir, 'tree')
+        start_time = time.time()
+        tree = generate_tree(tree_dir, args.seed, args.small_files, args.small_dirs,
+                             args.small_kb, args.huge_files, args.huge_mb)
+        print('generated %d files of %.1f MB in %.1f seconds'
+              % (tree['files'], tree['bytes'] / 1048576.0, time.time() - start_time))
+
+        results = []
+        for codec in codecs:
+            for workers in workers_list:
+                work_dir = join(temp_dir, 'work')
+                shutil.copytree(tree_dir, work_dir)
+                try:
+                    result = run_in_process({'work_dir':   work_dir,
+                                             'codec':      codec,
+                                             'workers':    workers,
+                                             'processes':  args.processes,
+                                             'batch_size': args.batch_size})
+                finally:
+                    shutil.rmtree(work_dir)
+                result.update(codec=codec, workers=workers, processes=args.processes,
+                              files=tree['files'], bytes_in=tree['bytes'])
+                result['files_per_sec'] = result['files'] / result['seconds']
+                result['mb_per_sec']    = result['bytes_in'] / 1048576.0 / result['seconds']
+                results.append(result)
+                print_result(result)
+    finally:
+        shutil.rmtree(temp_dir)
+
+    report = {'meta':    get_meta(args, tree),
+              'results': results}
+    with open(args.output, 'w') as f:
+        json.dump(report, f, indent=2, sort_keys=True)
+    print('results written to %s' % args.output)
+
+    if args.compare:
+        with open(args.compare) as f:
+            compare(json.load(f), report, args.threshold)
+    return 0
+
+
+
+def generate_tree(tree_dir, seed, small_files, small_dirs, small_kb, huge_files, huge_mb):
+    """ Writes the synthetic tree & returns its file count and bytes.  The
+        same seed always produces the same bytes - on any python.
+    """
+    rng          = random.Random(seed)
+    text_block   = make_text(rng, BLOCK_SIZE)
+    random_block = make_random(seed, BLOCK_SIZE)
+    old_time     = time.time() - 86400 * 30
+    file_count   = 0
+    byte_count   = 0
+
+    for i in range(small_files):
+        dir_name = join(tree_dir, 'small', 'd%03d' % (i % small_dirs))
+        if not os.path.isdir(dir_name):
+            os.makedirs(dir_name)
+        size   = rng.randint(0, small_kb * 1024)
+        offset = rng.randint(0, BLOCK_SIZE - size)
+        kind   = rng.random()
+        if kind < 0.6:
+            content = text_block[offset:offset + size]
+        elif kind < 0.8:
+            content = random_block[offset:offset + size]
+        else:
+            content = (text_block[offset:offset + size // 2]
+                       + random_block[offset:offset + size - size // 2])
+        byte_count += write_file(join(dir_name, 'f%06d.log' % i), [content], old_time)
+        file_count += 1
+
+    os.makedirs(join(tree_dir, 'huge'))
+    kinds = ['text', 'random', 'mixed']
+    for i in range(huge_files):
+        kind   = kinds[i % len(kinds)]
+        chunks = []
+        for j in range(huge_mb):
+            if kind == 'text' or (kind == 'mixed' and j % 2 == 0):
+                # fresh text for every block - so that long-range matching
+                # codecs don't find whole repeated blocks:
+                chunks.append(make_text(rng, BLOCK_SIZE))
+            else:
+                chunks.append(make_random('%s-%d-%d' % (seed, i, j), BLOCK_SIZE))
+        byte_count += write_file(join(tree_dir, 'huge', 'h%02d_%s.dat' % (i, kind)), chunks, old_time)
+        file_count += 1
+    return {'files': file_count, 'bytes': byte_count}
+
+
+
+def make_text(rng, size):
+    text = ' '.join(rng.choice(WORDS) for i in range(size // 4)).encode('ascii')
+    return (text * 2)[:size]
+
+
+
+def make_random(seed, size):
+    """ Returns reproducible incompressible bytes.
+    """
+    return b''.join(hashlib.sha512(('%s-%d' % (seed, i)).encode('ascii')).digest()
+                    for i in range(size // 64 + 1))[:size]
+
+
+
+def write_file(fqfn, chunks, mtime):
+    size = 0
+    with open(fqfn, 'wb') as f:
+        for chunk in chunks:
+            f.write(chunk)
+            size += len(chunk)
+    os.utime(fqfn, (mtime, mtime))
+    return size
+
+
+
+def run_in_process(settings):
+    output = subprocess.check_output([sys.executable, os.path.abspath(__file__),
+                                      '--run-one', json.dumps(settings)])
+    return json.loads(output.decode('utf-8').strip().splitlines()[-1])
+
+
+
+def run_one(settings):
+    """ Runs the archiver over the work dir with the given settings - within
+        this process, which was started just for it.
+    """
+    archiver.logger = logging.getLogger('bench_cletus_archiver')
+    archiver.logger.addHandler(logging.NullHandler())
+    work_dir    = settings['work_dir']
+    config_fqfn = work_dir + '.yml'
+    with open(config_fqfn, 'w') as f:
+        json.dump({'dir':                work_dir,
+                   'recursive':          True,
+                   'min_age_days':       0,
+                   'codec':              settings['codec'],
+                   'compress_workers':   settings['workers'],
+                   'compress_processes': settings['processes'],
+                   'batch_size':         settings['batch_size'],
+                   'max_files':          1000000000,
+                   'state_index':        False,
+                   'checkpoint':         False}, f)
+    args = argparse.Namespace(config_fqfn=config_fqfn, log_level=None, log_to_console=False,
+                              recursive=None, max_files=None, compress_workers=None,
+                              compress_processes=None)
+    config = archiver.setup_config(args)
+    os.remove(config_fqfn)
+
+    start_self     = resource.getrusage(resource.RUSAGE_SELF)
+    start_children = resource.getrusage(resource.RUSAGE_CHILDREN)
+    start_time     = time.time()
+    archiver.process_all_the_files(config)
+    seconds        = time.time() - start_time
+    end_self       = resource.getrusage(resource.RUSAGE_SELF)
+    end_children   = resource.getrusage(resource.RUSAGE_CHILDREN)
+
+    cpu_seconds = ((end_self.ru_utime - start_self.ru_utime)
+                   + (end_self.ru_stime - start_self.ru_stime)
+                   + (end_children.ru_utime - start_children.ru_utime)
+                   + (end_children.ru_stime - start_children.ru_stime))
+    # ru_maxrss is in kilobytes, except on macs where it's in bytes:
+    rss_scale   = 1048576.0 if sys.platform == 'darwin' else 1024.0
+    bytes_out   = 0
+    remaining   = 0
+    for dir_name, sub_dirs, fns in os.walk(work_dir):
+        for fn in fns:
+            bytes_out += os.path.getsize(join(dir_name, fn))
+            if not fn.endswith(archiver.CODECS[settings['codec']].suffix):
+                remaining += 1
+    return {'seconds':      seconds,
+            'cpu_seconds':  cpu_seconds,
+            'cpu_util':     cpu_seconds / seconds,
+            'peak_rss_mb':  max(end_self.ru_maxrss, end_children.ru_maxrss) / rss_scale,
+            'bytes_out':    bytes_out,
+            'remaining':    remaining}
+
+
+
+def print_result(result):
+    print('%-6s workers: %2d %-9s %8.0f files/s %8.1f MB/s  cpu: %6.2fs (%4.0f%%)  '
+          'rss: %6.1f MB  ratio: %.3f%s'
+          % (result['codec'], result['workers'],
+             '(procs)' if result['processes'] else '(threads)',
+             result['files_per_sec'], result['mb_per_sec'], result['cpu_seconds'],
+             result['cpu_util'] * 100, result['peak_rss_mb'],
+             result['bytes_out'] / float(result['bytes_in'] or 1),
+             '  %d NOT COMPRESSED' % result['remaining'] if result['remaining'] else ''))
+
+
+
+def get_meta(args, tree):
+    return {'cletus_version': cletus._version.__version__,
+            'python':         platform.python_version(),
+            'platform':       platform.platform(),
+            'cpu_count':      multiprocessing.cpu_count(),
+            'date':           time.strftime('%Y-%m-%dT%H:%M:%S'),
+            'seed':           args.seed,
+            'tree':           {'small_files': args.small_files,
+                               'small_dirs':  args.small_dirs,
+                               'small_kb':    args.small_kb,
+                               'huge_files':  args.huge_files,
+                               'huge_mb':     args.huge_mb,
+                               'files':       tree['files'],
+                               'bytes':       tree['bytes']}}
+
+
+
+def compare(old_report, new_report, threshold):
+    """ Prints the change in MB/s of each combination found in both reports,
+        flagging drops of more than threshold percent.
+    """
+    if old_report['meta']['tree'] != new_report['meta']['tree']:
+        print('warning: the reports were run on different trees')
+    key = lambda result: (result['codec'], result['workers'], result['processes'])
+    old_results = dict((key(result), result) for result in old_report['results'])
+    print('\ncompared to %s (cletus %s):' % (old_report['meta']['date'],
+                                             old_report['meta']['cletus_version']))
+    for result in new_report['results']:
+        old_result = old_results.get(key(result))
+        if not old_result:
+            continue
+        change = (result['mb_per_sec'] / old_result['mb_per_sec'] - 1) * 100
+        print('%-6s workers: %2d %-9s %8.1f -> %8.1f MB/s  %+6.1f%%%s'
+              % (result['codec'], result['workers'],
+                 '(procs)' if result['processes'] else '(threads)',
+                 old_result['mb_per_sec'], result['mb_per_sec'], change,
+                 '  REGRESSION' if change < -threshold else ''))
+
+
+
+def get_args():
+    parser = argparse.ArgumentParser(description='benchmarks the cletus_archiver pipeline')
+    parser.add_argument('--codecs', default='gzip,zstd,lz4',
+                        help='comma-separated - those not installed are skipped')
+    parser.add_argument('--workers', default='1,2,4',
+                        help='comma-separated worker counts')
+    parser.add_argument('--processes', action='store_true',
+                        help='compress with a pool of processes rather than threads')
+    parser.add_argument('--batch-size', type=int, default=100)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--small-files', type=int, default=5000)
+    parser.add_argument('--small-dirs', type=int, default=50)
+    parser.add_argument('--small-kb', type=int, default=16,
+                        help='small files are up to this many KB')
+    parser.add_argument('--huge-files', type=int, default=3)
+    parser.add_argument('--huge-mb', type=int, default=64)
+    parser.add_argument('--output', default='bench_cletus_archiver.json')
+    parser.add_argument('--compare',
+                        help='a prior json output to compare MB/s against')
+    parser.add_argument('--threshold', type=float, default=10.0,
+                        help='percent drop in MB/s reported as a regression')
+    parser.add_argument('--run-one',
+                        help=argparse.SUPPRESS)
+    return parser.parse_args()
+
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,166 @@
+#!/usr/bin/env python
+""" Benchmarks the cost per call of ConfigManager.validate and of reading
+    config items.
+
+    Compares validictory.validate, which re-interprets the schema on every
+    call, against the checker that ConfigManager compiles once per schema.
+    Then compares reads through ConfigManager's namespace access, a pinned
+    view from get_view() and cm_config against reads from a plain dict, and
+    against the instance attributes that the old _bunch() copied config
+    into - the reference for namespace reads.  Finally reports the memory a
+    ConfigManager holds for the config - needs python 3.4+ for tracemalloc.
+
+    Usage:
+        python benchmarks/bench_cletus_config.py [--properties N] [--number N]
+
+    See the file "LICENSE" for the full license governing use of this file.
+    Copyright 2013, 2014, 2015, 2016 Ken Farmer
+"""
+from __future__ import absolute_import
+from __future__ import print_function
+from __future__ import division
+
+import gc
+import os
+import sys
+import copy
+import timeit
+import argparse
+from os.path import dirname
+
+sys.path.insert(0, dirname(dirname(os.path.abspath(__file__))))
+import cletus.cletus_config as conf
+
+
+
+def main():
+    args = get_args()
+    schema, config = build_schema_and_config(args.properties)
+
+    config_man = conf.ConfigManager(schema)
+    config_man.add_iterable(config)
+    checker    = conf.compile_schema(schema)
+    assert checker(config) == []
+
+    results = [('validictory.validate',      lambda: conf.valid.validate(config, schema)),
+               ('compile_schema + checker',  lambda: conf.compile_schema(schema)(config)),
+               ('compiled checker',          lambda: checker(config)),
+               ('ConfigManager.validate',    config_man.validate)]
+
+    print('schema properties: %d, calls per test: %d' % (args.properties, args.number))
+    print_results(results, args.number, 'us', 1000000)
+
+    view       = config_man.get_view()
+    cm_config  = config_man.cm_config
+    bunch      = Bunch(config)
+    results = [('dict - top-level',          lambda: config['str_0']),
+               ('dict - nested',             lambda: config['db']['pool']['size']),
+               ('_bunch attrs - top-level',  lambda: bunch.str_0),
+               ('_bunch attrs - nested',     lambda: bunch.db['pool']['size']),
+               ('cm_config - top-level',     lambda: cm_config['str_0']),
+               ('namespace - top-level',     lambda: config_man.str_0),
+               ('namespace - nested',        lambda: config_man.db.pool.size),
+               ('pinned view - top-level',   lambda: view.str_0),
+               ('pinned view - nested',      lambda: view.db.pool.size),
+               ('get_view + nested',         lambda: config_man.get_view().db.pool.size)]
+    print('\nreads per test: %d' % (args.number * 100))
+    print_results(results, args.number * 100, 'ns', 1000000000)
+
+    print_memory(schema, config)
+
+
+
+def print_memory(schema, config):
+    """ Prints the bytes held by a copy of the config, by a ConfigManager
+        with one layer - its frozen layer, first version & bound attributes -
+        and by each later version after a one-item add.
+    """
+    try:
+        import tracemalloc
+    except ImportError:
+        print('\nmemory: needs tracemalloc (python 3.4+)')
+        return
+    tracemalloc.start()
+
+    def measure(func):
+        gc.collect()
+        before = tracemalloc.get_traced_memory()[0]
+        result = func()
+        gc.collect()
+        return tracemalloc.get_traced_memory()[0] - before, result
+
+    plain_bytes, plain = measure(lambda: copy.deepcopy(config))
+    config_man = conf.ConfigManager(schema)
+    first_bytes, _     = measure(lambda: config_man.add_iterable(config))
+    old_version        = config_man.get_view()
+    later_bytes, _     = measure(lambda: config_man.add_iterable({'str_0': 'changed'}))
+    attr_bytes = sum(sys.getsizeof(section.__dict__)
+                     for section in (old_version, old_version['db'], old_version['db']['pool']))
+    tracemalloc.stop()
+
+    print('\nmemory')
+    print('%-28s %10d bytes' % ('plain dict copy', plain_bytes))
+    print('%-28s %10d bytes' % ('first version', first_bytes))
+    print('%-28s %10d bytes' % ('  of which attr tables', attr_bytes))
+    print('%-28s %10d bytes' % ('each later version', later_bytes))
+
+
+
+class Bunch(object):
+    """ Copies config into its instance dict, as ConfigManager._bunch() did
+        before the layered store - nested sections stay plain dicts.
+    """
+    def __init__(self, config):
+        self.__dict__.update(config)
+
+
+
+def print_results(results, number, unit, scale):
+    for name, func in results:
+        seconds = min(timeit.repeat(func, number=number, repeat=3))
+        print('%-28s %10.1f %s/call' % (name, seconds / number * scale, unit))
+
+
+
+def build_schema_and_config(property_count):
+    """ Returns a schema & matching config with a mix of top-level types and
+        one nested section.
+    """
+    properties = {}
+    config     = {}
+    for i in range(property_count):
+        if i % 4 == 0:
+            properties['str_%d' % i]  = {'type': 'string'}
+            config['str_%d' % i]      = 'value %d' % i
+        elif i % 4 == 1:
+            properties['int_%d' % i]  = {'type': ['integer', 'null'], 'minimum': 0}
+            config['int_%d' % i]      = i
+        elif i % 4 == 2:
+            properties['enum_%d' % i] = {'enum': ['DEBUG', 'INFO', 'WARNING']}
+            config['enum_%d' % i]     = 'INFO'
+        else:
+            properties['bool_%d' % i] = {'type': 'boolean', 'required': False}
+            config['bool_%d' % i]     = True
+    properties['db'] = {'type': 'object',
+                        'properties': {'host': {'type': 'string'},
+                                       'port': {'type': 'integer', 'maximum': 65535},
+                                       'pool': {'type': 'object',
+                                                'properties': {'size': {'type': 'integer'}}}}}
+    config['db']     = {'host': 'localhost', 'port': 5432, 'pool': {'size': 10}}
+    schema = {'type': 'object',
+              'properties': properties,
+              'additionalProperties': False}
+    return schema, config
+
+
+
+def get_args():
+    parser = argparse.ArgumentParser(description='benchmarks ConfigManager.validate and config reads')
+    parser.add_argument('--properties', type=int, default=50)
+    parser.add_argument('--number', type=int, default=2000)
+    return parser.parse_args()
+
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -34,12 +34,35 @@ import sys
 import argparse
 import time
 import logging
+import re
+import errno
+import hashlib
+import pickle
+import tempfile
+import threading
+import glob
+import multiprocessing
+from decimal import Decimal
 from pprint import pprint as pp
 
 import yaml
 import validictory as valid
 import appdirs
 
+# use the libyaml-based loader when available - it's much faster:
+YamlLoader = getattr(yaml, 'CSafeLoader', yaml.SafeLoader)
+
+# uncached config bytes below which starting a pool of processes costs more
+# than the parsing it would spread:
+PARALLEL_MIN_BYTES = 4 * 1024 * 1024
+
+try:
+    string_types  = (basestring,)
+    integer_types = (int, long)
+except NameError:               # python 3
+    string_types  = (str,)
+    integer_types = (int,)
+
 
 class NullHandler(logging.Handler):
     def emit(self, record):
@@ -48,13 +71,60 @@ class NullHandler(logging.Handler):
 
 
 class ConfigManager(object):
+    """ Combines config from files, environmental variables, argument
+        namespaces, iterables and defaults into a single config.
+
+        Each add_* call creates a layer that's kept separately.  The
+        consolidated config (cm_config) is resolved from those layers only
+        when it's needed and is then memoized until a layer changes - or,
+        with namespace access, as soon as a layer changes.  For each
+        key the value from the highest-priority layer wins - except that a
+        None never overrides a value from a lower-priority layer.
+
+        Nested sections are deep-merged across layers, so a later layer only
+        overrides the nested keys it provides - unless deep_merge is False, in
+        which case nested sections are replaced wholesale.  Nested sections
+        can be accessed as namespaces (ex: config.db.pool.size): they're
+        read-only FrozenDicts with their items bound as attributes once per
+        version, so a read never repeats the merge or a lookup through the
+        layers.
+
+        That binding trades memory for speed: each FrozenDict holds a second
+        table of references to its items, and the top-level items are bound
+        onto the ConfigManager when a version is published.  Values are never
+        copied, though - each layer is frozen once when it's added, and a
+        version shares every section it didn't have to merge with the
+        layers, so a version costs a copy of the merged sections only.  Ex:
+        with 2000 top-level items - 52KB as a plain dict - the first version
+        holds 430KB including the frozen layer, sources & bound attributes,
+        and each later version another 105KB.  See
+        benchmarks/bench_cletus_config.py.
+
+        By default a layer's priority is based on the order of the add_*
+        calls - later adds override earlier ones, and defaults are always
+        the lowest priority.  An explicit priority can be provided instead.
+        Adding a layer with the name of an existing layer replaces it.
+
+        get_source(key) reports the name of the layer a key's value came from.
+
+        The consolidated config is published as an immutable ConfigVersion
+        through a single reference, so readers in other threads never see a
+        half-applied add and need no locks.  Writers build the next layer
+        list off to the side and then swap it in.  cm_config is read-only
+        (its dicts and lists raise TypeError if modified), and it - like any
+        section read from it, or get_view() - stays pinned to one version,
+        so that a series of reads, ex: db = config.db; db.host then db.port,
+        is consistent.
+    """
 
     def __init__(self,
                  config_schema=None,
                  log_name='__main__',
-                 namespace_access=True):
+                 namespace_access=True,
+                 deep_merge=True):
 
         self.cm_namespace_access = namespace_access
+        self.cm_deep_merge       = deep_merge
 
         # set up logging:
         self.cm_logger   = logging.getLogger('%s.cletus_config' % log_name)
@@ -64,51 +134,208 @@ class ConfigManager(object):
 
         self.cm_config_schema    = config_schema
         self.cm_config_fqfn      = None
+        self.cm_config_fqfns     = []   # every file added, in order
 
         self.cm_config_file      = {}
         self.cm_config_env       = {}
         self.cm_config_namespace = {}
         self.cm_config_iterable  = {}
         self.cm_config_defaults  = {}
-        self.cm_config           = {}
+
+        self.cm_layers           = []   # ConfigLayers, lowest priority first
+        self.cm_layer_seq        = 0
+        self.cm_merged           = None # memoized ConfigVersion
+        self.cm_write_lock       = threading.RLock()
+        self.cm_bound_names      = []   # config items bound as attributes
+
+        self.cm_validators       = {}   # id(schema): (schema, checker)
+        self.cm_parse_cache      = parse_cache
+
+        # used to reload the config:
+        self.cm_log_name         = log_name
+        self.cm_history          = []   # (method name, kwargs) of each add
+        self.cm_file_stats       = {}   # fqfn: stat signature when loaded
+        self.cm_callbacks        = []
+        self.cm_reload_lock      = threading.Lock()
+        self.cm_watch_stop       = None
 
         # store an original copy of variable names to use to protect
         # from updating by bunch later on.
         self.cm_orig_dict_keys   = list(self.__dict__.keys())
 
 
-    def _bunch(self):
-        for key, val in list(self.cm_config.items()):
+    def __getattr__(self, name):
+        """ Provides namespace access to config items.  Only called when
+            normal attribute lookup fails, so never hides real attributes.
+        """
+        if name.startswith('cm_') or name.startswith('__'):
+            raise AttributeError(name)
+        if self.cm_namespace_access or name == 'log_level':
+            version = self.cm_merged
+            if version is None or version.layers is not self.cm_layers:
+                version = self._get_version()
+            config = version.cm_config
+            if name in config:
+                return config[name]
+            elif name == 'log_level':       # always provided, as before layers
+                return None
+        raise AttributeError("'%s' object has no attribute '%s'"
+                             % (self.__class__.__name__, name))
+
+
+    @property
+    def cm_config(self):
+        """ The consolidated config, resolved from all layers.
+        """
+        return self._get_version().cm_config
+
+
+    def _get_version(self):
+        """ Returns the ConfigVersion for the current layers - merging them if
+            that hasn't been done yet.  Versions are keyed by the identity of
+            the layer list, which writers replace rather than modify, so a
+            version built from stale layers is never returned.
+        """
+        version = self.cm_merged
+        layers  = self.cm_layers
+        if version is None or version.layers is not layers:
+            version = self.cm_merged = _merge_version(layers, self.cm_deep_merge)
+        return version
+
+
+    def _publish(self, layers, version=None):
+        """ Makes layers - and the version merged from them, if given - the
+            current config.  Must be called with cm_write_lock held.
+
+            With namespace access the version is merged now, if not given,
+            and its top-level items are bound as instance attributes - so
+            that namespace reads are plain attribute lookups rather than calls
+            to __getattr__, and never need the lock.  Each bound item is
+            replaced in one step, then items the version no longer has are
+            removed.
+        """
+        if version is None and self.cm_namespace_access:
+            version = _merge_version(layers, self.cm_deep_merge)
+        if version is not None:
+            self.cm_merged = version
+        self.cm_layers = layers
+        if not self.cm_namespace_access:
+            return
+
+        attrs       = self.__dict__
+        bound_names = []
+        for key, val in version.cm_config.items():
+            if isinstance(key, string_types) and key not in self.cm_orig_dict_keys:
+                attrs[key] = val
+                bound_names.append(key)
+        for key in set(self.cm_bound_names) - set(bound_names):
+            attrs.pop(key, None)
+        self.cm_bound_names = bound_names
+
+
+    def get_view(self):
+        """ Returns the whole config as a read-only FrozenDict, pinned to the
+            current version: later adds or reloads don't affect it.
+        """
+        return self._get_version().cm_config
+
+
+    def get_source(self, key):
+        """ Returns the name of the layer that provided the key's value, or
+            None if the key isn't in the config.  Nested keys are given as
+            dotted paths, ex: 'db.pool.size'.
+        """
+        version = self._get_version()
+        if key in version.cm_config:
+            return version.sources.get(key)
+        return _get_source(version, key.split('.'))
+
+
+    def get_layers(self):
+        """ Returns a list of (layer name, priority) tuples, highest priority
+            first.
+        """
+        return [(layer.name, layer.priority) for layer in reversed(self.cm_layers)]
+
+
+    def _check_reserved(self, config):
+        if not self.cm_namespace_access:
+            return
+        for key in config:
             if key in self.cm_orig_dict_keys:
                 raise ValueError('config key is a reserved value: %s' % key)
-            elif key in dir(ConfigManager):
+            elif key in _RESERVED_NAMES:
                 raise ValueError('config key is a reserved value: %s' % key)
-            else:
-                self.__dict__[key] = val
 
-    def _post_add_maintenance(self, config):
-        clean_config = self._remove_null_overrides(config)
-        self.cm_config.update(clean_config)
 
-        self.log_level = self.cm_config.get('log_level', None)
-        if self.cm_namespace_access:
-            self._bunch()
+    def _post_add_maintenance(self, config, source='iterable', name=None, priority=None):
+        """ Adds config as a layer - or if config is already the data of a
+            layer, just notes that it has changed.
+        """
+        with self.cm_write_lock:
+            for layer in self.cm_layers:
+                if layer.data is config:
+                    self._check_reserved(config)
+                    # layers are immutable - so refreeze it as a new one:
+                    self._publish([ConfigLayer(old.name, old.source, old.priority,
+                                               old.seq, old.data)
+                                   if old is layer else old
+                                   for old in self.cm_layers])
+                    return
+            self._add_layer(source, config, name, priority)
+
+
+    def _add_layer(self, source, config, name=None, priority=None):
+        """ Adds a layer - or replaces the layer with the same name.
+            Layers without a priority get the next priority after the highest
+            so far - except for defaults which get the lowest priority.
+        """
+        with self.cm_write_lock:
+            self._check_reserved(config)
+
+            if name is None:
+                name = source
+                names = set(layer.name for layer in self.cm_layers)
+                seq   = 1
+                while name in names:
+                    seq += 1
+                    name = '%s-%d' % (source, seq)
 
+            old_layer = None
+            for layer in self.cm_layers:
+                if layer.name == name:
+                    old_layer = layer
+            if priority is None:
+                if old_layer:
+                    priority = old_layer.priority
+                elif source == 'defaults':
+                    priority = DEFAULTS_PRIORITY
+                else:
+                    priority = max([layer.priority for layer in self.cm_layers
+                                    if layer.priority != DEFAULTS_PRIORITY] or [0]) + 1
 
-    def _remove_null_overrides(self, dictname):
-        working_dict = dict(dictname)
-        for key in dictname:
-            if dictname[key] is None and self.cm_config.get(key, None) is not None:
-                working_dict.pop(key)
-        return working_dict
+            self.cm_layer_seq += 1
+            new_layer = ConfigLayer(name, source, priority, self.cm_layer_seq, config)
+            layers    = [layer for layer in self.cm_layers if layer is not old_layer]
+            layers.append(new_layer)
+            layers.sort(key=lambda layer: (layer.priority, layer.seq))
+            self._publish(layers)
 
 
     def add_file(self,
                  app_name=None,
                  config_dir=None,
                  config_fn=None,
-                 config_fqfn=None):
-
+                 config_fqfn=None,
+                 disk_cache=False,
+                 priority=None):
+        """ Adds a yaml config file as a layer named file:<config_fqfn>.
+            Parsed files are cached in memory by path, mtime, size and hash, so
+            re-adding an unchanged file doesn't re-parse it.  If disk_cache is
+            True the parsed file is also cached on disk next to the config
+            file - which helps short-lived programs that load the same large
+            config on every run.
+        """
         # figure out the config_fqfn:
         if config_fqfn:
             self.cm_config_fqfn = config_fqfn
@@ -127,33 +354,164 @@ class ConfigManager(object):
             self.cm_logger.critical('config file missing: %s' % self.cm_config_fqfn)
             raise IOError('config file missing, was expecting %s' % self.cm_config_fqfn)
 
+        self.cm_history.append(('add_file', {'config_fqfn': self.cm_config_fqfn,
+                                             'disk_cache':  disk_cache,
+                                             'priority':    priority}))
+        self.cm_file_stats[self.cm_config_fqfn] = _get_stat_signature(self.cm_config_fqfn)
+        self.cm_config_fqfns.append(self.cm_config_fqfn)
+
         self.cm_config_file = {}
-        with open(self.cm_config_fqfn, 'r') as f:
-            self.cm_config_file = yaml.safe_load(f)
+        self.cm_config_file = self.cm_parse_cache.load(self.cm_config_fqfn,
+                                                       disk_cache=disk_cache)
+
+        self._add_layer('file', self.cm_config_file,
+                        name='file:%s' % self.cm_config_fqfn, priority=priority)
+
 
-        self._post_add_maintenance(self.cm_config_file)
 
+    def add_files(self,
+                  config_paths,
+                  disk_cache=False,
+                  priority=None,
+                  processes=None,
+                  parallel_min_bytes=PARALLEL_MIN_BYTES,
+                  executor=None):
+        """ Adds a list of yaml config files as layers, each named
+            file:<fqfn> - with later files overriding earlier ones.
 
+            Each path can be:
+               - a file - which must exist
+               - a directory, ex: conf.d - which adds its *.yml and *.yaml
+                 files in name order.  It may be empty.
+               - a glob pattern, ex: /etc/myapp/*.yml - whose matches are
+                 added in name order.  It may match nothing.
+            So a typical list would be a server-wide config, then the app's
+            config, then a directory of overrides.
 
-    def add_env_vars(self, key_list=None, key_to_lower=False):
+            Each file is cached independently (see ParseCache), so a change to
+            one file only re-parses that file.  If the files that need parsing
+            total parallel_min_bytes or more they're parsed by a pool of
+            processes - None disables the pool.  Or pass an executor - any
+            object with a map(), ex: a multiprocessing.Pool the app already
+            runs - to parse them with instead.  Reloads always parse within
+            this process.  If priority is given the files get consecutive
+            priorities starting from it.  Returns the list of files added.
+        """
+        self.cm_history.append(('add_files', {'config_paths':       config_paths,
+                                              'disk_cache':         disk_cache,
+                                              'priority':           priority,
+                                              'processes':          processes,
+                                              'parallel_min_bytes': parallel_min_bytes}))
+        fqfns = []
+        for config_path in config_paths:
+            if os.path.isdir(config_path):
+                # adding or removing a file changes the dir's signature:
+                self.cm_file_stats[config_path] = _get_stat_signature(config_path)
+                fqfns.extend(sorted(glob.glob(os.path.join(config_path, '*.yml'))
+                                    + glob.glob(os.path.join(config_path, '*.yaml'))))
+            elif glob.has_magic(config_path):
+                self.cm_file_stats[os.path.dirname(config_path) or '.'] = \
+                    _get_stat_signature(os.path.dirname(config_path) or '.')
+                fqfns.extend(sorted(glob.glob(config_path)))
+            elif os.path.isfile(config_path):
+                fqfns.append(config_path)
+            else:
+                self.cm_logger.critical('config file missing: %s' % config_path)
+                raise IOError('config file missing, was expecting %s' % config_path)
+
+        for fqfn in fqfns:
+            self.cm_file_stats[fqfn] = _get_stat_signature(fqfn)
+        configs = self.cm_parse_cache.load_many(fqfns, disk_cache=disk_cache,
+                                                processes=processes,
+                                                parallel_min_bytes=parallel_min_bytes,
+                                                executor=executor)
+        for i, (fqfn, config) in enumerate(zip(fqfns, configs)):
+            self.cm_config_fqfn = fqfn
+            self.cm_config_file = config
+            self.cm_config_fqfns.append(fqfn)
+            self._add_layer('file', config, name='file:%s' % fqfn,
+                            priority=None if priority is None else priority + i)
+        self.cm_logger.debug('added config files: %s' % ', '.join(fqfns))
+        return fqfns
+
+
+
+    def add_env_vars(self,
+                     key_list=None,
+                     key_to_lower=False,
+                     priority=None,
+                     prefix=None,
+                     separator='__',
+                     array_delimiter=','):
+        """ Adds environmental variables as a layer.
+
+            Without a prefix, the variables named in key_list - or the
+            upper-cased top-level schema properties - are looked up directly.
+
+            With a prefix, variables are named <prefix><separator><key>, where
+            nested keys are joined by the separator and upper-cased.  Ex: with
+            a prefix of APP, APP__DB__POOL_SIZE provides db.pool_size.  The
+            names are derived from the schema so each is looked up directly -
+            without a schema the environment is scanned for the prefix, and
+            keys are lower-cased.
+
+            Values are coerced to the schema's type for that key: integer,
+            number, boolean (true/false, yes/no, on/off, 1/0), null (empty
+            or 'null') and array (split on array_delimiter, with the items
+            coerced too).  Values that can't be coerced are left as strings
+            for validate() to report.
+        """
         assert key_to_lower in [True, False]
+        self.cm_history.append(('add_env_vars', {'key_list':        key_list,
+                                                 'key_to_lower':    key_to_lower,
+                                                 'priority':        priority,
+                                                 'prefix':          prefix,
+                                                 'separator':       separator,
+                                                 'array_delimiter': array_delimiter}))
         self.cm_config_env = {}
 
-        final_key_list = key_list or self._get_schema_keys()
-        if not final_key_list:
-            raise ValueError('add_env_vars called without key_list or cm_config_schema')
+        if prefix:
+            env_plan = self._get_prefixed_env_plan(prefix, separator)
+        else:
+            final_key_list = key_list or self._get_schema_keys()
+            if not final_key_list:
+                raise ValueError('add_env_vars called without key_list or cm_config_schema')
+            properties = self._get_schema_properties()
+            env_plan   = []
+            for env_name in final_key_list:
+                key = env_name.lower() if key_to_lower else env_name
+                prop_schema = properties.get(key, properties.get(env_name.lower()))
+                env_plan.append((env_name, (key,), prop_schema))
 
-        # get list of tuples of environment variables
-        env_list = list(os.environ.items())
+        for env_name, path, prop_schema in env_plan:
+            val = os.environ.get(env_name)
+            if val is None:
+                continue
+            val = _coerce_env_value(val, prop_schema, array_delimiter)
+            section = self.cm_config_env
+            for key in path[:-1]:
+                section = section.setdefault(key, {})
+            section[path[-1]] = val
 
-        for env_tup in env_list:
-            if env_tup[0] in final_key_list:
-                if key_to_lower:
-                    self.cm_config_env[env_tup[0].lower()] = env_tup[1]
-                else:
-                    self.cm_config_env[env_tup[0]] = env_tup[1]
+        self._add_layer('env', self.cm_config_env, priority=priority)
 
-        self._post_add_maintenance(self.cm_config_env)
+
+    def _get_prefixed_env_plan(self, prefix, separator):
+        """ Returns a list of (env var name, config path, schema) tuples.
+        """
+        env_plan = []
+        if self.cm_config_schema:
+            for path, prop_schema in _walk_schema_properties(self.cm_config_schema):
+                env_name = separator.join([prefix] + [str(key).upper() for key in path])
+                env_plan.append((env_name, path, prop_schema))
+        else:
+            env_prefix = prefix + separator
+            for env_name in os.environ:
+                if env_name.startswith(env_prefix) and len(env_name) > len(env_prefix):
+                    path = tuple(key.lower() for key in
+                                 env_name[len(env_prefix):].split(separator))
+                    env_plan.append((env_name, path, None))
+        return env_plan
 
 
     def _get_schema_keys(self):
@@ -164,33 +522,59 @@ class ConfigManager(object):
             return []
 
 
-    def add_namespace(self, args):
+    def _get_schema_properties(self):
+        if self.cm_config_schema:
+            return self.cm_config_schema.get('properties') or {}
+        return {}
+
+
+    def add_namespace(self, args, name=None, priority=None):
+        self.cm_history.append(('add_namespace', {'args':     args,
+                                                  'name':     name,
+                                                  'priority': priority}))
         self.cm_config_namespace = {}
         self.cm_config_namespace.update(vars(args))
-        self._post_add_maintenance(self.cm_config_namespace)
+        self._add_layer('namespace', self.cm_config_namespace, name, priority)
 
-    def add_iterable(self, user_iter):
+    def add_iterable(self, user_iter, name=None, priority=None):
         self.cm_config_iterable = {}
         self.cm_config_iterable.update(user_iter)
-        self._post_add_maintenance(self.cm_config_iterable)
+        self.cm_history.append(('add_iterable', {'user_iter': dict(self.cm_config_iterable),
+                                                 'name':      name,
+                                                 'priority':  priority}))
+        self._add_layer('iterable', self.cm_config_iterable, name, priority)
 
     def add_defaults(self, default_dict):
         """ Applies defaults to empty config items with the following limits:
             - only if the default is not None and the field is None
-            - only if they are top-level items - no nested items
+            Nested defaults are deep-merged like any other layer.  All
+            defaults are kept in a single layer with the lowest priority.
         """
-        # first create dict with all needed defaults:
+        self.cm_history.append(('add_defaults', {'default_dict': default_dict}))
+
         for key in default_dict:
-            if key is not None and self.cm_config.get(key, None) is None:
+            if key is not None:
                 self.cm_config_defaults[key] = default_dict[key]
 
-        # next update the main config from it:
-        self._post_add_maintenance(self.cm_config_defaults)
+        self._post_add_maintenance(self.cm_config_defaults, source='defaults',
+                                   name='defaults')
 
 
 
     def validate(self, config_type='config', schema=None):
+        """ Validates one of the config dictionaries against the schema.  The
+            schema is compiled into a checker function on first use and the
+            checker is cached, so repeated validations don't re-interpret the
+            schema.  All errors are logged and reported together.
+
+            Note that a schema should not be modified once it has been used.
 
+            Returns:
+                True  - if the config is valid
+                False - if there's no config_schema
+            Raises:
+                ValueError - if the config is invalid
+        """
         config_schema = schema or self.cm_config_schema
 
         config_types = {'config':           self.cm_config,
@@ -201,16 +585,1363 @@ class ConfigManager(object):
         assert config_type in config_types
 
         if self.cm_config_schema:
-            try:
-                valid.validate(config_types[config_type], config_schema)
-            except valid.FieldValidationError as e:
-                self.cm_logger.critical('Config error on field %s' % e.fieldname)
-                self.cm_logger.critical(e)
-                raise ValueError('config error: %s' % e)
+            errors = self._get_validator(config_schema)(config_types[config_type])
+            if errors:
+                for error in errors:
+                    self.cm_logger.critical('Config error: %s' % error)
+                raise ValueError('config error: %s' % '; '.join(errors))
             else:
                 return True
         else:
             return False
 
 
+    def export_snapshot(self, validate=True):
+        """ Returns an immutable ConfigSnapshot of the current config, which
+            can be passed to child processes (ex: via to_bytes() or save())
+            and rehydrated there with from_snapshot() - without re-reading
+            files, the environment or re-validating.
+
+            Raises:
+                ValueError - if validate is True and the config is invalid
+        """
+        if validate:
+            self.validate()
+        version         = self._get_version()
+        source_digests  = []
+        for layer in version.layers:
+            fqfn = _get_layer_fqfn(layer)
+            if fqfn and fqfn in self.cm_parse_cache.entries:
+                source_digests.append((layer.name, fqfn,
+                                       self.cm_parse_cache.entries[fqfn][2].decode('ascii')))
+            else:
+                data_digest = hashlib.sha1(pickle.dumps(layer.data, 2)).hexdigest()
+                source_digests.append((layer.name, None, data_digest))
+        return ConfigSnapshot(version.cm_config, dict(version.sources), source_digests)
+
+
+    @classmethod
+    def from_snapshot(cls, snapshot, log_name='__main__', namespace_access=True):
+        """ Returns a new ConfigManager with a single layer holding the
+            snapshot's config.  Sources are preserved for get_source().
+            Nothing is parsed, merged or validated.
+        """
+        config_man = cls(log_name=log_name, namespace_access=namespace_access)
+        with config_man.cm_write_lock:
+            config_man._check_reserved(snapshot.cm_config)
+            config_man.cm_layer_seq = 1
+            layers = [ConfigLayer('snapshot', 'snapshot', 1, 1, snapshot.cm_config)]
+            config_man._publish(layers, ConfigVersion(layers, snapshot.cm_config,
+                                                      snapshot.sources))
+        return config_man
+
+
+    def on_change(self, callback):
+        """ Registers a function to call after a reload changes the config.
+            It is passed a dict of only the keys that changed, with values of
+            (old value, new value).  Keys that were added or removed have an
+            old or new value of None.
+        """
+        self.cm_callbacks.append(callback)
+
+
+    def reload_if_changed(self):
+        """ Reloads the config if any of its files have changed since they
+            were loaded.  Cheap enough to call within a daemon's main loop:
+            it's just a stat per file.
+
+            Returns True if the config was reloaded, otherwise False.
+        """
+        for fqfn, signature in list(self.cm_file_stats.items()):
+            if _get_stat_signature(fqfn) != signature:
+                return self.reload()
+        return False
+
+
+    def reload(self):
+        """ Re-reads the config files and re-applies every add in its original
+            order, then validates the result against config_schema.  If that
+            all succeeds the new config is swapped in and the on_change
+            callbacks are called.  Otherwise the old config is kept.
+
+            Returns True if the config was reloaded, otherwise False.
+        """
+        with self.cm_reload_lock:
+            new_config = self._new_manager()
+            try:
+                new_config._replay(self.cm_history, in_process=True)
+                new_config.validate()
+            except Exception as e:
+                self.cm_logger.error('config reload failed - keeping prior config: %s' % e)
+                # don't retry until the files change again:
+                self.cm_file_stats.update(new_config.cm_file_stats)
+                return False
+
+            changes = _get_changes(self.cm_config, new_config.cm_config)
+            self._swap(new_config)
+
+        if changes:
+            self.cm_logger.info('config reloaded - changed keys: %s' % ', '.join(sorted(changes)))
+            for callback in self.cm_callbacks:
+                callback(changes)
+        return True
+
+
+    def rebuild(self, path_map=None):
+        """ Returns a new ConfigManager built by re-applying every add in its
+            original order - re-reading files and the environment.  path_map
+            is an optional dict of {old path: new path} for the files and
+            directories given to add_file/add_files, so that another set of
+            files can be loaded through the same layering.  The result is not
+            validated.
+        """
+        new_config = self._new_manager()
+        new_config._replay(self.cm_history, path_map)
+        return new_config
+
+
+    def diff(self, other, validate=True):
+        """ Returns a ConfigDiff of the changes from this config to other's,
+            after all layers have been merged.  If validate is True, other's
+            config is also validated against this config_schema - in a single
+            pass - and each error is attached to the change it belongs to.
+
+        Typical Usage:
+            candidate = config.rebuild({'/etc/app/app.yml': 'new/app.yml'})
+            config_diff = config.diff(candidate)
+            if not config_diff.is_valid():
+                ...
+        """
+        old_version = self._get_version()
+        new_version = other._get_version()
+        errors      = []
+        if validate and self.cm_config_schema:
+            errors = self._get_validator(self.cm_config_schema)(new_version.cm_config)
+        changes = []
+        _diff_config(old_version.cm_config, new_version.cm_config, (), changes)
+        return ConfigDiff([ConfigChange(path, kind, old_val, new_val,
+                                        _get_source(old_version, path),
+                                        _get_source(new_version, path))
+                           for path, kind, old_val, new_val in changes],
+                          errors)
+
+
+    def _new_manager(self):
+        """ Returns an empty ConfigManager with the same settings - sharing
+            the compiled validators.
+        """
+        new_config = ConfigManager(self.cm_config_schema,
+                                   log_name=self.cm_log_name,
+                                   namespace_access=self.cm_namespace_access,
+                                   deep_merge=self.cm_deep_merge)
+        new_config.cm_validators = self.cm_validators
+        return new_config
+
+
+    def _replay(self, history, path_map=None, in_process=False):
+        """ Re-applies every add in history.  If in_process is True files
+            are never parsed by a pool of processes - ex: from the watch
+            thread, where forking could copy another thread's held locks.
+        """
+        for method_name, kwargs in history:
+            if path_map and method_name == 'add_file':
+                kwargs = dict(kwargs, config_fqfn=path_map.get(kwargs['config_fqfn'],
+                                                               kwargs['config_fqfn']))
+            elif path_map and method_name == 'add_files':
+                kwargs = dict(kwargs, config_paths=[path_map.get(path, path)
+                                                    for path in kwargs['config_paths']])
+            if in_process and method_name == 'add_files':
+                kwargs = dict(kwargs, parallel_min_bytes=None)
+            getattr(self, method_name)(**kwargs)
+
+
+    def _swap(self, new_config):
+        """ Replaces the config layers with those from new_config.
+        """
+        version = new_config._get_version()
+        with self.cm_write_lock:
+            for attr in ('cm_config_fqfn', 'cm_config_fqfns', 'cm_config_file', 'cm_config_env',
+                         'cm_config_namespace', 'cm_config_iterable',
+                         'cm_config_defaults', 'cm_file_stats', 'cm_layer_seq'):
+                setattr(self, attr, getattr(new_config, attr))
+            self._publish(version.layers, version)
+
+
+    def watch(self, interval=1.0):
+        """ Starts a daemon thread that checks the config files for changes
+            every interval seconds, and reloads the config when they change.
+        """
+        if self.cm_watch_stop is not None:
+            return
+        self.cm_watch_stop = threading.Event()
+        watcher = threading.Thread(target=self._watch_loop,
+                                   args=(interval, self.cm_watch_stop),
+                                   name='cletus_config_watcher')
+        watcher.daemon = True
+        watcher.start()
+
+
+    def stop_watching(self):
+        if self.cm_watch_stop is not None:
+            self.cm_watch_stop.set()
+            self.cm_watch_stop = None
+
+
+    def _watch_loop(self, interval, stop):
+        while not stop.wait(interval):
+            try:
+                self.reload_if_changed()
+            except Exception as e:
+                self.cm_logger.error('config watcher error: %s' % e)
+
+
+    def _get_validator(self, schema):
+        try:
+            cached_schema, checker = self.cm_validators[id(schema)]
+            if cached_schema is schema:
+                return checker
+        except KeyError:
+            pass
+        checker = compile_schema(schema)
+        self.cm_validators[id(schema)] = (schema, checker)
+        return checker
+
+
+
+# reserved for ConfigManager attributes & methods:
+_RESERVED_NAMES   = frozenset(dir(ConfigManager))
+
+# defaults are always the lowest priority layer:
+DEFAULTS_PRIORITY = -sys.maxsize
+
+
+
+class ConfigSnapshot(object):
+    """ An immutable, validated copy of a ConfigManager's consolidated
+        config - created by ConfigManager.export_snapshot().
+
+        It has a compact binary form (to_bytes/from_bytes, save/load) that's
+        just a checksummed pickle, so rehydrating it involves no yaml
+        parsing, merging or validation.  The config is
+        read-only, and config sections are FrozenDicts, ex:
+        snapshot.db.pool.size or snapshot['db'].
+
+        The checksum covers the config and the digests of every source layer
+        - for files, the digest of the file contents.  verify_sources()
+        re-hashes the files to prove the snapshot still matches them.
+
+    Typical Usage:
+        snapshot = config.export_snapshot()
+        pool = multiprocessing.Pool(initializer=init_worker,
+                                    initargs=(snapshot.to_bytes(),))
+
+        def init_worker(snapshot_bytes):
+            global config
+            config = ConfigManager.from_snapshot(
+                         ConfigSnapshot.from_bytes(snapshot_bytes))
+    """
+
+    magic = b'cletus-snapshot-1\n'
+
+    def __init__(self, config, sources, source_digests):
+        self.cm_config      = config
+        self.sources        = sources
+        self.source_digests = source_digests
+        checksum            = hashlib.sha1(pickle.dumps(source_digests, 2))
+        checksum.update(pickle.dumps(sorted(config.items(), key=lambda item: str(item[0])), 2))
+        self.checksum       = checksum.hexdigest()
+
+    def __getattr__(self, name):
+        if name.startswith('__') or name.startswith('cm_'):
+            raise AttributeError(name)
+        try:
+            return self[name]
+        except KeyError:
+            raise AttributeError("config snapshot has no item '%s'" % name)
+
+    def __getitem__(self, key):
+        return self.cm_config[key]
+
+    def __contains__(self, key):
+        return key in self.cm_config
+
+    def get_source(self, key):
+        return self.sources.get(key)
+
+    def verify_sources(self):
+        """ Returns True if every file the snapshot was built from still has
+            the same contents - only hashing, not parsing, the files.
+        """
+        for name, fqfn, digest in self.source_digests:
+            if fqfn is None:
+                continue
+            try:
+                with open(fqfn, 'rb') as f:
+                    if hashlib.sha1(f.read()).hexdigest() != digest:
+                        return False
+            except (IOError, OSError):
+                return False
+        return True
+
+    def to_bytes(self):
+        payload = pickle.dumps((self.cm_config, self.sources, self.source_digests,
+                                self.checksum), pickle.HIGHEST_PROTOCOL)
+        return self.magic + hashlib.sha1(payload).hexdigest().encode('ascii') + payload
+
+    @classmethod
+    def from_bytes(cls, data):
+        """ Rehydrates a snapshot from to_bytes() output - or any buffer
+            holding it.  Raises ValueError if the data is corrupt.
+        """
+        header_len = len(cls.magic) + 40
+        if bytes(data[:len(cls.magic)]) != cls.magic:
+            raise ValueError('not a cletus config snapshot')
+        payload = memoryview(data)[header_len:]
+        if hashlib.sha1(payload).hexdigest().encode('ascii') != bytes(data[len(cls.magic):header_len]):
+            raise ValueError('config snapshot is corrupt')
+        config, sources, source_digests, checksum = pickle.loads(payload)
+        snapshot = cls.__new__(cls)
+        snapshot.cm_config      = config
+        snapshot.sources        = sources
+        snapshot.source_digests = source_digests
+        snapshot.checksum       = checksum
+        return snapshot
+
+    def save(self, fqfn):
+        """ Writes the snapshot atomically.
+        """
+        fd, temp_fqfn = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(fqfn)),
+                                         prefix='.tmp_snapshot_')
+        with os.fdopen(fd, 'wb') as f:
+            f.write(self.to_bytes())
+        os.rename(temp_fqfn, fqfn)
+
+    @classmethod
+    def load(cls, fqfn):
+        """ Reads a saved snapshot.  Each worker that loads it unpickles its
+            own copy of the config - the saving is in skipping the yaml
+            parsing, merging and validation, not in memory.
+        """
+        with open(fqfn, 'rb') as f:
+            return cls.from_bytes(f.read())
+
+
+
+class ConfigChange(object):
+    """ One difference between two configs: kind is 'added', 'removed' or
+        'changed', and path is the tuple of keys to the item.  errors are
+        the schema errors within the new value.
+    """
+
+    __slots__ = ('path', 'kind', 'old', 'new', 'old_source', 'new_source', 'errors')
+
+    def __init__(self, path, kind, old, new, old_source, new_source):
+        self.path       = path
+        self.kind       = kind
+        self.old        = old
+        self.new        = new
+        self.old_source = old_source
+        self.new_source = new_source
+        self.errors     = []
+
+    @property
+    def key(self):
+        return '.'.join(self.path)
+
+    def to_dict(self):
+        return {'key':        self.key,
+                'kind':       self.kind,
+                'old':        self.old,
+                'new':        self.new,
+                'old_source': self.old_source,
+                'new_source': self.new_source,
+                'errors':     self.errors}
+
+    def __repr__(self):
+        return 'ConfigChange(%s %s: %r -> %r)' % (self.kind, self.key, self.old, self.new)
+
+
+
+class ConfigDiff(object):
+    """ The changes between two merged configs - created by
+        ConfigManager.diff().  errors holds every schema error in the new
+        config, and each error is also attached to the change it falls
+        within.  Errors outside of any change were already in the old config.
+    """
+
+    def __init__(self, changes, errors):
+        self.changes = changes
+        self.errors  = errors
+        for error in errors:
+            match = _ERROR_FIELD.search(error)
+            if not match:
+                continue
+            error_path = tuple(match.group(1).split('.'))
+            for change in changes:
+                if error_path[:len(change.path)] == change.path:
+                    change.errors.append(error)
+                    break
+
+    def __len__(self):
+        return len(self.changes)
+
+    def __iter__(self):
+        return iter(self.changes)
+
+    def is_valid(self):
+        return not self.errors
+
+    def get_invalid_changes(self):
+        return [change for change in self.changes if change.errors]
+
+    def to_dict(self):
+        return {'changes': [change.to_dict() for change in self.changes],
+                'errors':  self.errors}
+
+    def format(self):
+        """ Returns the diff as lines of text, one per change and error.
+        """
+        lines = []
+        for change in self.changes:
+            if change.kind == 'added':
+                lines.append('+ %s: %r  (%s)' % (change.key, change.new, change.new_source))
+            elif change.kind == 'removed':
+                lines.append('- %s: %r  (%s)' % (change.key, change.old, change.old_source))
+            else:
+                lines.append('~ %s: %r -> %r  (%s -> %s)' % (change.key, change.old, change.new,
+                                                            change.old_source, change.new_source))
+            for error in change.errors:
+                lines.append('    ! %s' % error)
+        for error in self.errors:
+            if not any(error in change.errors for change in self.changes):
+                lines.append('! %s' % error)
+        return lines
+
+
+
+def _diff_config(old_config, new_config, path, changes):
+    """ Appends (path, kind, old value, new value) for every difference
+        between the two dicts to changes.  Equal sections are skipped with a
+        single comparison - so only the changed parts of a large config are
+        walked.  Keys are compared in sorted order where possible.
+    """
+    keys = set(old_config) | set(new_config)
+    try:
+        keys = sorted(keys)
+    except TypeError:
+        keys = list(keys)
+    for key in keys:
+        key_path = path + (str(key),)
+        if key not in new_config:
+            changes.append((key_path, 'removed', old_config[key], None))
+        elif key not in old_config:
+            changes.append((key_path, 'added', None, new_config[key]))
+        else:
+            old_val, new_val = old_config[key], new_config[key]
+            if old_val is new_val or old_val == new_val:
+                continue
+            if isinstance(old_val, dict) and isinstance(new_val, dict):
+                _diff_config(old_val, new_val, key_path, changes)
+            else:
+                changes.append((key_path, 'changed', old_val, new_val))
+
+
+
+def _get_source(version, path):
+    """ Returns the name of the layer that provided the value at path (a
+        sequence of keys) - or None if there is no such value.
+    """
+    try:
+        _get_path(version.cm_config, path)
+    except (KeyError, TypeError):
+        return None
+    path = list(path)
+    while path:
+        source = version.sources.get('.'.join(path))
+        if source is not None:
+            return source
+        path.pop()
+    return None
+
+
+# extracts the field from compiled checker & validictory error messages:
+_ERROR_FIELD = re.compile(r"field '([^']*)'")
+
+
+
+class ConfigVersion(object):
+    """ One immutable version of the consolidated config: the layers it was
+        merged from, the frozen config and the sources of its keys.
+    """
+
+    __slots__ = ('layers', 'cm_config', 'sources')
+
+    def __init__(self, layers, config, sources):
+        self.layers    = layers
+        self.cm_config = config
+        self.sources   = sources
+
+
+
+def _read_only(self, *args, **kwargs):
+    raise TypeError('config is read-only')
+
+
+
+class FrozenDict(dict):
+    """ A dict that can't be modified - but is still a dict for validictory,
+        json, comparisons, etc.
+
+        Its items can also be read as attributes, ex: config.db.pool.size.
+        They're bound into the instance's __dict__ once, when it's created,
+        so an attribute read costs no more than any other - for a second
+        table of references to the items.  Keys that clash
+        with dict attributes (ex: 'items') or aren't strings are only
+        available through [].
+    """
+
+    __setitem__ = __delitem__ = clear = pop = popitem = setdefault = update = _read_only
+    __setattr__ = __delattr__ = __ior__ = _read_only
+
+    def __init__(self, *args, **kwargs):
+        dict.__init__(self, *args, **kwargs)
+        attrs = self.__dict__
+        for key, val in dict.items(self):
+            if isinstance(key, string_types) and key not in _DICT_ATTRS:
+                attrs[key] = val
+
+    def __getattr__(self, name):
+        # only called for names that aren't items:
+        raise AttributeError("config section has no item '%s'" % name)
+
+    def __reduce__(self):
+        return (FrozenDict, (dict(self),))
+
+
+_DICT_ATTRS = frozenset(dir(FrozenDict))
+
+
+
+class FrozenList(list):
+    """ A list that can't be modified.
+    """
+
+    __slots__ = ()
+    __setitem__ = __delitem__ = __iadd__ = __imul__ = _read_only
+    append = extend = insert = pop = remove = reverse = sort = clear = _read_only
+
+    def __reduce__(self):
+        return (FrozenList, (list(self),))
+
+
+
+def _freeze(val):
+    """ Returns a read-only copy of val - already frozen dicts and lists are
+        shared rather than copied.
+    """
+    if isinstance(val, dict):
+        if type(val) is FrozenDict:
+            return val
+        return FrozenDict((key, _freeze(sub_val)) for key, sub_val in val.items())
+    elif isinstance(val, (list, tuple)):
+        if type(val) is FrozenList:
+            return val
+        return FrozenList(_freeze(item) for item in val)
+    return val
+
+
+
+# frozen config dumps as plain yaml mappings & sequences, ex: through
+# yaml.safe_dump(config_man.cm_config):
+for _dumper in (yaml.SafeDumper, yaml.Dumper,
+                getattr(yaml, 'CSafeDumper', None), getattr(yaml, 'CDumper', None)):
+    if _dumper is not None:
+        _dumper.add_representer(FrozenDict, yaml.representer.SafeRepresenter.represent_dict)
+        _dumper.add_representer(FrozenList, yaml.representer.SafeRepresenter.represent_list)
+
+
+
+def _get_layer_fqfn(layer):
+    if layer.source == 'file' and layer.name.startswith('file:'):
+        return layer.name[len('file:'):]
+    return None
+
+
+
+class ConfigLayer(object):
+    """ One source of config items, ex: a file or the environment.  data is
+        as it was added, frozen is a read-only copy made once - that every
+        version merged from the layer shares.
+    """
+
+    __slots__ = ('name', 'source', 'priority', 'seq', 'data', 'frozen')
+
+    def __init__(self, name, source, priority, seq, data):
+        self.name     = name
+        self.source   = source
+        self.priority = priority
+        self.seq      = seq
+        self.data     = data
+        self.frozen   = _freeze(data)
+
+    def __repr__(self):
+        return 'ConfigLayer(%r, priority=%r)' % (self.name, self.priority)
+
+
+
+def _merge_version(layers, deep=True):
+    """ Returns a ConfigVersion merged from layers.  It only copies the
+        sections that had to be merged - the rest are the layers' own frozen
+        data.
+    """
+    config, sources = _merge_layers(layers, deep)
+    return ConfigVersion(layers, _freeze(config), sources)
+
+
+
+def _merge_layers(layers, deep=True):
+    """ Returns a tuple of (merged config, {dotted path: layer name}).
+        Layers must be in ascending priority.  Higher priority layers override
+        lower ones - except that a None never overrides a value.
+
+        With deep merging, dicts found at the same path in multiple layers
+        are merged recursively.  Dicts are only copied when they have to be
+        merged, otherwise the merged config references the layer's data.
+        The sources of nested keys are only recorded where they differ from
+        their parent's source.
+    """
+    config  = {}
+    sources = {}
+    owned   = set()     # ids of the dicts created by the merge
+    for layer in layers:
+        _merge_dict(config, layer.frozen, layer.name, sources, owned, '', deep)
+    return config, sources
+
+
+def _merge_dict(target, data, name, sources, owned, prefix, deep):
+    for key, val in data.items():
+        # top-level keys are their own paths - rather than a copy per version:
+        if prefix or not isinstance(key, string_types):
+            path = '%s%s' % (prefix, key)
+        else:
+            path = key
+        if val is None:
+            if key not in target:
+                target[key]   = None
+                sources[path] = name
+            continue
+        old_val = target.get(key)
+        if deep and isinstance(val, dict) and isinstance(old_val, dict):
+            if id(old_val) not in owned:
+                # copy-on-write - the lower layer's keys keep their source:
+                parent_source = sources[path]
+                for sub_key in old_val:
+                    sources.setdefault('%s.%s' % (path, sub_key), parent_source)
+                old_val = target[key] = dict(old_val)
+                owned.add(id(old_val))
+            _merge_dict(old_val, val, name, sources, owned, path + '.', deep)
+            sources[path] = name
+        else:
+            if isinstance(old_val, dict):
+                _forget_sources(sources, path, old_val)
+            target[key]   = val
+            sources[path] = name
+
+
+def _forget_sources(sources, path, old_val):
+    """ Removes the sources of a nested dict that has been replaced.
+    """
+    for sub_key, sub_val in old_val.items():
+        sub_path = '%s.%s' % (path, sub_key)
+        sources.pop(sub_path, None)
+        if isinstance(sub_val, dict):
+            _forget_sources(sources, sub_path, sub_val)
+
+
+def _walk_schema_properties(schema, path=()):
+    """ Yields (path, schema) for every property within the schema -
+        recursing into nested object properties.  Only leaf properties and
+        properties without nested properties are yielded.
+    """
+    properties = schema.get('properties') if isinstance(schema, dict) else None
+    if not isinstance(properties, dict):
+        return
+    for key, prop_schema in properties.items():
+        sub_path = path + (key,)
+        if isinstance(prop_schema, dict) and isinstance(prop_schema.get('properties'), dict):
+            for item in _walk_schema_properties(prop_schema, sub_path):
+                yield item
+        else:
+            yield sub_path, prop_schema
+
+
+
+_TRUE_STRINGS  = frozenset(['true', 'yes', 'y', 'on', '1'])
+_FALSE_STRINGS = frozenset(['false', 'no', 'n', 'off', '0'])
+
+
+def _coerce_env_value(val, prop_schema, array_delimiter=','):
+    """ Converts an environmental variable string to the type required by
+        the schema.  Returns the original string if that's not possible.
+    """
+    if not isinstance(prop_schema, dict) or 'type' not in prop_schema:
+        return val
+    types = prop_schema['type']
+    if not isinstance(types, (list, tuple)):
+        types = [types]
+    # a string is always acceptable so try it last:
+    for one_type in sorted(types, key=lambda one_type: one_type == 'string'):
+        try:
+            return _coerce_one(val, one_type, prop_schema, array_delimiter)
+        except (ValueError, TypeError):
+            continue
+    return val
+
+
+def _coerce_one(val, one_type, prop_schema, array_delimiter):
+    """ Converts val to one_type or raises ValueError.
+    """
+    if one_type in ('string', 'any'):
+        return val
+    elif one_type == 'integer':
+        return int(val.strip())
+    elif one_type == 'number':
+        try:
+            return int(val.strip())
+        except ValueError:
+            return float(val.strip())
+    elif one_type == 'boolean':
+        lower_val = val.strip().lower()
+        if lower_val in _TRUE_STRINGS:
+            return True
+        elif lower_val in _FALSE_STRINGS:
+            return False
+    elif one_type == 'null':
+        if val.strip().lower() in ('', 'null', 'none'):
+            return None
+    elif one_type == 'array':
+        items = [item.strip() for item in val.split(array_delimiter)] if val.strip() else []
+        item_schema = prop_schema.get('items')
+        if isinstance(item_schema, dict):
+            items = [_coerce_env_value(item, item_schema, array_delimiter) for item in items]
+        return items
+    raise ValueError('cannot convert %r to %s' % (val, one_type))
+
+
+
+def _get_path(config, path):
+    """ Returns the value at the sequence of keys in path.
+        Raises KeyError or TypeError if the path doesn't exist.
+    """
+    val = config
+    for key in path:
+        val = val[key]
+    return val
+
+
+
+def _get_stat_signature(fqfn):
+    """ Returns a tuple that changes whenever the file is modified or
+        replaced, or None if the file doesn't exist.
+    """
+    try:
+        stat = os.stat(fqfn)
+    except OSError:
+        return None
+    return (stat.st_mtime, stat.st_size, stat.st_ino)
+
+
+
+def _get_changes(old_config, new_config):
+    """ Returns a dict of key: (old value, new value) for every key whose
+        value differs between the two configs.
+    """
+    changes = {}
+    for key in set(old_config) | set(new_config):
+        old_val = old_config.get(key)
+        new_val = new_config.get(key)
+        if old_val != new_val or (key in old_config) != (key in new_config):
+            changes[key] = (old_val, new_val)
+    return changes
+
+
+
+#------------------------------------------------------------------------------
+# Parsed config caching
+#------------------------------------------------------------------------------
+
+def _parse_yaml(raw):
+    return yaml.load(raw, Loader=YamlLoader)
+
+
+
+class ParseCache(object):
+    """ Caches parsed yaml files so that unchanged files are not re-parsed.
+
+        Each file is kept in memory as a pickle, keyed by path and validated
+        by mtime + size.  If those have changed the file is read and hashed -
+        and only parsed if the hash differs too.  Optionally the pickle is
+        also written to a cache file next to the config file, named
+        .<config_fn>.cache, so that later processes can skip parsing as well.
+        Disk cache files are trusted to the same degree as the config dir.
+
+        Every load returns a new copy of the parsed data, so callers are free
+        to modify it.
+    """
+
+    magic = b'cletus-parse-cache-1\n'
+
+    def __init__(self, log_name='__main__'):
+        self.logger  = logging.getLogger('%s.cletus_config' % log_name)
+        self.entries = {}   # fqfn: (mtime, size, digest, pickled)
+        self.lock    = threading.Lock()
+
+
+    def load(self, fqfn, disk_cache=False):
+        """ Returns the parsed contents of the yaml file fqfn.
+            Raises IOError/OSError if the file cannot be read.
+        """
+        return self.load_many([fqfn], disk_cache)[0]
+
+
+    def load_many(self, fqfns, disk_cache=False, processes=None,
+                  parallel_min_bytes=PARALLEL_MIN_BYTES, executor=None):
+        """ Returns the parsed contents of each of the yaml files, in order.
+
+            Files that are unchanged since they were cached are returned
+            from the cache.  The others are read, hashed and parsed by
+            executor.map() if given, or by a new pool of processes if they
+            total parallel_min_bytes or more - since yaml parsing holds the
+            GIL threads wouldn't help.  Otherwise, or if parallel_min_bytes
+            is None, they're parsed within this process.
+            Raises IOError/OSError if a file cannot be read.
+        """
+        results = [None] * len(fqfns)
+        misses  = []
+        miss_bytes = 0
+        for i, fqfn in enumerate(fqfns):
+            stat  = os.stat(fqfn)
+            with self.lock:
+                entry = self.entries.get(fqfn)
+            if entry and entry[0] == stat.st_mtime and entry[1] == stat.st_size:
+                results[i] = entry[3]
+            else:
+                misses.append((i, (fqfn, entry and entry[2], disk_cache)))
+                miss_bytes += stat.st_size
+
+        miss_args = [args for i, args in misses]
+        if len(misses) < 2:
+            new_entries = [_load_entry(args) for args in miss_args]
+        elif executor is not None:
+            new_entries = list(executor.map(_load_entry, miss_args))
+        elif parallel_min_bytes is not None and miss_bytes >= parallel_min_bytes:
+            new_entries = _map_in_processes(_load_entry, miss_args, processes)
+        else:
+            new_entries = [_load_entry(args) for args in miss_args]
+
+        for (i, (fqfn, old_digest, _)), new_entry in zip(misses, new_entries):
+            if new_entry[3] is None:     # contents unchanged - just touched
+                with self.lock:
+                    new_entry = new_entry[:3] + (self.entries[fqfn][3],)
+            with self.lock:
+                self.entries[fqfn] = new_entry
+            results[i] = new_entry[3]
+        return [pickle.loads(pickled) for pickled in results]
+
+
+    def _load_file(self, fqfn, old_digest, disk_cache):
+        """ Reads fqfn and returns a new cache entry for it.  If its hash
+            matches old_digest the pickle is left as None.
+        """
+        stat  = os.stat(fqfn)
+        with open(fqfn, 'rb') as f:
+            raw = f.read()
+        digest = hashlib.sha1(raw).hexdigest().encode('ascii')
+
+        if digest == old_digest:
+            pickled = None
+        else:
+            pickled = disk_cache and self._read_disk_cache(fqfn, digest)
+            if not pickled:
+                pickled = pickle.dumps(_parse_yaml(raw), pickle.HIGHEST_PROTOCOL)
+                if disk_cache:
+                    self._write_disk_cache(fqfn, digest, pickled)
+        return (stat.st_mtime, stat.st_size, digest, pickled)
+
+
+    def clear(self):
+        with self.lock:
+            self.entries = {}
+
+
+    def get_disk_cache_fqfn(self, fqfn):
+        config_dir, config_fn = os.path.split(fqfn)
+        return os.path.join(config_dir, '.%s.cache' % config_fn)
+
+
+    def _read_disk_cache(self, fqfn, digest):
+        """ Returns the cached pickle if it was built from a file with the
+            given digest, otherwise None.
+        """
+        try:
+            with open(self.get_disk_cache_fqfn(fqfn), 'rb') as f:
+                header = f.read(len(self.magic) + len(digest))
+                if header != self.magic + digest:
+                    return None
+                return f.read()
+        except (IOError, OSError) as e:
+            if e.errno != errno.ENOENT:
+                self.logger.debug('parse cache read failed: %s' % e)
+            return None
+
+
+    def _write_disk_cache(self, fqfn, digest, pickled):
+        """ Writes the cache atomically.  Failures - ex: a read-only config
+            dir - only cost the next process a parse, so are just logged.
+        """
+        cache_fqfn = self.get_disk_cache_fqfn(fqfn)
+        try:
+            fd, temp_fqfn = tempfile.mkstemp(dir=os.path.dirname(cache_fqfn),
+                                             prefix='.tmp_cache_')
+            try:
+                with os.fdopen(fd, 'wb') as f:
+                    f.write(self.magic + digest + pickled)
+                os.rename(temp_fqfn, cache_fqfn)
+            except Exception:
+                os.remove(temp_fqfn)
+                raise
+        except (IOError, OSError) as e:
+            self.logger.debug('parse cache write failed: %s' % e)
+
+
+# shared by all ConfigManagers within the process:
+parse_cache = ParseCache()
+
+
+
+def _load_entry(args):
+    """ Pool-friendly wrapper around ParseCache._load_file.
+    """
+    return parse_cache._load_file(*args)
+
+
+
+def _map_in_processes(func, arg_list, processes=None):
+    """ Returns map(func, arg_list) run across a pool of processes - or within
+        this process if a pool can't be created, ex: on platforms without
+        working semaphores.
+    """
+    try:
+        pool = multiprocessing.Pool(processes)
+    except (OSError, ImportError, NotImplementedError):
+        return [func(args) for args in arg_list]
+    try:
+        return pool.map(func, arg_list)
+    finally:
+        pool.close()
+        pool.join()
+
+
+
+#------------------------------------------------------------------------------
+# Schema compilation
+#------------------------------------------------------------------------------
+
+class _Uncompilable(Exception):
+    """ Raised for schema features that compile_schema leaves to validictory.
+    """
+    pass
+
+
+# validictory keywords that only affect other keywords or are informational:
+_PASSIVE_KEYWORDS  = ('required', 'blank', 'default', 'exclusiveMinimum',
+                      'exclusiveMaximum')
+
+# validictory keywords that compile_schema doesn't support:
+_FALLBACK_KEYWORDS = ('format', 'disallow', 'additionalItems')
+
+_TYPE_CHECKS = {'string':  lambda v: isinstance(v, string_types),
+                'integer': lambda v: type(v) in integer_types,
+                'number':  lambda v: type(v) in integer_types + (float, Decimal),
+                'boolean': lambda v: type(v) is bool,
+                'object':  lambda v: isinstance(v, dict) or (hasattr(v, 'keys')
+                                                             and hasattr(v, 'items')),
+                'array':   lambda v: isinstance(v, (list, tuple)),
+                'null':    lambda v: v is None,
+                'any':     lambda v: True}
+
+
+def compile_schema(schema):
+    """ Compiles a validictory schema into a checker function.
+
+        The checker takes the data to validate and returns a list of error
+        messages - empty if the data is valid.  Unlike validictory.validate
+        it reports every error in one pass rather than stopping at the first.
+
+        The same defaults as validictory apply: properties are required
+        unless 'required' is False, and strings cannot be blank unless 'blank'
+        is True.  Schemas that use features not compiled here (format,
+        disallow, additionalItems, dict types, callable enums, dict
+        dependencies) get a checker that runs validictory in its
+        collect-all-errors mode instead.
+
+        Raises:
+            validictory.SchemaError - if the schema is invalid
+    """
+    try:
+        check, deps = _compile_node(schema)
+        if deps:
+            raise _Uncompilable('top-level dependencies')
+    except _Uncompilable:
+        return _validictory_checker(schema)
+
+    def checker(data):
+        errors = []
+        check(data, '', errors)
+        return errors
+    return checker
+
+
+def _validictory_checker(schema):
+    def checker(data):
+        validator = valid.SchemaValidator(fail_fast=False)
+        try:
+            validator.validate(data, schema)
+        except valid.MultipleValidationError as e:
+            return [str(err) for err in e.errors]
+        except valid.SchemaError:
+            raise
+        except valid.ValidationError as e:
+            return [str(e)]
+        return []
+    return checker
+
+
+def _error(errors, path, value, msg):
+    errors.append("Value %r for field '%s' %s" % (value, path or '<config>', msg))
+
+
+def _join_path(path, name):
+    return '%s.%s' % (path, name) if path else name
+
+
+def _compile_node(schema):
+    """ Returns a tuple of:
+            - a function(value, path, errors) that validates a value that
+              exists against the schema, appending any errors
+            - a list of dependencies - which have to be checked against the
+              dict containing the value.
+    """
+    if schema is None:
+        return _noop, []
+    if not isinstance(schema, dict):
+        raise valid.SchemaError("Type for field must be 'dict', got: '%s'"
+                                % type(schema).__name__)
+    for keyword in _FALLBACK_KEYWORDS:
+        if keyword in schema:
+            raise _Uncompilable(keyword)
+
+    checks = []
+    deps   = []
+    blank  = schema.get('blank', False)
+
+    for keyword, arg in schema.items():
+        if keyword in _PASSIVE_KEYWORDS:
+            continue
+        elif keyword in ('title', 'description'):
+            if not isinstance(arg, string_types + (type(None),)):
+                raise valid.SchemaError('The %s must be a string' % keyword)
+        elif keyword == 'type':
+            checks.append(_compile_type(arg))
+        elif keyword == 'properties':
+            checks.append(_compile_properties(arg))
+        elif keyword == 'patternProperties':
+            checks.append(_compile_pattern_properties(arg))
+        elif keyword == 'additionalProperties':
+            check = _compile_additional_properties(schema, arg)
+            if check:
+                checks.append(check)
+        elif keyword == 'items':
+            checks.append(_compile_items(arg))
+        elif keyword == 'enum':
+            checks.append(_compile_enum(arg, blank))
+        elif keyword == 'dependencies':
+            if isinstance(arg, string_types):
+                deps = [arg]
+            elif isinstance(arg, (list, tuple)):
+                deps = list(arg)
+            else:
+                raise _Uncompilable('dependencies')
+        elif keyword in _SIMPLE_COMPILERS:
+            checks.append(_SIMPLE_COMPILERS[keyword](schema, arg))
+
+    if not blank:
+        checks.append(_check_blank)
+
+    if not checks:
+        return _noop, deps
+    elif len(checks) == 1:
+        return checks[0], deps
+
+    def check(value, path, errors):
+        for one_check in checks:
+            one_check(value, path, errors)
+    return check, deps
+
+
+def _noop(value, path, errors):
+    pass
+
+
+def _check_blank(value, path, errors):
+    if isinstance(value, string_types) and not value:
+        _error(errors, path, value, 'cannot be blank')
+
+
+def _compile_type(fieldtype):
+    if isinstance(fieldtype, (list, tuple)):
+        if any(isinstance(one_type, dict) for one_type in fieldtype):
+            raise _Uncompilable('dict type')
+        type_checks = [_get_type_check(one_type) for one_type in fieldtype]
+    elif isinstance(fieldtype, dict):
+        raise _Uncompilable('dict type')
+    else:
+        type_checks = [_get_type_check(fieldtype)]
+
+    def check_type(value, path, errors):
+        for type_check in type_checks:
+            if type_check(value):
+                return
+        _error(errors, path, value, 'is not of type %s' % (fieldtype,))
+    return check_type
+
+
+def _get_type_check(fieldtype):
+    try:
+        return _TYPE_CHECKS[fieldtype]
+    except (KeyError, TypeError):
+        raise valid.SchemaError("Field type '%s' is not supported." % (fieldtype,))
+
+
+def _compile_properties(properties):
+    if not isinstance(properties, dict):
+        raise valid.SchemaError('Properties definition is not an object')
+    compiled = []
+    for name, sub_schema in properties.items():
+        check, deps = _compile_node(sub_schema)
+        required    = (sub_schema or {}).get('required', True)
+        compiled.append((name, required, check, deps))
+
+    def check_properties(value, path, errors):
+        if not isinstance(value, dict):
+            return
+        for name, required, check, deps in compiled:
+            if name in value:
+                sub_value = value[name]
+                sub_path  = _join_path(path, name)
+                check(sub_value, sub_path, errors)
+                if deps and sub_value is not None:
+                    for dep in deps:
+                        if dep not in value:
+                            _error(errors, sub_path, sub_value, "requires field '%s'" % dep)
+            elif required:
+                errors.append("Required field '%s' is missing" % _join_path(path, name))
+    return check_properties
+
+
+def _compile_pattern_properties(pattern_properties):
+    compiled = []
+    for pattern, sub_schema in pattern_properties.items():
+        check, deps = _compile_node(sub_schema)
+        if deps:
+            raise _Uncompilable('dependencies')
+        compiled.append((re.compile(pattern), check))
+
+    def check_pattern_properties(value, path, errors):
+        if not isinstance(value, dict):
+            return
+        for regex, check in compiled:
+            for key, sub_value in value.items():
+                if regex.match(key):
+                    check(sub_value, _join_path(path, key), errors)
+    return check_pattern_properties
+
+
+def _compile_additional_properties(schema, additional):
+    if additional is True:
+        return None
+    if not isinstance(additional, (dict, bool)):
+        raise valid.SchemaError('additionalProperties schema definition is not an object')
+    known    = set(schema.get('properties') or {})
+    patterns = [re.compile(p) for p in schema.get('patternProperties', {})]
+    if additional is False:
+        sub_check = None
+    else:
+        sub_check, deps = _compile_node(additional)
+        if deps:
+            raise _Uncompilable('dependencies')
+
+    def check_additional_properties(value, path, errors):
+        if not isinstance(value, dict):
+            return
+        for key in value:
+            if key in known or any(p.match(key) for p in patterns):
+                continue
+            if sub_check is None:
+                _error(errors, path, value,
+                       "contains additional property '%s' not defined by 'properties' "
+                       "or 'patternProperties' and additionalProperties is False" % key)
+            else:
+                sub_check(value[key], _join_path(path, key), errors)
+    return check_additional_properties
+
+
+def _compile_items(items):
+    if isinstance(items, dict):
+        item_check, deps = _compile_node(items)
+        if deps:
+            raise _Uncompilable('dependencies')
+
+        def check_items(value, path, errors):
+            if isinstance(value, (list, tuple)):
+                for index, item in enumerate(value):
+                    item_check(item, '%s[%d]' % (path, index), errors)
+        return check_items
+
+    elif isinstance(items, (list, tuple)):
+        item_checks = []
+        for item in items:
+            item_check, deps = _compile_node(item)
+            if deps:
+                raise _Uncompilable('dependencies')
+            item_checks.append(item_check)
+
+        def check_item_list(value, path, errors):
+            if not isinstance(value, (list, tuple)):
+                return
+            if len(value) != len(item_checks):
+                _error(errors, path, value, 'is not of same length as schema list')
+                return
+            for index, item_check in enumerate(item_checks):
+                item_check(value[index], '%s[%d]' % (path, index), errors)
+        return check_item_list
+
+    else:
+        raise valid.SchemaError('Items definition is not a list or an object')
+
+
+def _compile_enum(options, blank):
+    if callable(options):
+        raise _Uncompilable('callable enum')
+    try:
+        lookup = frozenset(options)
+    except TypeError:
+        lookup = options
+
+    def check_enum(value, path, errors):
+        if value is None:
+            return
+        try:
+            found = value in lookup
+        except TypeError:
+            found = value in options
+        if not found and not (value == '' and blank):
+            _error(errors, path, value, 'is not in the enumeration: %r' % (options,))
+    return check_enum
+
+
+def _is_number(value):
+    return type(value) in integer_types + (float, Decimal)
+
+
+def _compile_minimum(schema, minimum):
+    exclusive = schema.get('exclusiveMinimum', False)
+
+    def check_minimum(value, path, errors):
+        if _is_number(value) and (value <= minimum if exclusive else value < minimum):
+            _error(errors, path, value, 'is less than minimum value: %s' % minimum)
+    return check_minimum
+
+
+def _compile_maximum(schema, maximum):
+    exclusive = schema.get('exclusiveMaximum', False)
+
+    def check_maximum(value, path, errors):
+        if _is_number(value) and (value >= maximum if exclusive else value > maximum):
+            _error(errors, path, value, 'is greater than maximum value: %s' % maximum)
+    return check_maximum
+
+
+def _compile_min_length(schema, length):
+    def check_min_length(value, path, errors):
+        if isinstance(value, string_types + (list, tuple)) and len(value) < length:
+            _error(errors, path, value, 'must have length greater than or equal to %d' % length)
+    return check_min_length
+
+
+def _compile_max_length(schema, length):
+    def check_max_length(value, path, errors):
+        if isinstance(value, string_types + (list, tuple)) and len(value) > length:
+            _error(errors, path, value, 'must have length less than or equal to %d' % length)
+    return check_max_length
+
+
+def _compile_min_properties(schema, number):
+    def check_min_properties(value, path, errors):
+        if isinstance(value, dict) and len(value) < number:
+            _error(errors, path, value,
+                   'must have number of properties greater than or equal to %d' % number)
+    return check_min_properties
+
+
+def _compile_max_properties(schema, number):
+    def check_max_properties(value, path, errors):
+        if isinstance(value, dict) and len(value) > number:
+            _error(errors, path, value,
+                   'must have number of properties less than or equal to %d' % number)
+    return check_max_properties
+
+
+def _compile_pattern(schema, pattern):
+    regex = re.compile(pattern) if isinstance(pattern, string_types) else pattern
+
+    def check_pattern(value, path, errors):
+        if isinstance(value, string_types) and not regex.match(value):
+            _error(errors, path, value, "does not match regular expression '%s'" % regex.pattern)
+    return check_pattern
+
+
+def _compile_unique_items(schema, unique):
+    def check_unique_items(value, path, errors):
+        if not unique or not isinstance(value, (list, tuple)):
+            return
+        seen = []
+        for item in value:
+            if item in seen:
+                _error(errors, path, item, 'is not unique')
+            else:
+                seen.append(item)
+    return check_unique_items
+
+
+def _compile_divisible_by(schema, divisor):
+    if divisor == 0:
+        raise valid.SchemaError('divisibleBy can not be 0')
+
+    def check_divisible_by(value, path, errors):
+        if _is_number(value) and value % divisor != 0:
+            _error(errors, path, value, "is not divisible by '%s'" % divisor)
+    return check_divisible_by
+
 
+_SIMPLE_COMPILERS = {'minimum':       _compile_minimum,
+                     'maximum':       _compile_maximum,
+                     'minLength':     _compile_min_length,
+                     'maxLength':     _compile_max_length,
+                     'minItems':      _compile_min_length,
+                     'maxItems':      _compile_max_length,
+                     'minProperties': _compile_min_properties,
+                     'maxProperties': _compile_max_properties,
+                     'pattern':       _compile_pattern,
+                     'uniqueItems':   _compile_unique_items,
+                     'divisibleBy':   _compile_divisible_by}
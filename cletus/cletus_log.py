@@ -31,11 +31,95 @@ import sys
 import logging
 import logging.handlers
 import errno
+import atexit
+import threading
+import time
+import functools
+import cProfile
+import collections
+import socket
 
 import appdirs
 
+try:
+    _wall_clock = time.perf_counter
+    _cpu_clock  = time.process_time
+except AttributeError:          # python 2
+    _wall_clock = time.time
+    _cpu_clock  = time.clock
+
 
 class LogManager(object):
+    """ Sets up a logger with a consistent format, a rotating log file and
+        console output.
+
+    Typical Usage:
+        log_man = mod.LogManager(app_name=pgm_name, log_name=__name__)
+        logger  = log_man.logger
+        logger.info('starting now')
+
+    Inputs:
+        app_name (str)      - Used to look up the log directory based on xdg
+                              standards if log_dir is not provided.
+        log_dir (str)       - Directory to write log files into.
+        log_fn (str)        - Log file name.  Defaults to main.log.
+        log_name (str)      - Name of logger.  Defaults to __main__.
+        log_file_size (int) - Max bytes per log file before rotation.
+        log_count (int)     - Number of rotated log files to keep.
+        log_to_console (bool)
+        log_to_file (bool)
+        log_delimiter (str) - Separates fields within each record.
+        rate_limit (int)    - Max records per call site per rate_period.
+                              Defaults to None - no rate limiting.
+        rate_period (int)   - Seconds per rate limiting period.  Defaults to 60.
+        coalesce (bool)     - Replace consecutive identical records with a
+                              'previous message repeated N times' record.
+                              Defaults to False.
+        lazy (bool)         - Defer creating the log dir, files and handlers
+                              until the first record at or above the effective
+                              level is logged.  Useful for short jobs that may
+                              exit right away.  Defaults to False.
+        excepthook (bool)   - Install an excepthook that logs any uncaught
+                              exception then exits.  Defaults to True.
+        chain_excepthook (bool)
+                            - Have that excepthook also call the excepthook
+                              that was installed before it.  Defaults to False.
+        timing (bool)       - Turns on the timing spans of self.timer.
+                              Defaults to False - spans are then no-ops.
+        timing_interval (int)
+                            - Seconds between timing summaries written to the
+                              log.  Defaults to None - the summary is only
+                              written when the program exits.
+        timing_profiler (bool)
+                            - Also run cProfile while within any span of the
+                              thread that created the LogManager - see
+                              SpanTimer.  Defaults to False.
+        debug_buffer (int)  - Number of records below the level given to
+                              set_level() to keep in memory.  They're written
+                              to the log file only when an ERROR or CRITICAL
+                              record is logged, or on an uncaught exception.
+                              The buffer needs the logger itself kept at
+                              DEBUG, so use set_level() rather than
+                              logger.setLevel().  A level set directly on the
+                              logger is picked up as the next record arrives
+                              - but records below it are lost until then.
+                              Defaults to None - no buffer.
+        forward_to (str or tuple)
+                            - Send records to a local log collector instead
+                              of writing them to the log file.  Either the
+                              path of a unix datagram socket (ex: /dev/log)
+                              or a (host, port) tuple for udp.  If the
+                              collector is down records fall back to the log
+                              file.  Defaults to None - no forwarding.
+        forward_batch (int) - Max number of records per send.  Defaults to 50.
+        forward_interval (float)
+                            - Max seconds a record waits for its batch to be
+                              sent.  Defaults to 1.0.
+        syslog_facility (str or int)
+                            - If provided, each forwarded record gets a syslog
+                              priority prefix and is sent in its own datagram.
+                              Ex: 'user', 'local0'.  Defaults to None.
+    """
 
     def __init__(self,
                  app_name=None,
@@ -46,7 +130,21 @@ class LogManager(object):
                  log_count=10,
                  log_to_console=True,
                  log_to_file=True,
-                 log_delimiter=':'):
+                 log_delimiter=':',
+                 rate_limit=None,
+                 rate_period=60,
+                 coalesce=False,
+                 lazy=False,
+                 excepthook=True,
+                 chain_excepthook=False,
+                 timing=False,
+                 timing_interval=None,
+                 timing_profiler=False,
+                 debug_buffer=None,
+                 forward_to=None,
+                 forward_batch=50,
+                 forward_interval=1.0,
+                 syslog_facility=None):
 
         self.app_name       = app_name
         self.log_name       = log_name
@@ -58,21 +156,102 @@ class LogManager(object):
         self.log_count      = log_count
         self.log_file_size  = log_file_size
         self.log_delimiter  = log_delimiter
+        self.log_to_file    = log_to_file
+        self.log_to_console = log_to_console
+        self.forward_to     = forward_to
+        self.forward_batch  = forward_batch
+        self.forward_interval = forward_interval
+        self.syslog_facility  = syslog_facility
+        self.rate_filter    = None
+        self.handlers       = []
+        self.handler_level  = logging.NOTSET
+        self.debug_ring     = None
+        self.prior_excepthook = None
+        self.chain_excepthook = chain_excepthook
+
+        self._lazy_handler  = None
+        self._lazy_lock     = threading.Lock()
 
         self._create_log_formatter()
 
-        if log_to_file:
-            self._create_file_handler()
-
-        if log_to_console:
-            self._create_console_handler()
+        if rate_limit or coalesce:
+            self.rate_filter = RateLimitFilter(self.logger,
+                                               rate_limit=rate_limit,
+                                               rate_period=rate_period,
+                                               coalesce=coalesce)
+            atexit.register(self.rate_filter.flush)
+
+        self.timer = SpanTimer(self.logger,
+                               enabled=timing,
+                               summary_interval=timing_interval,
+                               profiler=timing_profiler)
+        if timing:
+            atexit.register(self.timer.log_summary)
+
+        if debug_buffer:
+            self.debug_ring = _DebugRingHandler(self, debug_buffer)
+            self.logger.addHandler(self.debug_ring)
+
+        if lazy:
+            self._lazy_handler = _LazyHandler(self)
+            self.logger.addHandler(self._lazy_handler)
+        else:
+            self._create_handlers()
 
         #logging from this class isn't working
         #self.logger_sub     = logging.getLogger('%s.cletus_log' % log_name)
         #self.logger.debug('logger started, written to: %s' % self.log_dir)
 
         # Ensure all crashes get logged:
-        sys.excepthook = self._excepthook
+        if excepthook:
+            self.prior_excepthook = sys.excepthook
+            sys.excepthook = self._excepthook
+
+
+
+    def set_level(self, level):
+        """ Sets the level of records written to the log.  Without a
+            debug_buffer this just sets the logger level.  With one, the logger
+            is set to DEBUG so that lower-level records still reach the ring
+            buffer, while the handlers are set to the given level.
+        """
+        if not isinstance(level, int):
+            level = logging.getLevelName(level.upper())
+        if self.debug_ring:
+            self.logger.setLevel(logging.DEBUG)
+            self.handler_level = level
+            for handler in self.handlers:
+                handler.setLevel(level)
+        else:
+            self.logger.setLevel(level)
+
+
+
+    def _create_handlers(self):
+        if self.forward_to:
+            self._create_forward_handler()
+        elif self.log_to_file:
+            self._create_file_handler()
+
+        if self.log_to_console:
+            self._create_console_handler()
+
+
+
+    def _activate(self):
+        """ Replaces the lazy placeholder handler with the real handlers.
+            Does nothing if that has already been done.
+
+            The logger's handler list is rebound rather than modified in place
+            since Logger.callHandlers may be iterating over it at the time.
+        """
+        with self._lazy_lock:
+            if self._lazy_handler is None:
+                return
+            self.logger.handlers = [h for h in self.logger.handlers
+                                    if h is not self._lazy_handler]
+            self._lazy_handler = None
+            self._create_handlers()
 
 
 
@@ -95,13 +274,43 @@ class LogManager(object):
         """ Adds a handler to send logs to the console (stdout).
         """
         console_handler = logging.StreamHandler()
-        console_handler.setFormatter(self.formatter)
-        self.logger.addHandler(console_handler)
+        self._add_handler(console_handler)
+
+
+
+    def _create_forward_handler(self):
+        """ Adds a handler to send logs to a local collector.  If logging to
+            files, the file handler is only created once the collector fails.
+        """
+        if self.log_to_file:
+            fallback = self._build_fallback_handler
+        else:
+            fallback = None
+        forward_handler = ForwardHandler(self.forward_to,
+                                         fallback=fallback,
+                                         batch_size=self.forward_batch,
+                                         flush_interval=self.forward_interval,
+                                         syslog_facility=self.syslog_facility)
+        self._add_handler(forward_handler)
+
+
+
+    def _build_fallback_handler(self):
+        file_handler = self._build_file_handler()
+        file_handler.setFormatter(self.formatter)
+        return file_handler
 
 
 
     def _create_file_handler(self):
-        """ Adds a handler to send logs to a file.  This is a rotating file handler,
+        """ Adds a handler to send logs to a file.
+        """
+        self._add_handler(self._build_file_handler())
+
+
+
+    def _build_file_handler(self):
+        """ Returns a handler to send logs to a file.  This is a rotating file handler,
             so when files reach log_file_size they will get renamed and have a numeric
             suffix added.
 
@@ -126,16 +335,623 @@ class LogManager(object):
         file_handler = logging.handlers.RotatingFileHandler(log_fqfn,
                                                             maxBytes=self.log_file_size,
                                                             backupCount=self.log_count)
-        file_handler.setFormatter(self.formatter)
-        self.logger.addHandler(file_handler)
+        return file_handler
+
+
+
+    def _add_handler(self, handler):
+        """ Formats and attaches a handler to the logger.  Any filters are
+            attached to the handler rather than the logger so that records
+            from child loggers (ex: <log_name>.cletus_job) are also filtered.
+        """
+        handler.setFormatter(self.formatter)
+        handler.setLevel(self.handler_level)
+        if self.rate_filter:
+            handler.addFilter(self.rate_filter)
+        self.logger.addHandler(handler)
+        self.handlers.append(handler)
 
 
 
     def _excepthook(self, *args):
         """ Capture uncaught exceptions, write details into logger, exit.
         """
+        if self.debug_ring:
+            self.debug_ring.dump()
         self.logger.critical('Uncaught exception - exiting now. ', exc_info=args)
+        if self.chain_excepthook and self.prior_excepthook:
+            self.prior_excepthook(*args)
         sys.exit(1)
 
 
 
+class _DebugRingHandler(logging.Handler):
+    """ Keeps the most recent records that are below the LogManager's
+        handler_level in a fixed-size deque.  Records are kept unformatted, so
+        the cost per record is just an append.  When an ERROR or CRITICAL
+        record arrives the buffer is written to the log file first, giving
+        the context leading up to the error.
+
+        Note that records keep references to their args, so mutable args will
+        be formatted with their values at dump time.
+    """
+
+    def __init__(self, log_manager, capacity, dump_level=logging.ERROR):
+        logging.Handler.__init__(self)
+        self.log_manager = log_manager
+        self.dump_level  = dump_level
+        self.buffer      = collections.deque(maxlen=capacity)
+
+    def emit(self, record):
+        logger = self.log_manager.logger
+        if logger.level != logging.DEBUG:
+            # set directly on the logger - which would starve the buffer:
+            self.log_manager.set_level(logger.getEffectiveLevel())
+        if record.levelno >= self.dump_level:
+            self.dump()
+        elif record.levelno < self.log_manager.handler_level:
+            self.buffer.append(record)
+
+    def dump(self):
+        """ Writes all buffered records to the file or forward handler - or
+            to every handler if there's neither, then empties the buffer.
+            The records are tagged so that a RateLimitFilter passes them
+            through as they are.
+        """
+        self.acquire()
+        try:
+            records = list(self.buffer)
+            self.buffer.clear()
+        finally:
+            self.release()
+        if not records:
+            return
+
+        self.log_manager._activate()
+        handlers = self.log_manager.handlers
+        targets  = ([h for h in handlers
+                     if isinstance(h, (logging.FileHandler, ForwardHandler))]
+                    or handlers)
+
+        header = self.log_manager.logger.makeRecord(
+            self.log_manager.logger.name, logging.DEBUG, __file__, 0,
+            'debug buffer - writing the prior %d records', (len(records),), None)
+        for record in [header] + records:
+            record.cletus_replayed = True
+        for target in targets:
+            for record in [header] + records:
+                target.handle(record)
+
+
+
+class ForwardHandler(logging.Handler):
+    """ Sends formatted records to a local log collector over a unix datagram
+        socket or udp.
+
+        Records are formatted as they arrive and batched.  A batch is sent
+        once it holds batch_size records, an ERROR or CRITICAL record arrives,
+        or its oldest record is flush_interval seconds old - a timer thread
+        handles that last case when no further records arrive.  Records within a
+        batch are newline-delimited and packed into as few datagrams as
+        max_datagram allows - unless syslog_facility is provided, in which
+        case each record gets a syslog priority prefix and its own datagram.
+
+        The socket is non-blocking so the caller is never held up by the
+        collector.  If a send fails the batch is written to the fallback
+        handler instead, and all records go there for the next retry_interval
+        seconds before the collector is tried again.
+
+        Inputs:
+            address (str or tuple) - unix socket path or (host, port).
+            fallback (callable)    - returns the handler to use when the
+                                     collector is down.  Only called on the
+                                     first failure.  Defaults to None - records
+                                     are dropped while the collector is down.
+            batch_size (int)       - defaults to 50.
+            flush_interval (float) - defaults to 1.0 seconds.
+            syslog_facility (str or int) - defaults to None.
+            max_datagram (int)     - defaults to 8192 bytes.
+            retry_interval (float) - defaults to 30 seconds.
+    """
+
+    syslog_severities = {logging.DEBUG:    7,
+                         logging.INFO:     6,
+                         logging.WARNING:  4,
+                         logging.ERROR:    3,
+                         logging.CRITICAL: 2}
+
+    def __init__(self,
+                 address,
+                 fallback=None,
+                 batch_size=50,
+                 flush_interval=1.0,
+                 syslog_facility=None,
+                 max_datagram=8192,
+                 retry_interval=30):
+
+        logging.Handler.__init__(self)
+        self.address          = address
+        self.fallback_factory = fallback
+        self.fallback         = None
+        self.batch_size       = batch_size
+        self.flush_interval   = flush_interval
+        self.max_datagram     = max_datagram
+        self.retry_interval   = retry_interval
+        if isinstance(syslog_facility, str):
+            syslog_facility   = logging.handlers.SysLogHandler.facility_names[syslog_facility]
+        self.syslog_facility  = syslog_facility
+
+        self.batch            = []      # (record, encoded msg)
+        self.batch_start      = None
+        self.down_until       = 0
+        self.sock             = None
+        self.timer            = None
+
+
+    def emit(self, record):
+        try:
+            msg = self.format(record)
+            if self.syslog_facility is not None:
+                msg = '<%d>%s' % (self.syslog_facility * 8
+                                  + self.syslog_severities.get(record.levelno, 7), msg)
+            msg = msg.encode('utf-8')
+        except Exception:
+            self.handleError(record)
+            return
+
+        if not self.batch:
+            self.batch_start = record.created
+            self._start_timer()
+        self.batch.append((record, msg))
+        if (len(self.batch) >= self.batch_size
+                or record.levelno >= logging.ERROR
+                or record.created - self.batch_start >= self.flush_interval):
+            self._send_batch()
+
+
+    def _start_timer(self):
+        """ Ensures a quiet program doesn't leave a batch waiting forever.
+        """
+        if self.timer is None or not self.timer.is_alive():
+            self.timer = threading.Timer(self.flush_interval, self.flush)
+            self.timer.daemon = True
+            self.timer.start()
+
+
+    def flush(self):
+        self.acquire()
+        try:
+            if self.batch:
+                self._send_batch()
+        finally:
+            self.release()
+
+
+    def close(self):
+        self.flush()
+        self.acquire()
+        try:
+            if self.timer:
+                self.timer.cancel()
+            if self.sock:
+                self.sock.close()
+                self.sock = None
+            if self.fallback:
+                self.fallback.close()
+        finally:
+            self.release()
+        logging.Handler.close(self)
+
+
+    def _send_batch(self):
+        batch      = self.batch
+        self.batch = []
+        sent       = 0
+        if time.time() >= self.down_until:
+            try:
+                for datagram, count in self._pack(batch):
+                    self._get_socket().send(datagram)
+                    sent += count
+                return
+            except (socket.error, OSError):
+                self.down_until = time.time() + self.retry_interval
+                if self.sock:
+                    self.sock.close()
+                    self.sock = None
+        self._write_fallback(batch[sent:])
+
+
+    def _pack(self, batch):
+        """ Yields tuples of (datagram, number of records within it).
+        """
+        if self.syslog_facility is not None:
+            for record, msg in batch:
+                yield msg[:self.max_datagram], 1
+            return
+        datagram = b''
+        count    = 0
+        for record, msg in batch:
+            msg = msg[:self.max_datagram]
+            if count and len(datagram) + 1 + len(msg) > self.max_datagram:
+                yield datagram, count
+                datagram = b''
+                count    = 0
+            datagram = datagram + b'\n' + msg if count else msg
+            count   += 1
+        if count:
+            yield datagram, count
+
+
+    def _get_socket(self):
+        if self.sock is None:
+            if isinstance(self.address, tuple):
+                sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+            else:
+                sock = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+            sock.setblocking(False)
+            try:
+                sock.connect(self.address)
+            except (socket.error, OSError):
+                sock.close()
+                raise
+            self.sock = sock
+        return self.sock
+
+
+    def _write_fallback(self, batch):
+        if self.fallback is None:
+            if self.fallback_factory is None:
+                return
+            self.fallback = self.fallback_factory()
+        for record, msg in batch:
+            self.fallback.handle(record)
+
+
+
+class _LazyHandler(logging.Handler):
+    """ Placeholder handler used by LogManager in lazy mode.  The logger
+        only passes it records at or above the effective level, so the first
+        record it receives triggers creation of the real handlers and is then
+        forwarded to them.
+    """
+
+    def __init__(self, log_manager):
+        logging.Handler.__init__(self)
+        self.log_manager = log_manager
+
+    def handle(self, record):
+        if record.levelno < self.log_manager.handler_level:
+            return True
+        self.log_manager._activate()
+        for handler in self.log_manager.handlers:
+            if record.levelno >= handler.level:
+                handler.handle(record)
+        return True
+
+    def emit(self, record):
+        pass
+
+
+
+class RateLimitFilter(logging.Filter):
+    """ Protects the logs from floods of records, typically from loops that
+        log on every iteration - like JobCheck.lock_pidfile waiting for a lock.
+
+        Two independent mechanisms are supported:
+           - coalescing: consecutive records with the same logger name, level,
+             msg and args are dropped and later replaced by a single
+             'previous message repeated N times' record.  This summary is
+             written as soon as a different record arrives, or at least once
+             every rate_period seconds while the repeats continue.
+           - rate limiting: each call site (source file + line number) may
+             write at most rate_limit records every rate_period seconds.  Once
+             the period rolls over a single 'N messages suppressed' record is
+             written.
+
+        Records that are not suppressed cost a dict lookup and a few
+        comparisons - they are never formatted.  The filter is intended to be
+        attached to every handler of a logger: a record seen a second time
+        (by the next handler) simply gets the decision made the first time.
+        Its own summaries and the records replayed from a debug_buffer pass
+        through without touching its state.
+
+        Inputs:
+            logger (Logger)    - used to write the summary records.
+            rate_limit (int)   - max records per call site per rate_period.
+                                 Defaults to None - no rate limiting.
+            rate_period (int)  - number of seconds in each rate limiting
+                                 period.  Defaults to 60.
+            coalesce (bool)    - turns on coalescing of repeated records.
+                                 Defaults to True.
+    """
+
+    def __init__(self,
+                 logger,
+                 rate_limit=None,
+                 rate_period=60,
+                 coalesce=True):
+
+        logging.Filter.__init__(self)
+        self.logger        = logger
+        self.rate_limit    = rate_limit
+        self.rate_period   = rate_period
+        self.coalesce      = coalesce
+
+        self._lock         = threading.Lock()
+        self._sites        = {}     # (pathname, lineno): [period_start, count, suppressed]
+        self._prior        = None   # last record allowed through
+        self._repeats      = 0
+        self._last_record  = None
+        self._last_result  = True
+
+
+    def filter(self, record):
+        if record is self._last_record:
+            return self._last_result
+        if getattr(record, 'cletus_summary', False) or getattr(record, 'cletus_replayed', False):
+            return True
+
+        summaries = []
+        with self._lock:
+            result = self._check(record, summaries)
+            self._last_record = record
+            self._last_result = result
+
+        for summary in summaries:
+            self.logger.handle(summary)
+        return result
+
+
+    def _check(self, record, summaries):
+        """ Returns True if the record should be written, False if it should
+            be suppressed.  Any summary records that need to be written
+            before this one are appended to summaries.
+        """
+        now = record.created
+
+        if self.coalesce:
+            prior = self._prior
+            if (prior is not None
+                    and record.msg == prior.msg
+                    and record.levelno == prior.levelno
+                    and record.name == prior.name
+                    and record.args == prior.args):
+                if now - prior.created < self.rate_period:
+                    self._repeats += 1
+                    return False
+            if self._repeats:
+                summaries.append(self._make_summary(prior,
+                                 'previous message repeated %d times' % self._repeats))
+                self._repeats = 0
+
+        if self.rate_limit is not None:
+            site  = (record.pathname, record.lineno)
+            state = self._sites.get(site)
+            if state is None or now - state[0] >= self.rate_period:
+                if state is not None and state[2]:
+                    summaries.append(self._make_site_summary(record, state[2]))
+                self._sites[site] = [now, 1, 0]
+            elif state[1] >= self.rate_limit:
+                state[2] += 1
+                return False
+            else:
+                state[1] += 1
+
+        if self.coalesce:
+            self._prior = record
+        return True
+
+
+    def flush(self):
+        """ Writes summaries for any records still being suppressed.  Should
+            be called before the program terminates - LogManager registers it
+            with atexit.
+        """
+        summaries = []
+        with self._lock:
+            if self._repeats:
+                summaries.append(self._make_summary(self._prior,
+                                 'previous message repeated %d times' % self._repeats))
+                self._repeats = 0
+            for (pathname, lineno), state in self._sites.items():
+                if state[2]:
+                    summaries.append(self._make_site_summary(self._site_record(pathname, lineno),
+                                                             state[2]))
+                    state[2] = 0
+        for summary in summaries:
+            self.logger.handle(summary)
+
+
+    def _make_site_summary(self, record, suppressed):
+        return self._make_summary(record,
+                                  '%d messages suppressed from %s:%d in the last %d seconds'
+                                  % (suppressed, os.path.basename(record.pathname),
+                                     record.lineno, self.rate_period))
+
+
+    def _site_record(self, pathname, lineno):
+        return self.logger.makeRecord(self.logger.name, logging.WARNING,
+                                      pathname, lineno, '', None, None)
+
+
+    def _make_summary(self, record, msg):
+        summary = self.logger.makeRecord(record.name, record.levelno,
+                                         record.pathname, record.lineno,
+                                         msg, None, None)
+        summary.cletus_summary = True
+        return summary
+
+
+
+class SpanTimer(object):
+    """ Lightweight timing of named sections of code.  Elapsed wall and cpu
+        time are aggregated in memory per span name, and a summary is written
+        to the logger every summary_interval seconds and on request.
+
+    Typical Usage:
+        timer = log_man.timer
+        with timer.span('load'):
+            load_files()
+
+        @timer.timed('transform')
+        def transform(rec):
+            ...
+
+        timer.log_summary()
+
+    Inputs:
+        logger (Logger)         - used to write the summaries.
+        enabled (bool)          - when False span() returns a shared no-op
+                                  context manager and timed() returns the
+                                  function undecorated, so the spans can stay
+                                  in production code.  Defaults to True.
+        summary_interval (int)  - seconds between summaries, checked as each
+                                  span ends.  Defaults to None - no periodic
+                                  summaries.
+        profiler (bool or cProfile.Profile)
+                                - if provided, the profiler is enabled while
+                                  within any span of the thread that created
+                                  the timer - cProfile only profiles the
+                                  thread that enables it, and python 3.12+
+                                  allows only one active profiler, so spans
+                                  in other threads are timed but not
+                                  profiled.  Its results are available
+                                  from self.profiler, ex:
+                                  timer.profiler.dump_stats(fqfn).
+                                  Defaults to None.
+    """
+
+    def __init__(self,
+                 logger,
+                 enabled=True,
+                 summary_interval=None,
+                 profiler=None):
+
+        self.logger           = logger
+        self.enabled          = enabled
+        self.summary_interval = summary_interval
+        if profiler is True:
+            self.profiler     = cProfile.Profile()
+        else:
+            self.profiler     = profiler or None
+
+        self.stats            = {}    # name: [count, wall_total, cpu_total, wall_max]
+        self._lock            = threading.Lock()
+        self._profile_depth   = 0     # only used by the _profile_thread
+        self._profile_thread  = threading.current_thread()
+        self._last_summary    = _wall_clock()
+
+
+    def span(self, name):
+        """ Returns a context manager that times the enclosed block.
+        """
+        if not self.enabled:
+            return _NULL_SPAN
+        return _Span(self, name)
+
+
+    def timed(self, name=None):
+        """ Returns a decorator that times every call of the function.  The
+            span name defaults to the function name.
+        """
+        def decorator(func):
+            if not self.enabled:
+                return func
+            span_name = name or func.__name__
+
+            @functools.wraps(func)
+            def wrapper(*args, **kwargs):
+                with _Span(self, span_name):
+                    return func(*args, **kwargs)
+            return wrapper
+        return decorator
+
+
+    def _start_profiler(self):
+        if threading.current_thread() is not self._profile_thread:
+            return
+        self._profile_depth += 1
+        if self._profile_depth == 1:
+            self.profiler.enable()
+
+
+    def _stop_profiler(self):
+        if threading.current_thread() is not self._profile_thread:
+            return
+        self._profile_depth -= 1
+        if self._profile_depth == 0:
+            self.profiler.disable()
+
+
+    def _record(self, name, wall, cpu):
+        with self._lock:
+            stat = self.stats.get(name)
+            if stat is None:
+                self.stats[name] = [1, wall, cpu, wall]
+            else:
+                stat[0] += 1
+                stat[1] += wall
+                stat[2] += cpu
+                if wall > stat[3]:
+                    stat[3] = wall
+            due = (self.summary_interval is not None
+                   and _wall_clock() - self._last_summary >= self.summary_interval)
+        if due:
+            self.log_summary()
+
+
+    def log_summary(self, level=logging.INFO):
+        """ Writes one record per span name, slowest first.
+        """
+        with self._lock:
+            self._last_summary = _wall_clock()
+            stats = sorted(self.stats.items(), key=lambda item: item[1][1], reverse=True)
+            stats = [(name, list(stat)) for name, stat in stats]
+        for name, (count, wall, cpu, wall_max) in stats:
+            self.logger.log(level,
+                            'timing: %s - count: %d, wall: %.3fs, cpu: %.3fs, avg: %.3fms, max: %.3fms',
+                            name, count, wall, cpu, wall / count * 1000, wall_max * 1000)
+
+
+    def reset(self):
+        with self._lock:
+            self.stats = {}
+
+
+
+class _Span(object):
+
+    __slots__ = ('timer', 'name', 'wall_start', 'cpu_start')
+
+    def __init__(self, timer, name):
+        self.timer = timer
+        self.name  = name
+
+    def __enter__(self):
+        if self.timer.profiler is not None:
+            self.timer._start_profiler()
+        self.wall_start = _wall_clock()
+        self.cpu_start  = _cpu_clock()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        wall = _wall_clock() - self.wall_start
+        cpu  = _cpu_clock() - self.cpu_start
+        if self.timer.profiler is not None:
+            self.timer._stop_profiler()
+        self.timer._record(self.name, wall, cpu)
+        return False
+
+
+
+class _NullSpan(object):
+
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        return False
+
+_NULL_SPAN = _NullSpan()
@@ -0,0 +1,695 @@
+#!/usr/bin/env python
+""" Used for testing the cletus_archiver script.
+
+    See the file "LICENSE" for the full license governing use of this file.
+    Copyright 2013, 2014, 2015, 2016 Ken Farmer
+"""
+from __future__ import absolute_import
+from __future__ import print_function
+
+
+
+# IMPORTS -----------------------------------------------------------------
+import sys
+import os
+import stat
+import time
+import gzip
+import io
+import logging
+import json
+import tarfile
+import tempfile
+import shutil
+import subprocess
+import pytest
+import argparse
+import yaml
+from pprint import pprint as pp
+from os.path import dirname, join, exists
+
+sys.path.insert(0, join(dirname(dirname(dirname(os.path.abspath(__file__)))), 'scripts'))
+import cletus_archiver as mod
+
+mod.logger = logging.getLogger('test_cletus_archiver')
+
+
+
+def write_file(fqfn, content, mtime=None):
+    with open(fqfn, 'wb') as f:
+        f.write(content)
+    if mtime:
+        os.utime(fqfn, (mtime, mtime))
+    return fqfn
+
+
+
+def get_config(temp_dir, file_config, **kwargs):
+    """ Writes file_config to a config file within temp_dir and returns the
+        script's config for it.  kwargs are added to the command line args.
+    """
+    config_fqfn = join(temp_dir, 'main.yml')
+    with open(config_fqfn, 'w') as f:
+        f.write(yaml.dump(file_config, default_flow_style=False))
+    args = argparse.Namespace(config_fqfn=config_fqfn, log_level=None,
+                              log_to_console=False, recursive=None, max_files=None,
+                              compress_workers=None, compress_processes=None)
+    vars(args).update(kwargs)
+    return mod.setup_config(args)
+
+
+
+class TestFileCompressor(object):
+
+    def setup_method(self, method):
+        self.temp_dir = tempfile.mkdtemp()
+
+    def teardown_method(self, method):
+        shutil.rmtree(self.temp_dir)
+
+    def test_compress(self):
+        fqfn = write_file(join(self.temp_dir, 'a.log'), b'hello world\n' * 1000, mtime=1000000)
+        os.chmod(fqfn, 0o640)
+        compressor = mod.FileCompressor()
+        fn, in_bytes, out_bytes, error = compressor.compress(fqfn)
+        assert error is None
+        assert in_bytes == 12000
+        assert not exists(fqfn)
+        assert os.path.getsize(fqfn + '.gz') == out_bytes
+        assert stat.S_IMODE(os.stat(fqfn + '.gz').st_mode) == 0o640
+        assert os.path.getmtime(fqfn + '.gz') == 1000000
+        with gzip.open(fqfn + '.gz', 'rb') as f:
+            assert f.read() == b'hello world\n' * 1000
+        assert os.listdir(self.temp_dir) == ['a.log.gz']
+
+    def test_failure_leaves_no_temp_files(self):
+        compressor = mod.FileCompressor()
+        fn, in_bytes, out_bytes, error = compressor.compress(join(self.temp_dir, 'missing.log'))
+        assert error
+        assert compressor.error_count == 1
+        assert os.listdir(self.temp_dir) == []
+
+    def test_existing_compressed_file_is_not_overwritten(self):
+        fqfn = write_file(join(self.temp_dir, 'a.log'), b'new\n' * 100)
+        write_file(fqfn + '.gz', b'old archive', mtime=1000000)
+        compressor = mod.FileCompressor()
+        fn, in_bytes, out_bytes, error = compressor.compress(fqfn)
+        assert 'already exists' in error
+        assert compressor.error_count == 1
+        with open(fqfn + '.gz', 'rb') as f:
+            assert f.read() == b'old archive'
+        assert os.path.getmtime(fqfn + '.gz') == 1000000
+        assert sorted(os.listdir(self.temp_dir)) == ['a.log', 'a.log.gz']
+
+    @pytest.mark.parametrize('use_processes', [False, True])
+    def test_compress_all(self, use_processes):
+        fqfns = [write_file(join(self.temp_dir, '%d.log' % i), os.urandom(1000) * 50)
+                 for i in range(10)]
+        compressor = mod.FileCompressor(workers=3, use_processes=use_processes,
+                                        chunk_size=4096)
+        results = list(compressor.compress_all(iter(fqfns)))
+        assert sorted(result[0] for result in results) == sorted(fqfns)
+        assert all(result[3] is None for result in results)
+        assert compressor.file_count == 10
+        assert compressor.bytes_in == 500000
+        assert compressor.get_throughput() > 0
+        assert sorted(os.listdir(self.temp_dir)) == sorted('%d.log.gz' % i for i in range(10))
+
+
+
+class TestFileScanner(object):
+
+    def setup_method(self, method):
+        self.temp_dir = tempfile.mkdtemp()
+        old = time.time() - 86400 * 10
+        write_file(join(self.temp_dir, 'old.log'), b'x', mtime=old)
+        write_file(join(self.temp_dir, 'old.csv'), b'x' * 100, mtime=old)
+        write_file(join(self.temp_dir, 'old.log.gz'), b'x', mtime=old)
+        write_file(join(self.temp_dir, 'new.log'), b'x')
+        os.mkdir(join(self.temp_dir, 'sub'))
+        write_file(join(self.temp_dir, 'sub', 'old_sub.log'), b'x', mtime=old)
+        os.symlink(join(self.temp_dir, 'old.log'), join(self.temp_dir, 'link.log'))
+
+    def teardown_method(self, method):
+        shutil.rmtree(self.temp_dir)
+
+    def scan(self, policies=None, **kwargs):
+        policies = policies or [mod.ArchivePolicy('test', [self.temp_dir], **kwargs)]
+        return sorted(entry.name for entry, policy in mod.FileScanner(policies).scan())
+
+    def test_age_type_and_pattern(self):
+        assert self.scan() == ['old.csv', 'old.log']
+        assert self.scan(include=['*.log']) == ['old.log']
+        assert self.scan(exclude=['*.log', 'x*']) == ['old.csv']
+        assert self.scan(min_age_days=0) == ['new.log', 'old.csv', 'old.log']
+
+    def test_size(self):
+        assert self.scan(min_size=10) == ['old.csv']
+        assert self.scan(max_size=10) == ['old.log']
+
+    def test_recursive(self):
+        assert self.scan(recursive=True) == ['old.csv', 'old.log', 'old_sub.log']
+
+    def test_first_matching_policy_wins(self):
+        policies = [mod.ArchivePolicy('csv', [self.temp_dir], include=['*.csv'], codec='gzip',
+                                      compress_level=9),
+                    mod.ArchivePolicy('all', [self.temp_dir + '/'], recursive=True,
+                                      compress_level=1)]
+        results = dict((entry.name, policy.name)
+                       for entry, policy in mod.FileScanner(policies).scan())
+        assert results == {'old.csv': 'csv', 'old.log': 'all', 'old_sub.log': 'all'}
+
+    def test_budgets(self):
+        policies = [mod.ArchivePolicy('test', [self.temp_dir], recursive=True)]
+        scanner  = mod.FileScanner(policies, max_files=2)
+        assert len(list(scanner.scan())) == 2
+        scanner  = mod.FileScanner(policies, max_bytes=50)
+        assert sorted(entry.name for entry, policy in scanner.scan()) == ['old.log', 'old_sub.log']
+        assert scanner.counts['over_budget'] == 1
+
+    def test_is_lazy(self):
+        scanner = mod.FileScanner([mod.ArchivePolicy('test', [self.temp_dir])])
+        entries = scanner.scan()
+        next(entries)
+        assert scanner.counts['selected'] == 1
+
+    def test_without_scandir(self):
+        orig_scandir = mod.scandir
+        mod.scandir  = None
+        try:
+            assert self.scan(recursive=True) == ['old.csv', 'old.log', 'old_sub.log']
+        finally:
+            mod.scandir = orig_scandir
+
+
+
+class TestPolicies(object):
+
+    def setup_method(self, method):
+        self.temp_dir = tempfile.mkdtemp()
+
+    def teardown_method(self, method):
+        shutil.rmtree(self.temp_dir)
+
+    def test_default_policy_from_dir(self):
+        config   = get_config(self.temp_dir, {'dir': '/tmp', 'extensions': ['.log']})
+        policies = mod.get_policies(config)
+        assert [(policy.dirs, policy.min_age_days) for policy in policies] == [(['/tmp'], 3)]
+        assert policies[0].matches_name('a.log')
+        assert not policies[0].matches_name('a.csv')
+
+    def test_policies_inherit_top_level_keys(self):
+        config = get_config(self.temp_dir,
+                            {'min_age_days': 5,
+                             'compress_level': 9,
+                             'policies': [{'dirs': ['/a'], 'min_age_days': 1},
+                                          {'name': 'b', 'dirs': ['/b'], 'exclude': ['*.x']}]})
+        policies = mod.get_policies(config)
+        assert [(policy.name, policy.min_age_days, policy.compress_level) for policy in policies] \
+            == [('policy-1', 1, 9), ('b', 5, 9)]
+        assert not policies[1].matches_name('a.x')
+
+    def test_invalid_policy(self):
+        with pytest.raises(ValueError):
+            get_config(self.temp_dir, {'policies': [{'dirs': ['/a'], 'codec': 'nope'}]})
+        with pytest.raises(ValueError):
+            mod.get_policies(get_config(self.temp_dir, {}))
+
+
+
+class TestStateIndex(object):
+
+    def setup_method(self, method):
+        self.temp_dir = tempfile.mkdtemp()
+        self.data_dir = join(self.temp_dir, 'data')
+        os.makedirs(join(self.data_dir, 'sub'))
+        self.old = time.time() - 86400 * 10
+        write_file(join(self.data_dir, 'old.log'), b'x', mtime=self.old)
+        write_file(join(self.data_dir, 'new.log'), b'x', mtime=time.time() - 86400)
+        write_file(join(self.data_dir, 'sub', 'old_sub.log'), b'x', mtime=self.old)
+        self.db_fqfn = join(self.temp_dir, 'cache', 'state_index.sqlite')
+
+    def teardown_method(self, method):
+        shutil.rmtree(self.temp_dir)
+
+    def scan(self, compress=True, min_age_days=3, min_size=None):
+        index   = mod.StateIndex(self.db_fqfn)
+        scanner = mod.FileScanner([mod.ArchivePolicy('test', [self.data_dir], recursive=True,
+                                                     min_age_days=min_age_days,
+                                                     min_size=min_size)],
+                                  index=index)
+        names = []
+        compressor = mod.FileCompressor(workers=2)
+        for fn, in_bytes, out_bytes, error in compressor.compress_all(
+                entry.path for entry, policy in scanner.scan()):
+            names.append(os.path.basename(fn))
+            index.record_result(fn, error)
+        index.close()
+        return sorted(names), scanner.counts
+
+    def test_unchanged_dirs_are_skipped(self):
+        names, counts = self.scan()
+        assert names == ['old.log', 'old_sub.log']
+        assert counts['unchanged_dirs'] == 0
+
+        # compression changed the dirs, so they're rescanned once:
+        names, counts = self.scan()
+        assert names == []
+        assert counts['scanned'] == 4
+
+        names, counts = self.scan()
+        assert counts['unchanged_dirs'] == 2
+        assert counts['scanned'] == 0
+
+    def test_new_file_is_found(self):
+        self.scan()
+        self.scan()
+        write_file(join(self.data_dir, 'sub', 'another.log'), b'x', mtime=self.old)
+        names, counts = self.scan()
+        assert names == ['another.log']
+        assert counts['unchanged_dirs'] == 1
+
+    def test_files_coming_due_are_found(self):
+        self.scan()
+        self.scan()
+        # new.log is a day old - so due in two days, or now with a 1 day policy:
+        names, counts = self.scan(min_age_days=1)
+        assert names == ['new.log']
+
+    def test_files_too_small_dont_come_due(self):
+        names, counts = self.scan(min_size=10)
+        assert names == []
+        # old.log is past the age cutoff, but no amount of waiting selects it:
+        names, counts = self.scan(min_size=10)
+        assert counts['unchanged_dirs'] == 2
+        assert counts['scanned'] == 0
+
+    def test_failed_files_are_not_retried(self):
+        class FailingCodec(mod.GzipCodec):
+            def open(self, fn, outfile, compress_level, stat_result):
+                raise IOError('disk full')
+        orig_codec = mod.CODECS['gzip']
+        mod.CODECS['gzip'] = FailingCodec()
+        try:
+            names, counts = self.scan()
+            assert names == ['old.log', 'old_sub.log']
+            names, counts = self.scan()
+            assert names == []
+            assert counts['failed_before'] == 2
+        finally:
+            mod.CODECS['gzip'] = orig_codec
+
+    def test_recorded_actions(self):
+        self.scan()
+        index = mod.StateIndex(self.db_fqfn)
+        files = index.get_files(self.data_dir)
+        index.close()
+        assert files['old.log'][2] == 'compressed'
+        assert files['new.log'][2] == 'good'
+
+
+
+class TestCheckpoint(object):
+
+    def setup_method(self, method):
+        self.temp_dir = tempfile.mkdtemp()
+        self.data_dir = join(self.temp_dir, 'data')
+        old = time.time() - 86400 * 10
+        os.makedirs(join(self.data_dir, 'a'))
+        os.makedirs(join(self.data_dir, 'b'))
+        for sub_dir in ('', 'a', 'b'):
+            for i in range(3):
+                write_file(join(self.data_dir, sub_dir, 'f%d.log' % i), b'x' * 100, mtime=old)
+
+    def teardown_method(self, method):
+        shutil.rmtree(self.temp_dir)
+
+    def get_config(self, **kwargs):
+        file_config = {'dir': self.data_dir,
+                       'recursive': True,
+                       'batch_size': 2,
+                       'state_index_fqfn': join(self.temp_dir, 'cache', 'state_index.sqlite'),
+                       'checkpoint_fqfn': join(self.temp_dir, 'cache', 'checkpoint.json')}
+        file_config.update(kwargs)
+        return get_config(self.temp_dir, file_config)
+
+    def get_uncompressed(self):
+        return sorted(os.path.relpath(join(dir_name, fn), self.data_dir)
+                      for dir_name, sub_dirs, fns in os.walk(self.data_dir)
+                      for fn in fns if fn.endswith('.log'))
+
+    def test_scanner_resumes_from_checkpoint(self):
+        policies = [mod.ArchivePolicy('test', [self.data_dir], recursive=True)]
+        scanner  = mod.FileScanner(policies, max_files=4)
+        first    = [entry.path for entry, policy in scanner.scan()]
+        assert not scanner.is_complete()
+        state    = scanner.get_checkpoint()
+        assert state['dirs'][-1][0] in (join(self.data_dir, 'a'), join(self.data_dir, 'b'))
+
+        scanner  = mod.FileScanner(policies, resume=state)
+        rest     = [entry.path for entry, policy in scanner.scan()]
+        assert scanner.is_complete()
+        assert len(set(first + rest)) == 9
+
+    def test_suppressed_run_resumes(self):
+        class FakeSuppressCheck(object):
+            def suppressed(self):
+                return True
+        config = self.get_config()
+        mod.process_all_the_files(config, FakeSuppressCheck())
+        assert len(self.get_uncompressed()) == 7
+        assert exists(config.checkpoint_fqfn)
+
+        mod.process_all_the_files(config)
+        assert self.get_uncompressed() == []
+        assert not exists(config.checkpoint_fqfn)
+
+    def test_time_budget(self):
+        config = self.get_config(time_budget_minutes=0)
+        mod.process_all_the_files(config)
+        assert len(self.get_uncompressed()) == 7
+        mod.process_all_the_files(config)
+        assert len(self.get_uncompressed()) == 5
+
+    def test_changed_policies_ignore_checkpoint(self):
+        checkpoint = mod.Checkpoint(join(self.temp_dir, 'cache', 'checkpoint.json'))
+        checkpoint.save({'fingerprint': 'abc', 'dirs': []})
+        assert checkpoint.load('abc') == {'fingerprint': 'abc', 'dirs': []}
+        assert checkpoint.load('xyz') is None
+        checkpoint.clear()
+        assert checkpoint.load('abc') is None
+
+
+
+class TestPlan(object):
+
+    def setup_method(self, method):
+        self.temp_dir = tempfile.mkdtemp()
+        self.data_dir = join(self.temp_dir, 'data')
+        os.makedirs(self.data_dir)
+        old = time.time() - 86400 * 10
+        for i in range(30):
+            write_file(join(self.data_dir, 'f%02d.log' % i), b'abcd' * 2500, mtime=old)
+        write_file(join(self.data_dir, 'random.dat'), os.urandom(10000), mtime=old)
+
+    def teardown_method(self, method):
+        shutil.rmtree(self.temp_dir)
+
+    def test_plan_changes_nothing(self):
+        before = sorted(os.listdir(self.data_dir))
+        config = get_config(self.temp_dir,
+                            {'policies': [{'name': 'logs', 'dirs': [self.data_dir],
+                                           'include': ['*.log']},
+                                          {'name': 'other', 'dirs': [self.data_dir],
+                                           'codec': 'bz2'}],
+                             'plan_sample_files': 5,
+                             'max_files': 20},
+                            plan=True)
+        plan = mod.plan_all_the_files(config)
+        assert sorted(os.listdir(self.data_dir)) == before
+
+        assert sorted(plan.groups) == [('logs', 'gzip', None), ('other', 'bz2', None)]
+        assert len(plan.groups[('logs', 'gzip', None)]['samples']) == 5
+        files, bytes_in, bytes_out, seconds = plan.get_totals()
+        assert (files, bytes_in) == (31, 310000)
+        assert plan.groups[('logs', 'gzip', None)]['out_bytes'] < 30000
+        assert plan.groups[('other', 'bz2', None)]['out_bytes'] > 9000
+        lines = plan.format()
+        assert lines[-1] == 'at max_files of 20 this takes 2 runs'
+
+    @pytest.mark.parametrize('codec', ['gzip', 'auto'])
+    @pytest.mark.parametrize('noatime', [True, False])
+    def test_plan_keeps_atimes(self, noatime, codec):
+        atimes = dict((fn, os.stat(join(self.data_dir, fn)).st_atime)
+                      for fn in os.listdir(self.data_dir))
+        orig_noatime = mod.O_NOATIME
+        if not noatime:         # as if not the owner - so atimes are restored
+            mod.O_NOATIME = 0
+        try:
+            config = get_config(self.temp_dir, {'dir': self.data_dir, 'plan_sample_files': 50,
+                                                'codec': codec},
+                                plan=True)
+            plan = mod.plan_all_the_files(config)
+        finally:
+            mod.O_NOATIME = orig_noatime
+        assert sum(len(group['samples']) for group in plan.groups.values()) >= 30
+        assert dict((fn, os.stat(join(self.data_dir, fn)).st_atime)
+                    for fn in os.listdir(self.data_dir)) == atimes
+
+    def test_reservoir_sample(self):
+        plan = mod.Plan(sample_files=3)
+        for i in range(1000):
+            plan.add('f%d' % i, 1, 'p', 'gzip', None)
+        samples = plan.groups[('p', 'gzip', None)]['samples']
+        assert len(set(samples)) == 3
+        assert samples != ['f0', 'f1', 'f2']
+
+
+
+class TestBundles(object):
+
+    def setup_method(self, method):
+        self.temp_dir = tempfile.mkdtemp()
+        self.data_dir = join(self.temp_dir, 'data')
+        os.makedirs(join(self.data_dir, 'sub'))
+        self.old      = time.time() - 86400 * 10
+        self.contents = {}
+        for i in range(20):
+            self.contents['f%02d.log' % i] = ('line %d\n' % i).encode('ascii') * (i + 1) * 10
+            write_file(join(self.data_dir, 'f%02d.log' % i), self.contents['f%02d.log' % i],
+                       mtime=self.old)
+
+    def teardown_method(self, method):
+        shutil.rmtree(self.temp_dir)
+
+    def bundle(self, codec_name='gzip', block_size=mod.BUNDLE_BLOCK_SIZE):
+        names = sorted(self.contents)
+        return mod.write_bundle((self.data_dir, names, codec_name, None,
+                                 'bundle-test.tar%s' % mod.CODECS[codec_name].suffix, block_size))
+
+    @pytest.mark.parametrize('codec_name', sorted(mod.CODECS))
+    def test_bundle_is_a_valid_tar(self, codec_name):
+        if codec_name in ('zstd', 'lz4'):
+            pytest.skip('tarfile cannot read %s' % codec_name)
+        archive_fqfn, fns, in_bytes, out_bytes, error = self.bundle(codec_name, block_size=500)
+        assert error is None
+        assert sorted(os.listdir(self.data_dir)) == ['bundle-test.tar%s' % mod.CODECS[codec_name].suffix,
+                                                     'bundle-test.tar%s.idx' % mod.CODECS[codec_name].suffix,
+                                                     'sub']
+        with tarfile.open(archive_fqfn) as tar:
+            assert sorted(tar.getnames()) == sorted(self.contents)
+            for name, content in self.contents.items():
+                assert tar.extractfile(name).read() == content
+                assert tar.getmember(name).mtime == int(self.old)
+
+    @pytest.mark.parametrize('codec_name', sorted(mod.CODECS))
+    def test_random_access(self, codec_name):
+        archive_fqfn = self.bundle(codec_name, block_size=500)[0]
+        with open(archive_fqfn + mod.BUNDLE_INDEX_SUFFIX) as f:
+            assert len(json.load(f)['blocks']) > 5
+        for name, content in self.contents.items():
+            assert mod.extract_from_bundle(archive_fqfn, name) == content
+        with pytest.raises(KeyError):
+            mod.extract_from_bundle(archive_fqfn, 'nope.log')
+
+    def test_failure_keeps_originals(self):
+        self.contents['missing.log'] = b''
+        archive_fqfn, fns, in_bytes, out_bytes, error = self.bundle()
+        assert error
+        assert len([fn for fn in os.listdir(self.data_dir) if fn.endswith('.log')]) == 20
+        assert not exists(archive_fqfn)
+
+    def test_small_files_are_bundled_in_a_run(self):
+        write_file(join(self.data_dir, 'big.log'), b'x' * 10000, mtime=self.old)
+        write_file(join(self.data_dir, 'sub', 'lonely.log'), b'x', mtime=self.old)
+        mod.process_all_the_files(get_config(self.temp_dir,
+                                             {'dir': self.data_dir, 'recursive': True,
+                                              'bundle_max_size': 2000,
+                                              'state_index': False, 'checkpoint': False}))
+
+        names = sorted(os.listdir(self.data_dir))
+        assert [name for name in names if not name.startswith('bundle-')] == ['big.log.gz', 'sub']
+        assert os.listdir(join(self.data_dir, 'sub')) == ['lonely.log.gz']
+        bundles = [name for name in names if name.endswith('.tar.gz')]
+        with tarfile.open(join(self.data_dir, bundles[0])) as tar:
+            assert sorted(tar.getnames()) == sorted(self.contents)
+
+        # bundles and their indexes aren't picked up by later runs:
+        policy = mod.ArchivePolicy('test', [self.data_dir], min_age_days=0)
+        assert [entry.name for entry, policy in mod.FileScanner([policy]).scan()] == []
+
+    def test_dir_is_bundled_once_across_batches(self):
+        write_file(join(self.data_dir, 'sub', 'a.log'), b'x', mtime=self.old)
+        write_file(join(self.data_dir, 'sub', 'b.log'), b'x', mtime=self.old)
+        mod.process_all_the_files(get_config(self.temp_dir,
+                                             {'dir': self.data_dir, 'recursive': True,
+                                              'bundle_max_size': 2000, 'batch_size': 3,
+                                              'state_index': False, 'checkpoint': False}))
+        bundles = [name for name in os.listdir(self.data_dir) if name.endswith('.tar.gz')]
+        assert len(bundles) == 1
+        with tarfile.open(join(self.data_dir, bundles[0])) as tar:
+            assert sorted(tar.getnames()) == sorted(self.contents)
+        sub_bundles = [name for name in os.listdir(join(self.data_dir, 'sub'))
+                       if name.endswith('.tar.gz')]
+        assert len(sub_bundles) == 1
+
+    def test_stopped_run_leaves_open_bundle_for_next_run(self):
+        file_config = {'dir': self.data_dir, 'bundle_max_size': 2000, 'batch_size': 3,
+                       'time_budget_minutes': 0, 'state_index': False,
+                       'checkpoint_fqfn': join(self.temp_dir, 'checkpoint.json')}
+        mod.process_all_the_files(get_config(self.temp_dir, file_config))
+        assert sorted(os.listdir(self.data_dir)) == sorted(list(self.contents) + ['sub'])
+
+        del file_config['time_budget_minutes']
+        mod.process_all_the_files(get_config(self.temp_dir, file_config))
+        bundles = [name for name in os.listdir(self.data_dir) if name.endswith('.tar.gz')]
+        assert len(bundles) == 1
+        with tarfile.open(join(self.data_dir, bundles[0])) as tar:
+            assert sorted(tar.getnames()) == sorted(self.contents)
+
+    def test_bundle_windows(self):
+        policy  = mod.ArchivePolicy('test', [self.data_dir], bundle_max_size=1000,
+                                    bundle_window='day')
+        write_file(join(self.data_dir, 'f00.log'), b'x', mtime=self.old - 86400 * 2)
+        bundler = mod.Bundler()
+        for entry, policy in mod.FileScanner([policy]).scan():
+            bundler.add(entry, policy, 'gzip', None)
+        bundle_tasks, single_tasks = bundler.get_tasks()
+        assert [len(task[1]) for task in bundle_tasks] == [19]
+        assert bundle_tasks[0][4].startswith('bundle-%s-' % time.strftime('%Y%m%d', time.localtime(self.old)))
+        assert single_tasks == [(join(self.data_dir, 'f00.log'), 'gzip', None)]
+
+
+
+class TestThrottle(object):
+
+    def setup_method(self, method):
+        self.temp_dir = tempfile.mkdtemp()
+
+    def teardown_method(self, method):
+        shutil.rmtree(self.temp_dir)
+
+    def test_token_bucket(self):
+        bucket = mod.TokenBucket(1000000, burst_seconds=0.01)
+        start_time = time.time()
+        assert bucket.consume(10000) == 0
+        bucket.consume(100000)
+        assert 0.08 < time.time() - start_time < 0.5
+
+    def test_iops(self):
+        throttle = mod.Throttle(iops=200)
+        start_time = time.time()
+        for i in range(300):
+            throttle.read(1)
+        throttle.write(0)           # no write - no operation
+        assert 0.4 < time.time() - start_time < 1.0
+
+    def test_throttled_compression(self):
+        fqfn = write_file(join(self.temp_dir, 'a.log'), b'x' * 1500000)
+        compressor = mod.FileCompressor(workers=1, chunk_size=65536,
+                                        throttle=mod.Throttle(read_bps=1000000))
+        start_time = time.time()
+        results = list(compressor.compress_all([fqfn]))
+        assert 0.4 < time.time() - start_time < 1.5
+        assert results[0][3] is None
+        assert decompress('gzip', fqfn + '.gz') == b'x' * 1500000
+
+    def test_governor_settles_on_the_useful_workers(self):
+        governor = mod.ConcurrencyGovernor(4, interval=1, probe_intervals=3)
+        governor.interval_start = 0
+        limits = []
+        for now in range(1, 15):
+            # throughput only grows up to 2 workers:
+            governor.record(min(governor.limit, 2) * 100, now=now)
+            limits.append(governor.limit)
+        assert limits == [2, 3, 2, 2, 2, 3, 2, 2, 2, 3, 2, 2, 2, 3]
+
+    def test_governor_backs_off_when_throughput_drops(self):
+        governor = mod.ConcurrencyGovernor(4, interval=1)
+        governor.interval_start = 0
+        for now in range(1, 4):
+            governor.record(governor.limit * 100, now=now)
+        assert governor.limit == 4
+        governor.record(50, now=4)      # the main workload got busy
+        governor.record(200, now=5)     # the limit at 4 didn't help
+        assert governor.limit == 2
+
+    def test_adaptive_compression(self):
+        fqfns = [write_file(join(self.temp_dir, '%d.log' % i), b'x' * 1000) for i in range(20)]
+        compressor = mod.FileCompressor(workers=3, adaptive=True)
+        results = list(compressor.compress_all(fqfns))
+        assert sorted(result[0] for result in results) == sorted(fqfns)
+        assert all(result[3] is None for result in results)
+
+    def test_lower_priority(self):
+        script = ('import sys, os, logging; sys.path.insert(0, %r); import cletus_archiver as mod; '
+                  'mod.logger = logging.getLogger(); before = os.nice(0); '
+                  'mod.lower_priority(3, "idle"); print(os.nice(0) - before)'
+                  % dirname(os.path.abspath(mod.__file__)))
+        assert subprocess.check_output([sys.executable, '-c', script]).strip() == b'3'
+
+
+
+class TestCodecs(object):
+
+    def setup_method(self, method):
+        self.temp_dir = tempfile.mkdtemp()
+        self.content  = ''.join('line %d of a fairly repetitive log file\n' % i
+                                for i in range(20000)).encode('ascii')
+
+    def teardown_method(self, method):
+        shutil.rmtree(self.temp_dir)
+
+    @pytest.mark.parametrize('codec_name', sorted(mod.CODECS))
+    def test_round_trip(self, codec_name):
+        fqfn  = write_file(join(self.temp_dir, 'a.log'), self.content)
+        codec = mod.CODECS[codec_name]
+        fn, in_bytes, out_bytes, error = mod.FileCompressor(codec=codec_name).compress(fqfn)
+        assert error is None
+        assert out_bytes < in_bytes
+        assert os.listdir(self.temp_dir) == ['a.log' + codec.suffix]
+        assert decompress(codec_name, join(self.temp_dir, 'a.log' + codec.suffix)) == self.content
+
+    def test_levels_are_clamped(self):
+        assert mod.CODECS['gzip'].get_level(22) == 9
+        assert mod.CODECS['gzip'].get_level(None) == 6
+        assert mod.CODECS['bz2'].get_level(0) == 1
+
+    def test_all_outputs_are_skipped(self):
+        policy = mod.ArchivePolicy('test', [self.temp_dir])
+        for suffix in ['.gz', '.bz2', '.xz', '.zst', '.lz4']:
+            assert not policy.matches_name('a.log' + suffix)
+        assert policy.matches_name('a.log')
+
+    def test_uninstalled_codec(self):
+        with pytest.raises(ValueError):
+            mod.ArchivePolicy('test', [self.temp_dir], codec='nope')
+
+    def test_auto_tune(self):
+        fqfn    = write_file(join(self.temp_dir, 'a.log'), self.content)
+        results = [('gzip', 1, 100.0, 0.30), ('gzip', 9, 30.0, 0.20), ('bz2', 9, 5.0, 0.10)]
+        assert mod.AutoTuner(min_mbps=20)._pick(results)  == ('gzip', 9)
+        assert mod.AutoTuner(min_mbps=500)._pick(results) == ('gzip', 1)
+        assert mod.AutoTuner(max_ratio=0.25)._pick(results) == ('gzip', 9)
+        assert mod.AutoTuner(max_ratio=0.01)._pick(results) == ('bz2', 9)
+
+        tuner  = mod.AutoTuner(min_mbps=0, sample_bytes=100000)
+        choice = tuner.choose(fqfn, key=('test', '.log'))
+        assert choice[0] in mod.CODECS
+        assert tuner.choose('/missing', key=('test', '.log')) == choice
+
+
+
+def decompress(codec_name, fqfn):
+    with open(fqfn, 'rb') as f:
+        data = f.read()
+    if codec_name == 'gzip':
+        return gzip.GzipFile(fileobj=io.BytesIO(data)).read()
+    elif codec_name == 'bz2':
+        return mod.bz2.decompress(data)
+    elif codec_name == 'xz':
+        return mod.lzma.decompress(data)
+    elif codec_name == 'zstd':
+        return mod.zstandard.ZstdDecompressor().decompressobj().decompress(data)
+    elif codec_name == 'lz4':
+        return mod.lz4_frame.decompress(data)
@@ -10,6 +10,11 @@ from __future__ import absolute_import
 # IMPORTS -----------------------------------------------------------------
 import sys
 import os
+import time
+import pickle
+import threading
+import subprocess
+import json
 import tempfile
 import shutil
 import pytest
@@ -43,6 +48,138 @@ class Test_add_file(object):
         assert self.config_man.cm_config['foo'] == 'bar'
 
 
+
+class Test_parse_cache(object):
+
+    def setup_method(self, method):
+        self.temp_dir    = tempfile.mkdtemp()
+        self.config_fqfn = os.path.join(self.temp_dir, 'config.yml')
+        self.write_config({'foo': 'bar', 'nested': {'size': 5}})
+        self.parse_count = 0
+        self.orig_parse  = mod._parse_yaml
+        mod._parse_yaml  = self.counting_parse
+        mod.parse_cache.clear()
+
+    def teardown_method(self, method):
+        mod._parse_yaml = self.orig_parse
+        shutil.rmtree(self.temp_dir)
+
+    def counting_parse(self, raw):
+        self.parse_count += 1
+        return self.orig_parse(raw)
+
+    def write_config(self, config):
+        with open(self.config_fqfn, 'w') as outfile:
+            outfile.write(yaml.dump(config, default_flow_style=False))
+
+    def test_unchanged_file_is_not_reparsed(self):
+        for i in range(3):
+            config_man = mod.ConfigManager()
+            config_man.add_file(config_fqfn=self.config_fqfn)
+            assert config_man.cm_config['nested'] == {'size': 5}
+            config_man.cm_config_file['nested']['size'] = 99
+        assert self.parse_count == 1
+
+    def test_changed_file_is_reparsed(self):
+        config_man = mod.ConfigManager()
+        config_man.add_file(config_fqfn=self.config_fqfn)
+        self.write_config({'foo': 'changed', 'nested': {'size': 5}})
+        os.utime(self.config_fqfn, (0, 0))
+        config_man.add_file(config_fqfn=self.config_fqfn)
+        assert config_man.foo == 'changed'
+        assert self.parse_count == 2
+
+    def test_touched_file_is_not_reparsed(self):
+        config_man = mod.ConfigManager()
+        config_man.add_file(config_fqfn=self.config_fqfn)
+        os.utime(self.config_fqfn, (0, 0))
+        config_man.add_file(config_fqfn=self.config_fqfn)
+        assert self.parse_count == 1
+
+    def test_disk_cache(self):
+        config_man = mod.ConfigManager()
+        config_man.add_file(config_fqfn=self.config_fqfn, disk_cache=True)
+        assert isfile(os.path.join(self.temp_dir, '.config.yml.cache'))
+
+        # simulate a new process:
+        mod.parse_cache.clear()
+        config_man = mod.ConfigManager()
+        config_man.add_file(config_fqfn=self.config_fqfn, disk_cache=True)
+        assert config_man.foo == 'bar'
+        assert self.parse_count == 1
+
+        # a changed file must not be served from the stale disk cache:
+        mod.parse_cache.clear()
+        self.write_config({'foo': 'changed'})
+        config_man = mod.ConfigManager()
+        config_man.add_file(config_fqfn=self.config_fqfn, disk_cache=True)
+        assert config_man.foo == 'changed'
+        assert self.parse_count == 2
+
+
+class Test_reload(object):
+
+    def setup_method(self, method):
+        self.temp_dir    = tempfile.mkdtemp()
+        self.config_fqfn = os.path.join(self.temp_dir, 'config.yml')
+        self.schema      = {'type': 'object',
+                            'properties': {
+                                'foo':   {'type': 'string'},
+                                'count': {'type': 'integer'},
+                                'mode':  {'type': 'string', 'required': False}},
+                            'additionalProperties': False}
+        self.write_config({'foo': 'bar', 'count': 1, 'mode': 'fast'})
+        self.config_man  = mod.ConfigManager(self.schema)
+        self.config_man.add_file(config_fqfn=self.config_fqfn)
+        self.config_man.add_iterable({'count': 2})
+        self.config_man.validate()
+        self.changes     = []
+        self.config_man.on_change(self.changes.append)
+
+    def teardown_method(self, method):
+        self.config_man.stop_watching()
+        shutil.rmtree(self.temp_dir)
+
+    def write_config(self, config):
+        with open(self.config_fqfn, 'w') as outfile:
+            outfile.write(yaml.dump(config, default_flow_style=False))
+        # ensure the change is visible even with coarse mtimes:
+        os.utime(self.config_fqfn, (time.time() + 5, time.time() + 5))
+
+    def test_unchanged_file(self):
+        assert self.config_man.reload_if_changed() is False
+        assert self.changes == []
+
+    def test_changed_file_keeps_layer_order(self):
+        self.write_config({'foo': 'changed', 'count': 1})
+        assert self.config_man.reload_if_changed() is True
+        assert self.config_man.foo   == 'changed'
+        assert self.config_man.count == 2            # iterable still overrides file
+        assert 'mode' not in self.config_man.cm_config
+        assert not hasattr(self.config_man, 'mode')
+        assert self.changes == [{'foo':  ('bar', 'changed'),
+                                 'mode': ('fast', None)}]
+
+    def test_invalid_file_keeps_old_config(self):
+        self.write_config({'foo': 5, 'count': 1})
+        assert self.config_man.reload_if_changed() is False
+        assert self.config_man.foo == 'bar'
+        assert self.changes == []
+        # and doesn't keep retrying the same bad file:
+        assert self.config_man.reload_if_changed() is False
+
+    def test_watch(self):
+        self.config_man.watch(interval=0.05)
+        self.write_config({'foo': 'watched', 'count': 1})
+        for i in range(100):
+            if self.changes:
+                break
+            time.sleep(0.05)
+        assert self.config_man.foo == 'watched'
+        assert sorted(self.changes[0]) == ['foo', 'mode']
+
+
+
 class Test_add_env_vars(object):
 
     def setup_method(self, method):
@@ -90,6 +227,72 @@ class Test_add_env_vars(object):
         assert self.config_man.cm_config['cletus_foo']     == 'bar'
 
 
+class Test_typed_env_vars(object):
+
+    def setup_method(self, method):
+        self.schema = {'type': 'object',
+                       'properties': {
+                           'name':    {'type': 'string'},
+                           'count':   {'type': 'integer'},
+                           'ratio':   {'type': 'number'},
+                           'verbose': {'type': 'boolean'},
+                           'limit':   {'type': ['integer', 'null']},
+                           'hosts':   {'type': 'array', 'items': {'type': 'integer'}},
+                           'db':      {'type': 'object',
+                                       'properties': {
+                                           'pool': {'type': 'object',
+                                                    'properties': {
+                                                        'pool_size': {'type': 'integer'}}}}}},
+                       'additionalProperties': False}
+        self.env_vars = {'APP__NAME':              'cletus',
+                         'APP__COUNT':             '12',
+                         'APP__RATIO':             '0.5',
+                         'APP__VERBOSE':           'yes',
+                         'APP__LIMIT':             '',
+                         'APP__HOSTS':             '1, 2,3',
+                         'APP__DB__POOL__POOL_SIZE': '8',
+                         'COUNT':                  '7',
+                         'VERBOSE':                'off'}
+        os.environ.update(self.env_vars)
+
+    def teardown_method(self, method):
+        for key in self.env_vars:
+            del os.environ[key]
+
+    def test_prefixed_with_schema(self):
+        config_man = mod.ConfigManager(self.schema)
+        config_man.add_env_vars(prefix='APP')
+        assert config_man.cm_config_env == {'name':    'cletus',
+                                            'count':   12,
+                                            'ratio':   0.5,
+                                            'verbose': True,
+                                            'limit':   None,
+                                            'hosts':   [1, 2, 3],
+                                            'db':      {'pool': {'pool_size': 8}}}
+        assert config_man.db.pool.pool_size == 8
+        assert config_man.validate() is True
+
+    def test_prefixed_without_schema(self):
+        config_man = mod.ConfigManager()
+        config_man.add_env_vars(prefix='APP')
+        assert config_man.cm_config_env['count'] == '12'
+        assert config_man.cm_config_env['db'] == {'pool': {'pool_size': '8'}}
+
+    def test_unprefixed_keys_are_coerced(self):
+        config_man = mod.ConfigManager(self.schema)
+        config_man.add_env_vars(['COUNT', 'VERBOSE'], key_to_lower=True)
+        assert config_man.cm_config_env == {'count': 7, 'verbose': False}
+
+    def test_uncoercible_value_left_for_validation(self):
+        os.environ['APP__COUNT'] = 'many'
+        config_man = mod.ConfigManager(self.schema)
+        config_man.add_env_vars(prefix='APP')
+        assert config_man.count == 'many'
+        with pytest.raises(ValueError):
+            config_man.validate()
+
+
+
 class Test_get_schema_keys(object):
 
     def setup_method(self, method):
@@ -420,5 +623,549 @@ class Test_access_via_namespace(object):
         with pytest.raises(ValueError):
             self.config_man.add_iterable(sample_dict)
 
+    def test_log_level_without_namespace_access(self):
+        config_man = mod.ConfigManager(namespace_access=False)
+        assert config_man.log_level is None
+        config_man.add_iterable({'log_level': 'INFO', 'foo': 'bar'})
+        assert config_man.log_level == 'INFO'
+        with pytest.raises(AttributeError):
+            config_man.foo
+
+
+
+
+
+class Test_compiled_validation(object):
+
+    def setup_method(self, method):
+        self.schema = {'type': 'object',
+                       'properties': {
+                         'foo':   {'required': True, 'type': 'string'},
+                         'baz':   {'enum': ['spaz', 'fads']},
+                         'count': {'type': 'integer', 'minimum': 1, 'required': False},
+                         'db':    {'type': 'object',
+                                   'required': False,
+                                   'properties': {
+                                       'host': {'type': 'string'},
+                                       'port': {'type': 'integer', 'maximum': 65535}}} },
+                       'additionalProperties': False }
+
+    def test_all_errors_reported_in_one_pass(self):
+        config_man = mod.ConfigManager(self.schema)
+        config_man.add_iterable({'baz':   'nope',
+                                 'count': 0,
+                                 'db':    {'host': 5, 'port': 70000},
+                                 'extra': 1})
+        with pytest.raises(ValueError) as excinfo:
+            config_man.validate()
+        msg = str(excinfo.value)
+        for field in ("'foo' is missing", "'baz'", "'count'", "'db.host'", "'db.port'",
+                      "additional property 'extra'"):
+            assert field in msg
+
+        checker = mod.compile_schema(self.schema)
+        assert len(checker(config_man.cm_config)) == 6
+
+    def test_checker_is_cached(self):
+        config_man = mod.ConfigManager(self.schema)
+        config_man.add_iterable({'foo': 'bar', 'baz': 'spaz'})
+        assert config_man.validate() is True
+        checker = config_man._get_validator(self.schema)
+        assert config_man.validate() is True
+        assert config_man._get_validator(self.schema) is checker
+        assert len(config_man.cm_validators) == 1
+
+    def test_same_results_as_validictory(self):
+        cases = [({'foo': 'bar', 'baz': 'spaz'},                       True),
+                 ({'foo': 'bar'},                                      False),
+                 ({'foo': '',    'baz': 'spaz'},                       False),
+                 ({'foo': 'bar', 'baz': None},                         True),
+                 ({'foo': 'bar', 'baz': 'spaz', 'count': True},        False),
+                 ({'foo': 'bar', 'baz': 'spaz', 'count': 3},           True),
+                 ({'foo': 'bar', 'baz': 'spaz', 'db': None},           False),
+                 ({'foo': 'bar', 'baz': 'spaz', 'db': {'host': 'h', 'port': 5}}, True),
+                 ({'foo': 'bar', 'baz': 'spaz', 'db': {'host': 'h'}},  False),
+                 ({'foo': None,  'baz': 'spaz'},                       False)]
+        checker = mod.compile_schema(self.schema)
+        for data, expected in cases:
+            try:
+                mod.valid.validate(data, self.schema)
+                validictory_result = True
+            except ValueError:
+                validictory_result = False
+            assert validictory_result is expected, data
+            assert (checker(data) == []) is expected, data
+
+    def test_fallback_to_validictory(self):
+        schema  = {'type': 'object',
+                   'properties': {
+                       'started': {'type': 'string', 'format': 'date'},
+                       'foo':     {'type': 'string'}}}
+        checker = mod.compile_schema(schema)
+        assert checker({'started': '2016-08-01', 'foo': 'bar'}) == []
+        assert len(checker({'started': 'last week', 'foo': 5})) == 2
+
+    def test_invalid_schema(self):
+        with pytest.raises(ValueError):
+            mod.compile_schema({'type': 'object',
+                                'properties': {'foo': {'type': 'widget'}}})
+
 
 
+class Test_layers(object):
+
+    def setup_method(self, method):
+        self.temp_dir    = tempfile.mkdtemp()
+        self.config_fqfn = os.path.join(self.temp_dir, 'config.yml')
+        with open(self.config_fqfn, 'w') as outfile:
+            outfile.write(yaml.dump({'foo': 'file', 'bar': 'file', 'baz': None}))
+        self.config_man  = mod.ConfigManager()
+
+    def teardown_method(self, method):
+        shutil.rmtree(self.temp_dir)
+
+    def test_provenance(self):
+        self.config_man.add_defaults({'baz': 'default', 'bugs': 'default'})
+        self.config_man.add_file(config_fqfn=self.config_fqfn)
+        self.config_man.add_iterable({'foo': 'iterable', 'bar': None})
+
+        assert self.config_man.cm_config == {'foo': 'iterable', 'bar': 'file',
+                                             'baz': 'default', 'bugs': 'default'}
+        assert self.config_man.get_source('foo')  == 'iterable'
+        assert self.config_man.get_source('bar')  == 'file:%s' % self.config_fqfn
+        assert self.config_man.get_source('baz')  == 'defaults'
+        assert self.config_man.get_source('nope') is None
+        assert [name for name, priority in self.config_man.get_layers()] \
+            == ['iterable', 'file:%s' % self.config_fqfn, 'defaults']
+
+    def test_explicit_priorities(self):
+        self.config_man.add_iterable({'foo': 'args'}, name='args', priority=100)
+        self.config_man.add_file(config_fqfn=self.config_fqfn, priority=10)
+        assert self.config_man.foo == 'args'
+        assert self.config_man.bar == 'file'
+
+        # a later add without a priority still overrides everything before it:
+        self.config_man.add_iterable({'foo': 'latest'})
+        assert self.config_man.foo == 'latest'
+        assert self.config_man.get_layers()[0] == ('iterable', 101)
+
+    def test_replace_named_layer(self):
+        self.config_man.add_iterable({'foo': 'first', 'bar': 'first'}, name='overrides')
+        self.config_man.add_iterable({'baz': 'other'})
+        self.config_man.add_iterable({'foo': 'second'}, name='overrides')
+        assert self.config_man.cm_config == {'foo': 'second', 'baz': 'other'}
+        assert len(self.config_man.get_layers()) == 2
+
+    def test_merge_is_memoized(self):
+        self.config_man.add_iterable({'foo': 'bar'})
+        config = self.config_man.cm_config
+        assert self.config_man.cm_config is config
+        self.config_man.add_iterable({'foo': 'baz'})
+        assert self.config_man.cm_config is not config
+        assert self.config_man.foo == 'baz'
+
+
+
+class Test_nested_config(object):
+
+    def setup_method(self, method):
+        self.config_man = mod.ConfigManager()
+        self.config_man.add_defaults({'db': {'pool': {'size': 5, 'timeout': 30}}})
+        self.config_man.add_iterable({'db': {'host': 'localhost',
+                                             'pool': {'size': 10}},
+                                      'name': 'app'},
+                                     name='file')
+        self.config_man.add_iterable({'db': {'pool': {'timeout': None,
+                                                      'recycle': 60}}},
+                                     name='args')
+
+    def test_deep_merge(self):
+        assert self.config_man.cm_config['db'] == {'host': 'localhost',
+                                                   'pool': {'size': 10,
+                                                            'timeout': 30,
+                                                            'recycle': 60}}
+
+    def test_layers_are_not_modified(self):
+        assert self.config_man.cm_config_defaults == {'db': {'pool': {'size': 5,
+                                                                      'timeout': 30}}}
+
+    def test_namespace_access(self):
+        assert self.config_man.db.pool.size == 10
+        assert self.config_man.db.pool['timeout'] == 30
+        assert self.config_man.db['pool'].recycle == 60
+        assert self.config_man.db.host == 'localhost'
+        assert sorted(self.config_man.db.pool.keys()) == ['recycle', 'size', 'timeout']
+        assert self.config_man.db.pool == {'size': 10, 'timeout': 30, 'recycle': 60}
+        assert self.config_man.db.get('missing') is None
+        with pytest.raises(AttributeError):
+            self.config_man.db.missing
+
+    def test_sections_are_pinned(self):
+        pool = self.config_man.db.pool
+        self.config_man.add_iterable({'db': {'pool': {'size': 20}}})
+        assert pool.size == 10
+        assert self.config_man.db.pool.size == 20
+
+    def test_items_are_bound_when_published(self):
+        assert self.config_man.__dict__['name'] == 'app'
+        self.config_man.add_iterable({'name': 'other'}, name='other')
+        assert self.config_man.__dict__['name'] == 'other'
+        self.config_man.add_iterable({'extra': 1}, name='other')
+        assert self.config_man.__dict__['name'] == 'app'
+        assert self.config_man.extra == 1
+        self.config_man.add_iterable({}, name='other')
+        assert 'extra' not in self.config_man.__dict__
+        with pytest.raises(AttributeError):
+            self.config_man.extra
+
+    def test_reads_never_take_the_lock(self):
+        class NoLock(object):
+            def __enter__(self):
+                pytest.fail('read took cm_write_lock')
+        self.config_man.cm_write_lock = NoLock()
+        assert self.config_man.db.pool.size == 10
+        assert self.config_man.cm_config['name'] == 'app'
+        assert self.config_man.get_source('db.pool.size') == 'file'
+
+    def test_unmerged_sections_are_shared(self):
+        cache = {'cache': {'size': 1, 'hosts': ['a']}}
+        self.config_man.add_iterable(cache)
+        version = self.config_man._get_version()
+        self.config_man.add_iterable({'name': 'other'})
+        new_version = self.config_man._get_version()
+        assert new_version.cm_config['cache'] is version.cm_config['cache']
+        assert new_version.cm_config['cache'] is self.config_man.cm_layers[-2].frozen['cache']
+        # merged sections are copied:
+        assert new_version.cm_config['db'] is not version.cm_config['db']
+
+    def test_sections_are_frozen_dicts(self):
+        pool = self.config_man.db.pool
+        assert type(pool) is mod.FrozenDict
+        assert pool is self.config_man.cm_config['db']['pool']
+        with pytest.raises(TypeError):
+            pool.size = 1
+        with pytest.raises(TypeError):
+            pool |= {'size': 1}
+        assert self.config_man.db.pool.size == 10
+        # items that clash with dict methods are only available through []:
+        config = mod.FrozenDict({'items': 1, 'size': 2})
+        assert (config['items'], config.size) == (1, 2)
+        assert callable(config.items)
+
+    def test_frozen_config_dumps_as_yaml(self):
+        self.config_man.add_iterable({'hosts': ['a', 'b']})
+        expected = {'db': {'host': 'localhost',
+                           'pool': {'size': 10, 'timeout': 30, 'recycle': 60}},
+                    'name': 'app',
+                    'hosts': ['a', 'b']}
+        for dump in (yaml.safe_dump, yaml.dump):
+            dumped = dump(self.config_man.cm_config, default_flow_style=False)
+            assert '!!python' not in dumped
+            assert yaml.safe_load(dumped) == expected
+
+    def test_nested_sources(self):
+        assert self.config_man.get_source('db.pool.size')    == 'file'
+        assert self.config_man.get_source('db.pool.timeout') == 'defaults'
+        assert self.config_man.get_source('db.pool.recycle') == 'args'
+        assert self.config_man.get_source('db.host')         == 'file'
+        assert self.config_man.get_source('db.pool.nope')    is None
+        assert self.config_man.get_source('name')            == 'file'
+
+    def test_replaced_section_sources(self):
+        self.config_man.add_iterable({'db': 'sqlite'}, name='override')
+        self.config_man.add_iterable({'db': {'host': 'remote'}}, name='last')
+        assert self.config_man.cm_config['db'] == {'host': 'remote'}
+        assert self.config_man.get_source('db.host') == 'last'
+        assert self.config_man.get_source('db.pool') is None
+
+    def test_without_deep_merge(self):
+        config_man = mod.ConfigManager(deep_merge=False)
+        config_man.add_iterable({'db': {'host': 'localhost', 'port': 5432}})
+        config_man.add_iterable({'db': {'port': 6543}})
+        assert config_man.cm_config['db'] == {'port': 6543}
+
+
+
+class Test_snapshot(object):
+
+    def setup_method(self, method):
+        self.temp_dir    = tempfile.mkdtemp()
+        self.config_fqfn = os.path.join(self.temp_dir, 'config.yml')
+        with open(self.config_fqfn, 'w') as outfile:
+            outfile.write(yaml.dump({'db': {'host': 'localhost', 'ports': [1, 2]},
+                                     'name': 'app'}, default_flow_style=False))
+        self.config_man = mod.ConfigManager()
+        self.config_man.add_file(config_fqfn=self.config_fqfn)
+        self.config_man.add_iterable({'name': 'worker'}, name='args')
+
+    def teardown_method(self, method):
+        shutil.rmtree(self.temp_dir)
+
+    def test_round_trip(self):
+        snapshot = mod.ConfigSnapshot.from_bytes(self.config_man.export_snapshot().to_bytes())
+        assert snapshot.name == 'worker'
+        assert snapshot.db.host == 'localhost'
+        assert snapshot.db.ports == [1, 2]
+        assert snapshot.get_source('name') == 'args'
+        assert snapshot.checksum == self.config_man.export_snapshot().checksum
+
+    def test_from_snapshot(self):
+        snapshot_fqfn = os.path.join(self.temp_dir, 'config.snapshot')
+        self.config_man.export_snapshot().save(snapshot_fqfn)
+        worker_config = mod.ConfigManager.from_snapshot(mod.ConfigSnapshot.load(snapshot_fqfn))
+        assert worker_config.name == 'worker'
+        assert worker_config.db.host == 'localhost'
+        assert worker_config.get_source('db.host') == 'file:%s' % self.config_fqfn
+        assert worker_config.get_layers() == [('snapshot', 1)]
+
+    def test_corrupt_snapshot(self):
+        data = bytearray(self.config_man.export_snapshot().to_bytes())
+        data[-3] ^= 0xff
+        with pytest.raises(ValueError):
+            mod.ConfigSnapshot.from_bytes(bytes(data))
+        with pytest.raises(ValueError):
+            mod.ConfigSnapshot.from_bytes(b'garbage')
+
+    def test_verify_sources(self):
+        snapshot = self.config_man.export_snapshot()
+        assert snapshot.verify_sources()
+        with open(self.config_fqfn, 'a') as outfile:
+            outfile.write('extra: 1\n')
+        assert not snapshot.verify_sources()
+
+    def test_invalid_config_is_not_exported(self):
+        config_man = mod.ConfigManager(config_schema={'type': 'object',
+                                                      'properties': {'name': {'type': 'integer'}}})
+        config_man.add_iterable({'name': 'app'})
+        with pytest.raises(ValueError):
+            config_man.export_snapshot()
+
+
+
+class Test_add_files(object):
+
+    def setup_method(self, method):
+        self.temp_dir = tempfile.mkdtemp()
+        self.conf_dir = os.path.join(self.temp_dir, 'conf.d')
+        os.mkdir(self.conf_dir)
+        self.server_fqfn = self.write_config('server.yml', {'host': 'server', 'port': 1, 'db': {'size': 5}})
+        self.app_fqfn    = self.write_config('app.yml', {'port': 2, 'db': {'timeout': 30}})
+        self.write_config('conf.d/20-second.yml', {'db': {'size': 20}})
+        self.write_config('conf.d/10-first.yaml', {'db': {'size': 10}, 'name': 'first'})
+        self.write_config('conf.d/notes.txt', {'name': 'ignored'})
+        mod.parse_cache.clear()
+
+    def teardown_method(self, method):
+        shutil.rmtree(self.temp_dir)
+
+    def write_config(self, fn, config):
+        fqfn = os.path.join(self.temp_dir, fn)
+        with open(fqfn, 'w') as outfile:
+            outfile.write(yaml.dump(config, default_flow_style=False))
+        return fqfn
+
+    def test_files_and_dir_in_order(self):
+        config_man = mod.ConfigManager()
+        fqfns = config_man.add_files([self.server_fqfn, self.app_fqfn, self.conf_dir])
+        assert [os.path.basename(x) for x in fqfns] == ['server.yml', 'app.yml',
+                                                        '10-first.yaml', '20-second.yml']
+        assert config_man.cm_config == {'host': 'server', 'port': 2, 'name': 'first',
+                                        'db': {'size': 20, 'timeout': 30}}
+        assert config_man.get_source('db.size') == 'file:%s' % fqfns[-1]
+        assert config_man.cm_config_fqfns == fqfns
+
+    def test_glob(self):
+        config_man = mod.ConfigManager()
+        config_man.add_files([os.path.join(self.temp_dir, '*.yml'),
+                              os.path.join(self.temp_dir, 'nothing*.yml')])
+        assert config_man.port == 1   # app.yml sorts before server.yml
+
+    def test_missing_file(self):
+        config_man = mod.ConfigManager()
+        with pytest.raises(IOError):
+            config_man.add_files([os.path.join(self.temp_dir, 'missing.yml')])
+
+    def test_parallel_parse(self):
+        config_man = mod.ConfigManager()
+        config_man.add_files([self.server_fqfn, self.app_fqfn, self.conf_dir],
+                             parallel_min_bytes=0, processes=2)
+        assert config_man.cm_config['db'] == {'size': 20, 'timeout': 30}
+        assert len(mod.parse_cache.entries) == 4
+
+    def test_small_files_are_parsed_in_process(self):
+        orig_map = mod._map_in_processes
+        mod._map_in_processes = lambda *args: pytest.fail('pool used for small files')
+        try:
+            config_man = mod.ConfigManager()
+            config_man.add_files([self.server_fqfn, self.app_fqfn, self.conf_dir])
+            assert config_man.cm_config['db'] == {'size': 20, 'timeout': 30}
+        finally:
+            mod._map_in_processes = orig_map
+
+    def test_executor(self):
+        mapped = []
+        class Executor(object):
+            def map(self, func, arg_list):
+                mapped.extend(args[0] for args in arg_list)
+                return [func(args) for args in arg_list]
+        config_man = mod.ConfigManager()
+        config_man.add_files([self.server_fqfn, self.app_fqfn, self.conf_dir],
+                             executor=Executor())
+        assert config_man.cm_config['db'] == {'size': 20, 'timeout': 30}
+        assert len(mapped) == 4
+
+    def test_reload_never_uses_a_pool(self):
+        config_man = mod.ConfigManager()
+        config_man.add_files([self.server_fqfn, self.app_fqfn, self.conf_dir],
+                             parallel_min_bytes=0)
+        self.write_config('app.yml', {'port': 3})
+        mod.parse_cache.clear()
+        orig_map = mod._map_in_processes
+        mod._map_in_processes = lambda *args: pytest.fail('pool used by reload')
+        try:
+            assert config_man.reload()
+        finally:
+            mod._map_in_processes = orig_map
+        assert config_man.port == 3
+
+    def test_only_changed_file_is_reparsed(self):
+        config_man = mod.ConfigManager()
+        config_man.add_files([self.server_fqfn, self.app_fqfn, self.conf_dir])
+        parsed = []
+        orig_parse = mod._parse_yaml
+        mod._parse_yaml = lambda raw: parsed.append(raw) or orig_parse(raw)
+        try:
+            self.write_config('app.yml', {'port': 3, 'db': {'timeout': 99}})
+            os.utime(self.app_fqfn, (0, 0))
+            assert config_man.reload_if_changed()
+        finally:
+            mod._parse_yaml = orig_parse
+        assert len(parsed) == 1
+        assert config_man.port == 3
+
+    def test_new_file_in_dir_is_reloaded(self):
+        config_man = mod.ConfigManager()
+        config_man.add_files([self.server_fqfn, self.conf_dir])
+        self.write_config('conf.d/30-third.yml', {'name': 'third'})
+        os.utime(self.conf_dir, (0, 0))
+        assert config_man.reload_if_changed()
+        assert config_man.name == 'third'
+
+
+
+class Test_immutable_versions(object):
+
+    def setup_method(self, method):
+        self.config_man = mod.ConfigManager()
+        self.config_man.add_defaults({'db': {'host': 'localhost', 'port': 5432}})
+        self.config_man.add_iterable({'tags': ['a', 'b']})
+
+    def test_config_is_read_only(self):
+        config = self.config_man.cm_config
+        with pytest.raises(TypeError):
+            config['new'] = 1
+        with pytest.raises(TypeError):
+            config['db']['port'] = 1
+        with pytest.raises(TypeError):
+            config['tags'].append('c')
+        assert config['tags'] == ['a', 'b']
+        assert config == {'db': {'host': 'localhost', 'port': 5432}, 'tags': ['a', 'b']}
+
+    def test_frozen_config_pickles(self):
+        config = self.config_man.cm_config
+        assert pickle.loads(pickle.dumps(config, 2)) == config
+        assert type(pickle.loads(pickle.dumps(config))['db']) is mod.FrozenDict
+
+    def test_pinned_view(self):
+        view = self.config_man.get_view()
+        self.config_man.add_iterable({'db': {'host': 'remote', 'port': 6543}})
+        assert (view.db.host, view.db.port) == ('localhost', 5432)
+        assert (self.config_man.db.host, self.config_man.db.port) == ('remote', 6543)
+
+    def test_new_version_per_change(self):
+        config = self.config_man.cm_config
+        assert self.config_man.cm_config is config
+        self.config_man.add_iterable({'name': 'app'})
+        assert self.config_man.cm_config is not config
+        assert 'name' not in config
+
+    def test_concurrent_readers(self):
+        errors = []
+        def reader():
+            for i in range(2000):
+                view = self.config_man.get_view()
+                if view.db.host != 'host-%d' % view.db.port and view.db.port != 5432:
+                    errors.append((view.db.host, view.db.port))
+        threads = [threading.Thread(target=reader) for i in range(4)]
+        for thread in threads:
+            thread.start()
+        for i in range(200):
+            self.config_man.add_iterable({'db': {'host': 'host-%d' % i, 'port': i}}, name='args')
+        for thread in threads:
+            thread.join()
+        assert errors == []
+
+
+
+class Test_diff(object):
+
+    def setup_method(self, method):
+        self.temp_dir = tempfile.mkdtemp()
+        self.schema   = {'type': 'object',
+                         'properties': {'name': {'type': 'string'},
+                                        'db':   {'type': 'object',
+                                                 'properties': {'host': {'type': 'string'},
+                                                                'port': {'type': 'integer'}}}}}
+        self.base_fqfn = self.write_config('base.yml', {'name': 'app', 'db': {'host': 'a', 'port': 1}})
+        self.app_fqfn  = self.write_config('app.yml', {'db': {'port': 2}})
+        self.new_fqfn  = self.write_config('new.yml', {'db': {'port': 'x'}, 'extra': True})
+        self.config_man = mod.ConfigManager(self.schema)
+        self.config_man.add_files([self.base_fqfn, self.app_fqfn])
+
+    def teardown_method(self, method):
+        shutil.rmtree(self.temp_dir)
+
+    def write_config(self, fn, config):
+        fqfn = os.path.join(self.temp_dir, fn)
+        with open(fqfn, 'w') as outfile:
+            outfile.write(yaml.dump(config, default_flow_style=False))
+        return fqfn
+
+    def test_no_changes(self):
+        config_diff = self.config_man.diff(self.config_man.rebuild())
+        assert len(config_diff) == 0
+        assert config_diff.is_valid()
+
+    def test_changes_through_same_layering(self):
+        candidate   = self.config_man.rebuild({self.app_fqfn: self.new_fqfn})
+        config_diff = self.config_man.diff(candidate)
+        changes     = dict((change.key, change) for change in config_diff)
+        assert sorted(changes) == ['db.port', 'extra']
+        assert changes['extra'].kind == 'added'
+        assert changes['db.port'].kind == 'changed'
+        assert (changes['db.port'].old, changes['db.port'].new) == (2, 'x')
+        assert changes['db.port'].old_source == 'file:%s' % self.app_fqfn
+        assert changes['db.port'].new_source == 'file:%s' % self.new_fqfn
+        assert not config_diff.is_valid()
+        assert config_diff.get_invalid_changes() == [changes['db.port']]
+
+    def test_removed(self):
+        other = mod.ConfigManager(self.schema)
+        other.add_iterable({'db': {'host': 'a', 'port': 2}})
+        config_diff = self.config_man.diff(other)
+        assert [(change.key, change.kind) for change in config_diff] == [('name', 'removed')]
+        assert len(config_diff.get_invalid_changes()) == 1
+
+    def test_cli(self):
+        schema_fqfn = self.write_config('schema.yml', self.schema)
+        script = os.path.join(dirname(dirname(dirname(os.path.abspath(__file__)))),
+                              'scripts', 'cletus_config_diff.py')
+        env = dict(os.environ, PYTHONPATH=dirname(dirname(dirname(os.path.abspath(__file__)))))
+        proc = subprocess.Popen([sys.executable, script, '--schema', schema_fqfn, '--json',
+                                 '--old', self.base_fqfn, self.app_fqfn,
+                                 '--new', self.base_fqfn, self.new_fqfn],
+                                stdout=subprocess.PIPE, env=env)
+        output = proc.communicate()[0]
+        assert proc.returncode == 1
+        result = json.loads(output.decode('utf-8'))
+        assert [change['key'] for change in result['changes']] == ['db.port', 'extra']
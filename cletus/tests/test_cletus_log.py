@@ -15,6 +15,10 @@ import shutil
 import tempfile
 import pytest
 import fileinput
+import logging
+import pstats
+import socket
+import threading
 from os.path import dirname
 
 sys.path.insert(0, dirname(dirname(dirname(os.path.abspath(__file__)))))
@@ -60,3 +64,449 @@ class TestBasicLog(object):
 
 
 
+class TestRateLimitFilter(object):
+
+    def setup_method(self, method):
+        self.temp_dir = tempfile.mkdtemp()
+        self.log_fqfn = os.path.join(self.temp_dir, 'test.log')
+
+    def teardown_method(self, method):
+        shutil.rmtree(self.temp_dir)
+
+    def get_log_msgs(self):
+        with open(self.log_fqfn) as f:
+            return [rec.split(':')[3].strip() for rec in f]
+
+    def test_coalesce_repeated_msgs(self):
+        log_mgr = mod.LogManager(log_dir=self.temp_dir,
+                                 log_fn='test.log',
+                                 log_name='test_coalesce',
+                                 log_to_console=False,
+                                 coalesce=True)
+        logger  = log_mgr.logger
+        logger.setLevel('DEBUG')
+        for i in range(100):
+            logger.warning('sleeping - waiting for lock')
+        logger.info('lock acquired')
+
+        assert self.get_log_msgs() == ['sleeping - waiting for lock',
+                                       'previous message repeated 99 times',
+                                       'lock acquired']
+
+    def test_coalesce_flush(self):
+        log_mgr = mod.LogManager(log_dir=self.temp_dir,
+                                 log_fn='test.log',
+                                 log_name='test_coalesce_flush',
+                                 log_to_console=False,
+                                 coalesce=True)
+        logger  = log_mgr.logger
+        logger.setLevel('DEBUG')
+        for i in range(3):
+            logger.info('row %d', 5)
+        log_mgr.rate_filter.flush()
+
+        assert self.get_log_msgs() == ['row 5',
+                                       'previous message repeated 2 times']
+
+    def test_rate_limit_per_call_site(self):
+        log_mgr = mod.LogManager(log_dir=self.temp_dir,
+                                 log_fn='test.log',
+                                 log_name='test_rate_limit',
+                                 log_to_console=False,
+                                 rate_limit=5)
+        logger  = log_mgr.logger
+        logger.setLevel('DEBUG')
+        for i in range(20):
+            logger.info('row %d', i)
+        logger.info('different call site')
+        log_mgr.rate_filter.flush()
+
+        msgs = self.get_log_msgs()
+        assert msgs[:6] == ['row 0', 'row 1', 'row 2', 'row 3', 'row 4',
+                            'different call site']
+        assert msgs[6].startswith('15 messages suppressed from test_cletus_log.py')
+        assert len(msgs) == 7
+
+    def test_child_logger_is_filtered(self):
+        log_mgr = mod.LogManager(log_dir=self.temp_dir,
+                                 log_fn='test.log',
+                                 log_name='test_child',
+                                 log_to_console=False,
+                                 coalesce=True)
+        log_mgr.logger.setLevel('DEBUG')
+        child   = logging.getLogger('test_child.cletus_job')
+        for i in range(10):
+            child.warning('sleeping - waiting for lock')
+        log_mgr.logger.info('done')
+
+        assert self.get_log_msgs() == ['sleeping - waiting for lock',
+                                       'previous message repeated 9 times',
+                                       'done']
+
+
+
+class TestLazyLog(object):
+
+    def setup_method(self, method):
+        self.temp_dir = tempfile.mkdtemp()
+        self.log_dir  = os.path.join(self.temp_dir, 'logs')
+        self.orig_excepthook = sys.excepthook
+
+    def teardown_method(self, method):
+        sys.excepthook = self.orig_excepthook
+        shutil.rmtree(self.temp_dir)
+
+    def test_nothing_created_until_first_record(self):
+        log_mgr = mod.LogManager(log_dir=self.log_dir,
+                                 log_fn='test.log',
+                                 log_name='test_lazy',
+                                 log_to_console=False,
+                                 lazy=True)
+        logger  = log_mgr.logger
+        logger.setLevel('INFO')
+        logger.debug('below the effective level')
+        assert not os.path.exists(self.log_dir)
+        assert log_mgr.handlers == []
+
+        logger.info('Test1')
+        logger.info('Test2')
+        with open(os.path.join(self.log_dir, 'test.log')) as f:
+            msgs = [rec.split(':')[3].strip() for rec in f]
+        assert msgs == ['Test1', 'Test2']
+        assert logger.handlers == log_mgr.handlers
+
+    def test_excepthook_not_installed(self):
+        mod.LogManager(log_dir=self.log_dir,
+                       log_name='test_no_hook',
+                       log_to_console=False,
+                       lazy=True,
+                       excepthook=False)
+        assert sys.excepthook is self.orig_excepthook
+
+    def test_chained_excepthook(self):
+        calls = []
+        sys.excepthook = lambda *args: calls.append(args)
+        log_mgr = mod.LogManager(log_dir=self.log_dir,
+                                 log_name='test_chained_hook',
+                                 log_to_console=False,
+                                 lazy=True,
+                                 chain_excepthook=True)
+        try:
+            raise ValueError('boom')
+        except ValueError:
+            exc_info = sys.exc_info()
+        with pytest.raises(SystemExit):
+            sys.excepthook(*exc_info)
+        assert calls == [exc_info]
+        assert os.path.exists(os.path.join(self.log_dir, 'main.log'))
+
+
+class TestSpanTimer(object):
+
+    def setup_method(self, method):
+        self.temp_dir = tempfile.mkdtemp()
+        self.log_fqfn = os.path.join(self.temp_dir, 'test.log')
+
+    def teardown_method(self, method):
+        shutil.rmtree(self.temp_dir)
+
+    def get_log_msgs(self):
+        with open(self.log_fqfn) as f:
+            return [rec.split(' : ', 3)[3].strip() for rec in f]
+
+    def test_span_and_decorator(self):
+        log_mgr = mod.LogManager(log_dir=self.temp_dir,
+                                 log_fn='test.log',
+                                 log_name='test_timing',
+                                 log_to_console=False,
+                                 timing=True)
+        log_mgr.logger.setLevel('DEBUG')
+        timer   = log_mgr.timer
+
+        @timer.timed()
+        def work():
+            return sum(range(1000))
+
+        for i in range(3):
+            with timer.span('outer'):
+                assert work() == 499500
+
+        assert timer.stats['outer'][0] == 3
+        assert timer.stats['work'][0]  == 3
+        assert timer.stats['outer'][1] >= timer.stats['work'][1]
+
+        timer.log_summary()
+        msgs = self.get_log_msgs()
+        assert len(msgs) == 2
+        assert msgs[0].startswith('timing: outer - count: 3, wall: ')
+        assert msgs[1].startswith('timing: work - count: 3, wall: ')
+
+    def test_periodic_summary(self):
+        log_mgr = mod.LogManager(log_dir=self.temp_dir,
+                                 log_fn='test.log',
+                                 log_name='test_timing_interval',
+                                 log_to_console=False,
+                                 timing=True,
+                                 timing_interval=0)
+        log_mgr.logger.setLevel('DEBUG')
+        with log_mgr.timer.span('step'):
+            pass
+        assert self.get_log_msgs()[0].startswith('timing: step - count: 1')
+
+    def test_disabled(self):
+        log_mgr = mod.LogManager(log_dir=self.temp_dir,
+                                 log_fn='test.log',
+                                 log_name='test_timing_disabled',
+                                 log_to_console=False)
+        timer   = log_mgr.timer
+
+        def work():
+            pass
+        assert timer.timed()(work) is work
+        with timer.span('step'):
+            pass
+        assert timer.stats == {}
+
+    def test_profiler(self):
+        log_mgr = mod.LogManager(log_dir=self.temp_dir,
+                                 log_fn='test.log',
+                                 log_name='test_timing_profiler',
+                                 log_to_console=False,
+                                 timing=True,
+                                 timing_profiler=True)
+        timer   = log_mgr.timer
+
+        def work():
+            return sorted(range(100), reverse=True)
+
+        with timer.span('outer'):
+            with timer.span('inner'):
+                work()
+        prof_fqfn = os.path.join(self.temp_dir, 'timing.prof')
+        timer.profiler.dump_stats(prof_fqfn)
+        stats = pstats.Stats(prof_fqfn)
+        assert any(func[2] == 'work' for func in stats.stats)
+
+    def test_profiler_ignores_other_threads(self):
+        log_mgr = mod.LogManager(log_dir=self.temp_dir,
+                                 log_fn='test.log',
+                                 log_name='test_timing_profiler_threads',
+                                 log_to_console=False,
+                                 timing=True,
+                                 timing_profiler=True)
+        timer   = log_mgr.timer
+
+        def main_work():
+            return sorted(range(100))
+
+        def thread_work():
+            return sorted(range(100), reverse=True)
+
+        started = threading.Event()
+        proceed = threading.Event()
+
+        def in_thread():
+            with timer.span('thread'):
+                started.set()
+                proceed.wait()
+                thread_work()
+
+        # the thread's span is already open when the main thread's starts:
+        thread = threading.Thread(target=in_thread)
+        thread.start()
+        started.wait()
+        with timer.span('main'):
+            main_work()
+            proceed.set()
+            thread.join()
+        assert timer._profile_depth == 0
+        assert set(timer.stats) == set(['main', 'thread'])
+        prof_fqfn = os.path.join(self.temp_dir, 'timing.prof')
+        timer.profiler.dump_stats(prof_fqfn)
+        names = set(func[2] for func in pstats.Stats(prof_fqfn).stats)
+        assert 'main_work' in names
+        assert 'thread_work' not in names
+
+
+class TestDebugBuffer(object):
+
+    def setup_method(self, method):
+        self.temp_dir = tempfile.mkdtemp()
+        self.log_fqfn = os.path.join(self.temp_dir, 'test.log')
+        self.orig_excepthook = sys.excepthook
+
+    def teardown_method(self, method):
+        sys.excepthook = self.orig_excepthook
+        shutil.rmtree(self.temp_dir)
+
+    def get_log_recs(self):
+        if not os.path.exists(self.log_fqfn):
+            return []
+        with open(self.log_fqfn) as f:
+            return [(rec.split(':')[2].strip(), rec.split(':')[3].strip())
+                    for rec in f if rec.count(':') >= 3]
+
+    def test_dump_on_error(self):
+        log_mgr = mod.LogManager(log_dir=self.temp_dir,
+                                 log_fn='test.log',
+                                 log_name='test_debug_buffer',
+                                 log_to_console=False,
+                                 debug_buffer=3)
+        log_mgr.set_level('info')
+        logger  = log_mgr.logger
+        for i in range(5):
+            logger.debug('row %d', i)
+        logger.info('Test1')
+        assert self.get_log_recs() == [('INFO', 'Test1')]
+
+        logger.error('Failed')
+        assert self.get_log_recs() == [('INFO',  'Test1'),
+                                       ('DEBUG', 'debug buffer - writing the prior 3 records'),
+                                       ('DEBUG', 'row 2'),
+                                       ('DEBUG', 'row 3'),
+                                       ('DEBUG', 'row 4'),
+                                       ('ERROR', 'Failed')]
+        assert len(log_mgr.debug_ring.buffer) == 0
+
+    def test_level_set_on_the_logger(self):
+        log_mgr = mod.LogManager(log_dir=self.temp_dir,
+                                 log_fn='test.log',
+                                 log_name='test_debug_buffer_set_level',
+                                 log_to_console=False,
+                                 debug_buffer=3)
+        logger  = log_mgr.logger
+        logger.setLevel(logging.INFO)
+        logger.info('Test1')
+        logger.debug('context')
+        logger.error('Failed')
+        assert self.get_log_recs() == [('INFO',  'Test1'),
+                                       ('DEBUG', 'debug buffer - writing the prior 1 records'),
+                                       ('DEBUG', 'context'),
+                                       ('ERROR', 'Failed')]
+
+    def test_replayed_records_skip_rate_limiting(self):
+        log_mgr = mod.LogManager(log_dir=self.temp_dir,
+                                 log_fn='test.log',
+                                 log_name='test_debug_buffer_rate_limit',
+                                 log_to_console=False,
+                                 coalesce=True,
+                                 rate_limit=1,
+                                 debug_buffer=5)
+        log_mgr.set_level('info')
+        logger  = log_mgr.logger
+        for i in range(3):
+            logger.debug('same')
+        logger.error('Failed')
+        assert self.get_log_recs() == [('DEBUG', 'debug buffer - writing the prior 3 records'),
+                                       ('DEBUG', 'same'),
+                                       ('DEBUG', 'same'),
+                                       ('DEBUG', 'same'),
+                                       ('ERROR', 'Failed')]
+
+    def test_dump_on_excepthook_when_lazy(self):
+        log_mgr = mod.LogManager(log_dir=self.temp_dir,
+                                 log_fn='test.log',
+                                 log_name='test_debug_buffer_lazy',
+                                 log_to_console=False,
+                                 lazy=True,
+                                 debug_buffer=10)
+        log_mgr.set_level('INFO')
+        log_mgr.logger.debug('context')
+        assert log_mgr.handlers == []
+
+        try:
+            raise ValueError('boom')
+        except ValueError:
+            exc_info = sys.exc_info()
+        with pytest.raises(SystemExit):
+            sys.excepthook(*exc_info)
+        recs = self.get_log_recs()
+        assert recs[1] == ('DEBUG', 'context')
+        assert recs[2][0] == 'CRITICAL'
+
+
+class TestForwarding(object):
+
+    def setup_method(self, method):
+        self.temp_dir  = tempfile.mkdtemp()
+        self.log_fqfn  = os.path.join(self.temp_dir, 'test.log')
+        self.sock_fqfn = os.path.join(self.temp_dir, 'collector.sock')
+        self.collector = None
+
+    def teardown_method(self, method):
+        if self.collector:
+            self.collector.close()
+        shutil.rmtree(self.temp_dir)
+
+    def start_collector(self, family=socket.AF_UNIX):
+        """ Stands in for a local log collector such as rsyslog.
+        """
+        self.collector = socket.socket(family, socket.SOCK_DGRAM)
+        if family == socket.AF_UNIX:
+            self.collector.bind(self.sock_fqfn)
+        else:
+            self.collector.bind(('127.0.0.1', 0))
+        self.collector.settimeout(2)
+        return self.collector.getsockname()
+
+    def receive(self):
+        return self.collector.recv(65536).decode('utf-8').split('\n')
+
+    def test_batched_over_unix_socket(self):
+        address = self.start_collector()
+        log_mgr = mod.LogManager(log_dir=self.temp_dir,
+                                 log_fn='test.log',
+                                 log_name='test_forward_unix',
+                                 log_to_console=False,
+                                 forward_to=address,
+                                 forward_batch=3)
+        logger  = log_mgr.logger
+        logger.setLevel('DEBUG')
+        for i in range(3):
+            logger.info('row %d', i)
+        msgs = self.receive()
+        assert [msg.split(':')[3].strip() for msg in msgs] == ['row 0', 'row 1', 'row 2']
+        assert not os.path.exists(self.log_fqfn)
+
+    def test_syslog_over_udp(self):
+        address = self.start_collector(socket.AF_INET)
+        log_mgr = mod.LogManager(log_dir=self.temp_dir,
+                                 log_fn='test.log',
+                                 log_name='test_forward_udp',
+                                 log_to_console=False,
+                                 forward_to=address,
+                                 syslog_facility='user')
+        logger  = log_mgr.logger
+        logger.setLevel('DEBUG')
+        logger.info('Test1')
+        logger.error('Failed')
+        assert self.receive()[0].startswith('<14>')
+        assert self.receive()[0].startswith('<11>')
+
+    def test_flush_interval(self):
+        address = self.start_collector()
+        log_mgr = mod.LogManager(log_dir=self.temp_dir,
+                                 log_fn='test.log',
+                                 log_name='test_forward_interval',
+                                 log_to_console=False,
+                                 forward_to=address,
+                                 forward_interval=0.1)
+        log_mgr.logger.setLevel('DEBUG')
+        log_mgr.logger.info('Test1')
+        assert self.receive()[0].endswith('Test1')
+
+    def test_fallback_when_collector_down(self):
+        log_mgr = mod.LogManager(log_dir=self.temp_dir,
+                                 log_fn='test.log',
+                                 log_name='test_forward_down',
+                                 log_to_console=False,
+                                 forward_to=self.sock_fqfn)
+        logger  = log_mgr.logger
+        logger.setLevel('DEBUG')
+        start_time = time.time()
+        logger.info('Test1')
+        logger.error('Failed')
+        assert time.time() - start_time < 1
+        with open(self.log_fqfn) as f:
+            msgs = [rec.split(':')[3].strip() for rec in f]
+        assert msgs == ['Test1', 'Failed']
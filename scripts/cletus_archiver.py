@@ -32,17 +32,64 @@
     Copyright 2013, 2014 Ken Farmer
 """
 from __future__ import absolute_import
+from __future__ import print_function
 
 #--------------------------------------------------------------
 
 
 import sys
-import glob
 import os
+import re
+import stat
 import time
+import json
+import random
+import ctypes
+import platform
+import traceback
+import fnmatch
+import sqlite3
+import gzip
+import bz2
+import zlib
+import tarfile
+import itertools
+import tempfile
+import threading
 import argparse
-
-import envoy
+import multiprocessing
+import multiprocessing.pool
+import appdirs
+try:
+    import queue
+except ImportError:                     # python 2
+    import Queue as queue
+try:
+    import lzma
+except ImportError:                     # python 2
+    try:
+        from backports import lzma
+    except ImportError:
+        lzma = None
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+try:
+    import lz4.frame as lz4_frame
+except ImportError:
+    lz4_frame = None
+try:
+    _perf_counter = time.perf_counter
+except AttributeError:                  # python 2
+    _perf_counter = time.time
+try:
+    from os import scandir
+except ImportError:                     # python 2
+    try:
+        from scandir import scandir
+    except ImportError:
+        scandir = None
 
 # only here to allow running out of dev
 sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
@@ -52,9 +99,16 @@ import cletus.cletus_supp   as supp
 import cletus.cletus_config as conf
 
 
-logger    = None
-MAX_FILES = 55
-APP_NAME  = 'cletus_archiver'
+logger     = None
+log_man    = None
+MAX_FILES  = 55
+APP_NAME   = 'cletus_archiver'
+CHUNK_SIZE = 1024 * 1024
+FAILED_RETRY_SECONDS = 86400
+BUNDLE_BLOCK_SIZE    = 1024 * 1024
+BUNDLE_INDEX_SUFFIX  = '.idx'
+BUNDLE_WINDOWS       = {'dir': None, 'hour': '%Y%m%dT%H', 'day': '%Y%m%d'}
+O_NOATIME            = getattr(os, 'O_NOATIME', 0)      # linux only
 
 
 
@@ -68,14 +122,19 @@ def main():
     logger.info('cletus_archiver - starting')
 
     config     = setup_config(args)
-    logger.setLevel(config.log_level or 'DEBUG')
+    log_man.set_level(config.log_level or 'DEBUG')
+
+    if config.plan:
+        for line in plan_all_the_files(config).format():
+            print(line)
+        return 0
 
     jobcheck   = exit_if_already_running()
 
-    exit_if_suppressed()
+    suppcheck  = exit_if_suppressed()
 
     # run the process:
-    process_all_the_files()
+    process_all_the_files(config, suppcheck)
 
     # housekeeping
     jobcheck.close()
@@ -84,47 +143,1619 @@ def main():
 
 
 
-def process_all_the_files():
+def process_all_the_files(config, suppcheck=None):
+    """ Compresses the selected files in batches of config.batch_size.
+        After each batch the scan position is saved to the checkpoint, then
+        the run stops early if it has been suppressed or has used up its
+        time budget - and the next run picks up from the checkpoint.
 
-    file_compressor = FileCompressor()
+        Files to bundle are held back until their dir has been scanned, so
+        that a dir gets one bundle per window however many batches it
+        spans.  If the run stops within a dir its held files are left for
+        the next run, which rescans that dir.
+    """
 
-    for i, fn in enumerate(glob.glob('/tmp/*')):
+    lower_priority(config.nice, config.ioprio_class, config.ioprio_level)
+    throttle = None
+    if config.read_mbps or config.write_mbps or config.max_iops:
+        throttle = Throttle(read_bps=config.read_mbps and config.read_mbps * 1048576,
+                            write_bps=config.write_mbps and config.write_mbps * 1048576,
+                            iops=config.max_iops)
+    file_compressor = FileCompressor(workers=config.compress_workers,
+                                     use_processes=config.compress_processes,
+                                     compress_level=config.compress_level,
+                                     throttle=throttle,
+                                     adaptive=config.adaptive_workers)
+
+    index = None
+    if config.state_index:
+        index = StateIndex(config.state_index_fqfn
+                           or os.path.join(appdirs.user_cache_dir(APP_NAME), 'state_index.sqlite'))
+
+    policies   = get_policies(config)
+    checkpoint = None
+    resume     = None
+    if config.checkpoint:
+        checkpoint = Checkpoint(config.checkpoint_fqfn
+                                or os.path.join(appdirs.user_cache_dir(APP_NAME), 'checkpoint.json'))
+        resume = checkpoint.load(FileScanner(policies).get_fingerprint())
+        if resume:
+            logger.info('resuming from checkpoint with %d dirs to scan' % len(resume['dirs']))
+
+    scanner = FileScanner(policies,
+                          max_files=config.max_files,
+                          max_bytes=config.max_bytes,
+                          index=index,
+                          resume=resume)
+    tuner = AutoTuner(min_mbps=config.auto_min_mbps,
+                      max_ratio=config.auto_max_ratio,
+                      sample_bytes=int(config.auto_sample_mb * 1024 * 1024))
+    bundler = Bundler()
+    items   = scanner.scan()
+
+    start_time = time.time()
+    file_compressor.open()
+    try:
+        while True:
+            batch = list(itertools.islice(items, config.batch_size))
+            tasks = []
+            for entry, policy in batch:
+                task = get_task(entry, policy, tuner)
+                if policy.bundles(entry.stat(follow_symlinks=False)):
+                    bundler.add(entry, policy, task[1], task[2])
+                else:
+                    tasks.append(task)
+            # the dir being scanned may have more files for its bundles:
+            open_dir = scanner.current[0] if batch and scanner.current else None
+            bundle_tasks, single_tasks = bundler.get_tasks(open_dir)
+            for archive_fqfn, fns, in_bytes, out_bytes, error in file_compressor.bundle_all(bundle_tasks):
+                if error:
+                    logger.error('%s bundling failed: %s' % (archive_fqfn, error))
+                else:
+                    logger.debug('%-20.20s - bundled %d files of %d bytes to %d'
+                                 % (abbreviate(archive_fqfn), len(fns), in_bytes, out_bytes))
+                if index:
+                    for fn in fns:
+                        index.record_result(fn, error)
+            for fn, in_bytes, out_bytes, error in file_compressor.compress_all(tasks + single_tasks):
+                if error:
+                    logger.error('%s compression failed: %s' % (fn, error))
+                else:
+                    logger.debug('%-20.20s - compressed %d bytes to %d' % (abbreviate(fn), in_bytes, out_bytes))
+                if index:
+                    index.record_result(fn, error)
+            if not batch:
+                break
+            if checkpoint:
+                checkpoint.save(scanner.get_checkpoint())
+            stop_reason = get_stop_reason(suppcheck, start_time, config.time_budget_minutes)
+            if stop_reason:
+                logger.warning('%s - stopping until the next run' % stop_reason)
+                break
+        if checkpoint:
+            if scanner.is_complete():
+                checkpoint.clear()
+            else:
+                checkpoint.save(scanner.get_checkpoint())
+    finally:
+        file_compressor.close()
+        if index:
+            index.close()
+    scanner.log_counts()
+    file_compressor.log_throughput()
 
-        if i > MAX_FILES:
-            logger.warning('max files exceeded - stopping now')
-            break
 
-        file_time_epoch, file_time_string = get_file_times(fn)
 
-        if (time.time() - file_time_epoch) > (86400 * 3):
+def plan_all_the_files(config):
+    """ Scans & applies the policies just like a run - but without the
+        state index, checkpoint or budgets - and returns a Plan estimating
+        the whole job.  Nothing is modified.
+    """
+    scanner = FileScanner(get_policies(config))
+    tuner   = AutoTuner(min_mbps=config.auto_min_mbps,
+                        max_ratio=config.auto_max_ratio,
+                        sample_bytes=int(config.auto_sample_mb * 1024 * 1024))
+    plan    = Plan(workers=config.compress_workers,
+                   sample_files=config.plan_sample_files,
+                   max_files=config.max_files)
+    start_time = time.time()
+    for entry, policy in scanner.scan():
+        fn, codec_name, level = get_task(entry, policy, tuner)
+        plan.add(fn, entry.stat(follow_symlinks=False).st_size, policy.name, codec_name, level)
+    plan.scan_seconds = time.time() - start_time
+    plan.estimate()
+    return plan
+
+
+
+def get_stop_reason(suppcheck, start_time, time_budget_minutes):
+    """ Returns why the run should stop between batches - or None.
+    """
+    if suppcheck is not None and suppcheck.suppressed():
+        return 'Pgm has been suppressed'
+    if (time_budget_minutes is not None
+            and time.time() - start_time >= time_budget_minutes * 60):
+        return 'time budget of %s minutes used up' % time_budget_minutes
+    return None
+
+
+
+def get_task(entry, policy, tuner):
+    """ Returns the (fn, codec, level) to compress the entry with.
+    """
+    if policy.codec == 'auto':
+        codec_name, level = tuner.choose(entry.path,
+                                         key=(policy.name, os.path.splitext(entry.name)[1]))
+        return (entry.path, codec_name, level)
+    return (entry.path, policy.codec, policy.compress_level)
+
+
+
+def get_policies(config):
+    """ Returns the list of ArchivePolicies from the config.  Each entry in
+        the policies list can set any of the policy keys - those it doesn't
+        set come from the top-level config keys of the same name.  Without
+        a policies list there's a single policy for the top-level dir.
+    """
+    defaults = {'include':        config.include,
+                'exclude':        config.exclude,
+                'extensions':     config.extensions,
+                'min_age_days':   config.min_age_days,
+                'min_size':       config.min_size,
+                'max_size':       config.max_size,
+                'recursive':      config.recursive,
+                'codec':          config.codec,
+                'compress_level': config.compress_level,
+                'bundle_max_size': config.bundle_max_size,
+                'bundle_window':  config.bundle_window}
+    if config.policies:
+        policy_configs = config.policies
+    elif config.dir:
+        policy_configs = [{'name': 'default', 'dirs': [config.dir]}]
+    else:
+        raise ValueError('config requires either dir or policies')
+
+    policies = []
+    for i, policy_config in enumerate(policy_configs):
+        kwargs = dict(defaults)
+        kwargs.update((key, val) for key, val in policy_config.items() if val is not None)
+        kwargs.setdefault('name', 'policy-%d' % (i + 1))
+        extensions = kwargs.pop('extensions')
+        if extensions:
+            kwargs['include'] = list(kwargs['include'] or []) + ['*%s' % ext for ext in extensions]
+        policies.append(ArchivePolicy(**kwargs))
+    return policies
+
+
+
+class ArchivePolicy(object):
+    """ One set of rules for choosing files to compress, and how to compress
+        them.
+
+        Rules are compiled once: include & exclude glob patterns become one
+        regex each, so a policy with many patterns still costs a single
+        match per name.  Files are checked in order of cost - name patterns
+        first, then the size & age from the already-fetched stat.  Files
+        that are already compressed are always excluded.
+
+        Inputs:
+           - name           - used in log messages
+           - dirs           - list of directories to scan
+           - include        - glob patterns (ex: '*.log') - if provided,
+                              only matching file names are selected
+           - exclude        - glob patterns for file names to skip
+           - min_age_days   - files accessed more recently are skipped
+           - min_size       - smaller files (bytes) are skipped
+           - max_size       - larger files (bytes) are skipped
+           - recursive      - if True, subdirectories are scanned too
+           - codec          - compression codec - see CODECS - or 'auto' to
+                              have an AutoTuner pick the codec & level
+           - compress_level - compression level - clamped to the codec's
+                              range.  Defaults to the codec's default.
+           - bundle_max_size - if provided, selected files of this many bytes
+                              or fewer are bundled into tar archives rather
+                              than compressed one by one - see Bundler
+           - bundle_window  - 'dir' bundles a dir's files together, 'hour'
+                              or 'day' also splits them by mtime
+    """
+
+    def __init__(self, name, dirs, include=None, exclude=None, min_age_days=3,
+                 min_size=None, max_size=None, recursive=False, codec='gzip',
+                 compress_level=None, bundle_max_size=None, bundle_window='dir'):
+        if codec not in CODECS and codec != 'auto':
+            raise ValueError('unknown or uninstalled codec: %s' % codec)
+        if bundle_window not in BUNDLE_WINDOWS:
+            raise ValueError('unknown bundle_window: %s' % bundle_window)
+        self.name           = name
+        self.dirs           = list(dirs)
+        self.include        = list(include or [])
+        self.exclude        = list(exclude or [])
+        self.min_age_days   = min_age_days
+        self.min_size       = min_size
+        self.max_size       = max_size
+        self.recursive      = recursive
+        self.codec          = codec
+        self.compress_level = compress_level
+        self.bundle_max_size = bundle_max_size
+        self.bundle_window  = bundle_window
+        self.include_match  = _compile_patterns(include)
+        self.exclude_match  = _compile_patterns(list(exclude or [])
+                                                + ['*%s' % suffix for suffix in COMPRESSED_SUFFIXES]
+                                                + ['bundle-*%s' % BUNDLE_INDEX_SUFFIX])
+
+    def matches_name(self, name):
+        if self.exclude_match(name):
+            return False
+        return self.include_match is None or bool(self.include_match(name))
+
+    def matches_stat(self, stat_result, cutoff):
+        """ cutoff is the latest atime a file can have, given min_age_days.
+        """
+        return self.matches_size(stat_result) and stat_result.st_atime <= cutoff
+
+    def matches_size(self, stat_result):
+        if self.min_size is not None and stat_result.st_size < self.min_size:
+            return False
+        if self.max_size is not None and stat_result.st_size > self.max_size:
+            return False
+        return True
+
+    def bundles(self, stat_result):
+        """ Returns True if a selected file should be bundled.
+        """
+        return self.bundle_max_size is not None and stat_result.st_size <= self.bundle_max_size
+
+    def get_fingerprint(self):
+        """ Returns a string that changes whenever the rules change.
+        """
+        return repr((self.name, self.include, self.exclude, self.min_age_days, self.min_size,
+                     self.max_size, self.recursive, self.codec, self.compress_level))
+
+    def __repr__(self):
+        return 'ArchivePolicy(%r)' % self.name
+
+
+
+def _compile_patterns(patterns):
+    """ Returns the match method of a single regex for all of the glob
+        patterns - or None if there aren't any.
+    """
+    if not patterns:
+        return None
+    return re.compile('|'.join('(?:%s)' % fnmatch.translate(pattern)
+                               for pattern in patterns)).match
 
-            if fn.endswith('.gz'):
-                action = 'skipped'
-            elif not os.path.isfile(fn):
-                action = 'skipped'
-            else:
-                file_compressor.compress(fn)
-                action = 'compressed'
 
+
+class FileScanner(object):
+    """ Streams the files that are due for compression under a list of
+        ArchivePolicies - yielding (DirEntry, policy) tuples.
+
+        Built on scandir, so each entry's type comes from the directory
+        listing and its stat is fetched at most once - and nothing is
+        accumulated, so directories with millions of files are scanned in
+        constant memory.  Each directory is scanned once even if multiple
+        policies cover it: a file goes to the first policy that selects it.
+        Symlinks are never followed.
+
+        Scanning stops once max_files have been selected.  Files that would
+        exceed max_bytes are skipped - smaller ones may still fit.
+
+        With a StateIndex, directories whose mtime & policies haven't changed
+        since they were last fully scanned - and that had no files coming
+        due - aren't listed at all.  And files whose compression failed are
+        not retried until they change or FAILED_RETRY_SECONDS pass.
+
+        get_checkpoint() returns the dirs still to be scanned - including the
+        one in progress - and passing that back as resume starts a later scan
+        from there rather than from the top dirs.
+    """
+
+    def __init__(self, policies, max_files=None, max_bytes=None, index=None, resume=None):
+        self.policies  = policies
+        self.max_files = max_files
+        self.max_bytes = max_bytes
+        self.index     = index
+        self.counts    = {'scanned': 0, 'skipped': 0, 'good': 0, 'over_budget': 0,
+                          'selected': 0, 'selected_bytes': 0, 'unchanged_dirs': 0,
+                          'failed_before': 0}
+        self.current   = None
+        if resume:
+            self.dir_list = [(scan_dir, [policies[i] for i in policy_ids])
+                             for scan_dir, policy_ids in resume['dirs']]
         else:
-            action = 'good'
+            self.dir_list = self._get_top_dirs()
+
+    def _get_top_dirs(self):
+        dir_list = []
+        for policy in reversed(self.policies):
+            for top_dir in reversed(policy.dirs):
+                dir_list.append((os.path.normpath(top_dir), [policy]))
+        # merge the policies of dirs listed more than once, keeping order:
+        merged = {}
+        for top_dir, policies in reversed(dir_list):
+            merged.setdefault(top_dir, []).extend(policies)
+        return [(top_dir, merged.pop(top_dir)) for top_dir, policies in dir_list
+                if top_dir in merged]
+
+    def get_fingerprint(self):
+        return '\n'.join(policy.get_fingerprint() for policy in self.policies)
+
+    def get_checkpoint(self):
+        """ Returns a json-able dict of the dirs still to be scanned.  The dir
+            in progress is rescanned in full on resume - the files already
+            compressed within it are gone by then.
+        """
+        pending = list(self.dir_list)
+        if self.current:
+            pending.append(self.current)
+        return {'fingerprint': self.get_fingerprint(),
+                'dirs':        [[scan_dir, [self.policies.index(policy) for policy in policies]]
+                                for scan_dir, policies in pending]}
+
+    def is_complete(self):
+        return not self.dir_list and self.current is None
+
+    def scan(self):
+        now      = time.time()
+        cutoffs  = dict((id(policy), now - policy.min_age_days * 86400)
+                        for policy in self.policies)
+        dir_list = self.dir_list
+
+        scanned_dirs = set()
+        while dir_list:
+            scan_dir, policies = self.current = dir_list.pop()
+            if scan_dir in scanned_dirs:
+                continue
+            scanned_dirs.add(scan_dir)
+            dir_state = None
+            if self.index:
+                dir_state = self._get_dir_state(scan_dir, policies, now)
+                if dir_state is None:
+                    continue
+                if dir_state['unchanged']:
+                    self.counts['unchanged_dirs'] += 1
+                    recursive_policies = [policy for policy in policies if policy.recursive]
+                    if recursive_policies:
+                        dir_list.extend((sub_dir, recursive_policies)
+                                        for sub_dir in dir_state['sub_dirs'])
+                    continue
+            try:
+                entries = _scandir(scan_dir)
+            except OSError as e:
+                logger.warning('cannot scan %s: %s' % (scan_dir, e))
+                continue
+            try:
+                for item in self._filter(entries, policies, cutoffs, dir_list, dir_state, now):
+                    yield item
+            finally:
+                if hasattr(entries, 'close'):
+                    entries.close()
+            if self._is_budget_spent():
+                logger.warning('max files or bytes reached - stopping now')
+                return
+            if dir_state is not None:
+                self.index.record_dir(scan_dir, dir_state, now)
+        self.current = None
+
+    def _get_dir_state(self, scan_dir, policies, now):
+        """ Returns a dict used to track the scan of the dir for the index -
+            or None if the dir can't be read.
+        """
+        try:
+            dir_mtime = os.stat(scan_dir).st_mtime
+        except OSError as e:
+            logger.warning('cannot scan %s: %s' % (scan_dir, e))
+            return None
+        fingerprint = '\n'.join(policy.get_fingerprint() for policy in policies)
+        prior = self.index.get_dir(scan_dir)
+        if (prior and prior['mtime'] == dir_mtime and prior['fingerprint'] == fingerprint
+                and (prior['next_due'] is None or prior['next_due'] > now)):
+            return {'unchanged': True, 'sub_dirs': prior['sub_dirs']}
+        return {'unchanged':   False,
+                'path':        scan_dir,
+                'mtime':       dir_mtime,
+                'fingerprint': fingerprint,
+                'next_due':    None,
+                'sub_dirs':    [],
+                'files':       [],
+                'known_files': self.index.get_files(scan_dir)}
+
+    def _filter(self, entries, policies, cutoffs, dir_list, dir_state, now):
+        recursive_policies = [policy for policy in policies if policy.recursive]
+        for entry in entries:
+            self.counts['scanned'] += 1
+            if entry.is_dir(follow_symlinks=False):
+                if recursive_policies:
+                    dir_list.append((entry.path, recursive_policies))
+                    if dir_state is not None:
+                        dir_state['sub_dirs'].append(entry.path)
+                continue
+            if not entry.is_file(follow_symlinks=False):
+                self.counts['skipped'] += 1
+                continue
+            name_policies = [policy for policy in policies if policy.matches_name(entry.name)]
+            if not name_policies:
+                self.counts['skipped'] += 1
+                continue
+            try:
+                stat_result = entry.stat(follow_symlinks=False)
+            except OSError:         # removed since the listing
+                self.counts['skipped'] += 1
+                continue
+            if dir_state is not None:
+                known = dir_state['known_files'].get(entry.name)
+                if (known and known[2] == 'failed'
+                        and known[:2] == (stat_result.st_size, stat_result.st_mtime)
+                        and now - known[3] < FAILED_RETRY_SECONDS):
+                    self.counts['failed_before'] += 1
+                    dir_state['files'].append((entry.name,) + known)
+                    continue
+            for policy in name_policies:
+                if policy.matches_stat(stat_result, cutoffs[id(policy)]):
+                    break
+            else:
+                self.counts['good'] += 1
+                if dir_state is not None:
+                    self._record_file(dir_state, entry.name, stat_result, 'good', now)
+                    # only files too young for a policy will come due by waiting:
+                    dues = [stat_result.st_atime + policy.min_age_days * 86400
+                            for policy in name_policies if policy.matches_size(stat_result)]
+                    if dues:
+                        due = min(dues)
+                        dir_state['next_due'] = min(due, dir_state['next_due'] or due)
+                continue
+            if (self.max_bytes is not None
+                    and self.counts['selected_bytes'] + stat_result.st_size > self.max_bytes):
+                self.counts['over_budget'] += 1
+                if dir_state is not None:
+                    dir_state['next_due'] = now
+                continue
+            self.counts['selected']       += 1
+            self.counts['selected_bytes'] += stat_result.st_size
+            if dir_state is not None:
+                # recorded now so that the result can update it:
+                self.index.add_files(dir_state['path'], [(entry.name, stat_result.st_size,
+                                                          stat_result.st_mtime, 'selected', now)])
+            yield entry, policy
+            if self._is_budget_spent():
+                return
+
+    def _record_file(self, dir_state, name, stat_result, action, now):
+        dir_state['files'].append((name, stat_result.st_size, stat_result.st_mtime, action, now))
+
+    def _is_budget_spent(self):
+        return ((self.max_files is not None and self.counts['selected'] >= self.max_files)
+                or (self.max_bytes is not None and self.counts['selected_bytes'] >= self.max_bytes))
+
+    def log_counts(self):
+        logger.info('scanned %(scanned)d entries: %(selected)d selected (%(selected_bytes)d bytes), '
+                    '%(good)d not due, %(over_budget)d over budget, %(skipped)d skipped, '
+                    '%(failed_before)d failed before, %(unchanged_dirs)d unchanged dirs' % self.counts)
+
+
+
+class Checkpoint(object):
+    """ Keeps the scan position of an unfinished run in a json file - by
+        default in the XDG cache dir.  On linux:
+            $HOME/.cache/<APP_NAME>/checkpoint.json
+
+        It's saved after every batch, by writing a temp file and renaming it
+        into place, so even a run that's killed leaves the position as of its
+        last complete batch.  It's cleared once a scan runs to completion,
+        and ignored if the policies have changed since it was saved.
+    """
+
+    def __init__(self, fqfn):
+        self.fqfn = fqfn
+
+    def load(self, fingerprint):
+        """ Returns the saved state, or None if there isn't a usable one.
+        """
+        try:
+            with open(self.fqfn) as f:
+                state = json.load(f)
+        except (IOError, OSError):
+            return None
+        except ValueError:
+            logger.warning('ignoring unreadable checkpoint: %s' % self.fqfn)
+            return None
+        if state.get('fingerprint') != fingerprint:
+            logger.info('policies have changed since the checkpoint - ignoring it')
+            return None
+        return state
+
+    def save(self, state):
+        ckpt_dir = os.path.dirname(os.path.abspath(self.fqfn))
+        if not os.path.isdir(ckpt_dir):
+            os.makedirs(ckpt_dir)
+        temp_fd, temp_fqfn = tempfile.mkstemp(dir=ckpt_dir, prefix='.checkpoint.')
+        try:
+            with os.fdopen(temp_fd, 'w') as f:
+                json.dump(state, f)
+            os.rename(temp_fqfn, self.fqfn)
+        except BaseException:
+            os.remove(temp_fqfn)
+            raise
+
+    def clear(self):
+        try:
+            os.remove(self.fqfn)
+        except OSError:
+            pass
+
+
+
+class StateIndex(object):
+    """ A persistent index of the state of each scanned directory & file,
+        kept in sqlite - by default in the XDG cache dir next to the JobCheck
+        pid dir.  On linux: $HOME/.cache/<APP_NAME>/state_index.sqlite
+
+        For each directory it records the mtime and policies it was scanned
+        with, its subdirectories and when its next file comes due.  For each
+        file that matched a policy's name patterns it records the size,
+        mtime and action taken: good (not due yet), selected, compressed or
+        failed.  A directory's files are replaced each time it's rescanned,
+        so files that are gone drop out of the index.
+
+        The index is used from both the scanning and the result threads, so
+        access is serialized by a lock.
+    """
+
+    def __init__(self, db_fqfn):
+        db_dir = os.path.dirname(os.path.abspath(db_fqfn))
+        if not os.path.isdir(db_dir):
+            os.makedirs(db_dir)
+        self.db_fqfn = db_fqfn
+        self.lock    = threading.Lock()
+        self.pending = 0
+        self.conn    = sqlite3.connect(db_fqfn, check_same_thread=False)
+        with self.lock:
+            self.conn.execute('PRAGMA journal_mode=WAL')
+            self.conn.execute('PRAGMA synchronous=NORMAL')
+            self.conn.execute("""CREATE TABLE IF NOT EXISTS dirs (
+                                     path        TEXT PRIMARY KEY,
+                                     mtime       REAL,
+                                     fingerprint TEXT,
+                                     next_due    REAL,
+                                     sub_dirs    TEXT,
+                                     scanned     REAL)""")
+            self.conn.execute("""CREATE TABLE IF NOT EXISTS files (
+                                     dir     TEXT,
+                                     name    TEXT,
+                                     size    INTEGER,
+                                     mtime   REAL,
+                                     action  TEXT,
+                                     updated REAL,
+                                     PRIMARY KEY (dir, name))""")
+            self.conn.commit()
+
+    def get_dir(self, path):
+        with self.lock:
+            row = self.conn.execute('SELECT mtime, fingerprint, next_due, sub_dirs FROM dirs '
+                                    'WHERE path = ?', (path,)).fetchone()
+        if row is None:
+            return None
+        return {'mtime':       row[0],
+                'fingerprint': row[1],
+                'next_due':    row[2],
+                'sub_dirs':    row[3].split('\0') if row[3] else []}
+
+    def get_files(self, path):
+        """ Returns {name: (size, mtime, action, updated)} for the dir's files.
+        """
+        with self.lock:
+            rows = self.conn.execute('SELECT name, size, mtime, action, updated FROM files '
+                                     'WHERE dir = ?', (path,)).fetchall()
+        return dict((row[0], tuple(row[1:])) for row in rows)
+
+    def add_files(self, path, file_rows):
+        """ Adds (name, size, mtime, action, updated) rows for the dir.
+        """
+        with self.lock:
+            self.conn.executemany('INSERT OR REPLACE INTO files VALUES (?, ?, ?, ?, ?, ?)',
+                                  ((path,) + file_row for file_row in file_rows))
+            self._commit_periodically(len(file_rows))
+
+    def record_dir(self, path, dir_state, scan_time):
+        """ Records a completed scan of the dir - replacing the rows of files
+            from prior scans with the dir_state's.
+        """
+        with self.lock:
+            self.conn.execute('INSERT OR REPLACE INTO dirs VALUES (?, ?, ?, ?, ?, ?)',
+                              (path, dir_state['mtime'], dir_state['fingerprint'],
+                               dir_state['next_due'], '\0'.join(dir_state['sub_dirs']),
+                               scan_time))
+            self.conn.execute('DELETE FROM files WHERE dir = ? AND updated < ?', (path, scan_time))
+            self.conn.executemany('INSERT OR REPLACE INTO files VALUES (?, ?, ?, ?, ?, ?)',
+                                  ((path,) + file_row for file_row in dir_state['files']))
+            self.conn.commit()
+            self.pending = 0
+
+    def record_result(self, fqfn, error):
+        """ Records the outcome of compressing a selected file.
+        """
+        with self.lock:
+            self.conn.execute('UPDATE files SET action = ?, updated = ? WHERE dir = ? AND name = ?',
+                              ('failed' if error else 'compressed', time.time(),
+                               os.path.dirname(fqfn), os.path.basename(fqfn)))
+            self._commit_periodically(1)
+
+    def _commit_periodically(self, row_count):
+        self.pending += row_count
+        if self.pending >= 1000:
+            self.conn.commit()
+            self.pending = 0
+
+    def close(self):
+        with self.lock:
+            self.conn.commit()
+            self.conn.close()
+
+
+
+class _DirEntry(object):
+    """ The subset of os.DirEntry used by FileScanner - for pythons without
+        scandir.
+    """
+
+    def __init__(self, top_dir, name):
+        self.name  = name
+        self.path  = os.path.join(top_dir, name)
+        self._stat = None
+
+    def stat(self, follow_symlinks=False):
+        if self._stat is None:
+            self._stat = os.lstat(self.path)
+        return self._stat
 
-        logger.debug('%-20.20s - %s - %s' % (abbreviate(fn), file_time_string, action))
+    def is_dir(self, follow_symlinks=False):
+        return stat.S_ISDIR(self.stat().st_mode)
+
+    def is_file(self, follow_symlinks=False):
+        return stat.S_ISREG(self.stat().st_mode)
+
+
+
+def _scandir(top_dir):
+    if scandir is not None:
+        return scandir(top_dir)
+    return (_DirEntry(top_dir, name) for name in os.listdir(top_dir))
 
 
 
 class FileCompressor(object):
+    """ Compresses files in-process - streaming each through the codec's
+        module in chunks - across a pool of workers.
+
+        Threads are the default since zlib releases the GIL while it
+        compresses, so they use multiple cores without the cost of starting
+        processes.  Each file is written to a temp file in the same dir,
+        given the original's permissions & times, renamed into place and only
+        then is the original removed - so a crash never leaves a partial file.
+
+        A Throttle limits the i/o of every worker - shared by threads, split
+        evenly between processes.  With adaptive, a ConcurrencyGovernor
+        decides how many of the workers are busy at once.
+    """
 
-    def __init__(self):
+    def __init__(self, workers=None, use_processes=False, compress_level=None,
+                 chunk_size=CHUNK_SIZE, codec='gzip', throttle=None, adaptive=False):
         logger.debug('cletus_archiver_lib starting')
+        self.workers        = workers or multiprocessing.cpu_count()
+        self.use_processes  = use_processes
+        self.compress_level = compress_level
+        self.chunk_size     = chunk_size
+        self.codec          = codec
+        self.file_count     = 0
+        self.error_count    = 0
+        self.bytes_in       = 0
+        self.bytes_out      = 0
+        self.elapsed        = 0.0
+        self.pool           = None
+        self.throttle       = throttle or Throttle()
+        self.governor       = ConcurrencyGovernor(self.workers) if adaptive else None
+
+    def open(self):
+        """ Starts a pool that's kept until close() - so that a run made of
+            many compress_all calls doesn't start its workers for each one.
+        """
+        if self.pool is None:
+            self.pool = self._new_pool()
+
+    def close(self):
+        if self.pool is not None:
+            self.pool.close()
+            self.pool.join()
+            self.pool = None
+
+    def _new_pool(self):
+        if self.use_processes:
+            return multiprocessing.Pool(self.workers, _init_worker,
+                                        (self.throttle.get_share(self.workers),))
+        else:
+            set_throttle(self.throttle)
+            return multiprocessing.pool.ThreadPool(self.workers)
+
+    def _imap(self, func, tasks):
+        """ Yields func(task) for each task as it finishes - keeping no more
+            than the governor's limit in flight, if there's a governor.
+        """
+        start_time = time.time()
+        pool       = self.pool or self._new_pool()
+        try:
+            if self.governor is None:
+                for result in pool.imap_unordered(func, tasks):
+                    yield result
+            else:
+                results   = queue.Queue()
+                in_flight = 0
+                for task in tasks:
+                    while in_flight >= self.governor.limit:
+                        yield self._get_result(results)
+                        in_flight -= 1
+                    pool.apply_async(_call_task, ((func, task),), callback=results.put)
+                    in_flight += 1
+                while in_flight:
+                    yield self._get_result(results)
+                    in_flight -= 1
+        finally:
+            if pool is not self.pool:
+                pool.close()
+                pool.join()
+            self.elapsed += time.time() - start_time
+
+    def _get_result(self, results):
+        error, result = results.get()
+        if error:
+            raise RuntimeError(error)
+        return result
 
     def compress(self, fn):
-        cmd   = '''gzip %s''' % fn
-        r     = envoy.run(cmd)
-        if r.status_code:
-            logger.error('%s compression failed with status %d' % (fn, r.status_code))
+        """ Compresses a single file within this thread.
+            Returns (fn, bytes in, bytes out, error message or None).
+        """
+        result = compress_file(self._get_task(fn))
+        self._tally(result)
+        return result
+
+    def compress_all(self, fns):
+        """ Compresses the files from the fns iterable - which may be a
+            generator - and yields the result of each as it finishes.  Each
+            item is either a file name or a (file name, codec, level) tuple.
+        """
+        tasks = (self._get_task(fn) for fn in fns)
+        for result in self._imap(compress_file, tasks):
+            self._tally(result)
+            if self.governor:
+                self.governor.record(result[1])
+            yield result
+
+    def _get_task(self, item):
+        if isinstance(item, tuple):
+            fn, codec, compress_level = item
+        else:
+            fn, codec, compress_level = item, self.codec, self.compress_level
+        return (fn, codec, compress_level, self.chunk_size)
+
+    def bundle_all(self, tasks):
+        """ Writes the bundles from the Bundler tasks across the pool - and
+            yields (archive fqfn, fns, bytes in, bytes out, error message or
+            None) for each as it finishes.
+        """
+        for result in self._imap(write_bundle, tasks):
+            archive_fqfn, fns, in_bytes, out_bytes, error = result
+            if error:
+                self.error_count += len(fns)
+            else:
+                self.file_count += len(fns)
+                self.bytes_in   += in_bytes
+                self.bytes_out  += out_bytes
+            if self.governor:
+                self.governor.record(in_bytes)
+            yield result
+
+    def _tally(self, result):
+        fn, in_bytes, out_bytes, error = result
+        if error:
+            self.error_count += 1
         else:
-            logger.debug('%s compressed' % fn)
+            self.file_count += 1
+            self.bytes_in   += in_bytes
+            self.bytes_out  += out_bytes
+
+    def get_throughput(self):
+        """ Returns the uncompressed MB per second.
+        """
+        if not self.elapsed:
+            return 0.0
+        return self.bytes_in / 1048576.0 / self.elapsed
+
+    def log_throughput(self):
+        logger.info('compressed %d files (%d failed): %.1f MB to %.1f MB in %.2f seconds - %.1f MB/s'
+                    % (self.file_count, self.error_count, self.bytes_in / 1048576.0,
+                       self.bytes_out / 1048576.0, self.elapsed, self.get_throughput()))
+
+
+
+class TokenBucket(object):
+    """ Limits a rate - of bytes or operations per second - while allowing
+        bursts of up to burst_seconds' worth.
+
+        consume() takes the tokens even if there aren't enough, then sleeps
+        off the debt - so callers can charge for i/o after the fact, once
+        they know its size.  Thread-safe: concurrent callers queue up behind
+        each other's debt.
+    """
+
+    def __init__(self, rate, burst_seconds=1.0):
+        self.rate     = float(rate)
+        self.capacity = self.rate * burst_seconds
+        self.tokens   = self.capacity
+        self.updated  = _perf_counter()
+        self.lock     = threading.Lock()
+
+    def consume(self, amount):
+        """ Returns the seconds slept.
+        """
+        with self.lock:
+            now          = _perf_counter()
+            self.tokens  = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            self.tokens -= amount
+            wait = -self.tokens / self.rate if self.tokens < 0 else 0.0
+        if wait > 0:
+            time.sleep(wait)
+        return wait
+
+
+
+class Throttle(object):
+    """ Token buckets limiting read bytes, write bytes and i/o operations
+        per second - any of which may be None for no limit.  Every read or
+        write call counts as one operation.
+    """
+
+    def __init__(self, read_bps=None, write_bps=None, iops=None):
+        self.rates        = (read_bps, write_bps, iops)
+        self.read_bucket  = TokenBucket(read_bps) if read_bps else None
+        self.write_bucket = TokenBucket(write_bps) if write_bps else None
+        self.io_bucket    = TokenBucket(iops) if iops else None
+
+    def read(self, nbytes):
+        if self.io_bucket:
+            self.io_bucket.consume(1)
+        if self.read_bucket and nbytes:
+            self.read_bucket.consume(nbytes)
+
+    def write(self, nbytes):
+        if not nbytes:
+            return
+        if self.io_bucket:
+            self.io_bucket.consume(1)
+        if self.write_bucket:
+            self.write_bucket.consume(nbytes)
+
+    def get_share(self, count):
+        """ Returns the rates for one of count processes sharing the limits.
+        """
+        return tuple(rate / float(count) if rate else None for rate in self.rates)
+
+
+
+# used by compress_file & write_bundle - set per pool by FileCompressor:
+_throttle = Throttle()
+
+
+def set_throttle(throttle):
+    global _throttle
+    _throttle = throttle
+
+
+def _init_worker(rates):
+    """ Pool initializer for worker processes - which can't share buckets,
+        so each gets its share of the limits.
+    """
+    set_throttle(Throttle(*rates) if rates else Throttle())
+
+
+
+def _call_task(func_and_task):
+    """ Runs func(task) for a governed pool - returning (error, result) so
+        that a failure can't leave the pool's callback waiting forever.
+    """
+    func, task = func_and_task
+    try:
+        return None, func(task)
+    except Exception:
+        return traceback.format_exc(), None
+
+
+
+class ConcurrencyGovernor(object):
+    """ Adapts how many files are compressed at once - up to max_workers -
+        to the throughput measured over each interval.
+
+        It starts with one and climbs a worker at a time as long as each
+        one adds at least min_gain to the throughput.  When one doesn't it
+        steps back, and if the throughput falls - say the disks got busy
+        with the host's main workload - it drops a worker.  After
+        probe_intervals without a change it tries one more again, to pick up
+        capacity that's become idle.  So it never jumps straight to every
+        worker, and under a Throttle it settles on the fewest that reach the
+        limit.
+    """
+
+    def __init__(self, max_workers, interval=5.0, min_gain=0.1, probe_intervals=6):
+        self.max_workers     = max_workers
+        self.interval        = interval
+        self.min_gain        = min_gain
+        self.probe_intervals = probe_intervals
+        self.limit           = 1
+        self.rate            = None         # bytes/second at the current limit
+        self.last_change     = 0
+        self.steady          = 0
+        self.interval_start  = _perf_counter()
+        self.interval_bytes  = 0
+
+    def record(self, nbytes, now=None):
+        """ Records the bytes of a finished file.
+        """
+        now = _perf_counter() if now is None else now
+        self.interval_bytes += nbytes
+        elapsed = now - self.interval_start
+        if elapsed >= self.interval:
+            self._adjust(self.interval_bytes / elapsed)
+            self.interval_start = now
+            self.interval_bytes = 0
+
+    def _adjust(self, rate):
+        prior = self.rate
+        if prior is None:
+            change = 1
+        elif self.last_change > 0:
+            change = 1 if rate >= prior * (1 + self.min_gain) else -1
+            if change < 0:          # the added worker didn't help
+                rate = prior
+        elif rate < prior * (1 - self.min_gain):
+            change = -1
+        else:
+            self.steady += 1
+            change = 1 if self.steady >= self.probe_intervals else 0
+        new_limit = max(1, min(self.max_workers, self.limit + change))
+        self.last_change = new_limit - self.limit
+        if self.last_change:
+            self.steady = 0
+            logger.debug('throughput %.1f MB/s - now compressing %d files at once'
+                         % (rate / 1048576.0, new_limit))
+        self.limit = new_limit
+        self.rate  = rate
+
+
+
+# ioprio_set syscall numbers by machine:
+IOPRIO_SYSCALLS = {'x86_64': 251, 'amd64': 251, 'i386': 289, 'i686': 289,
+                   'aarch64': 30, 'arm64': 30, 'armv7l': 314, 'ppc64le': 273, 's390x': 282}
+IOPRIO_CLASSES  = {'best-effort': 2, 'idle': 3}
+
+
+def lower_priority(nice=None, ioprio_class=None, ioprio_level=7):
+    """ Lowers this process's cpu priority by nice, and sets its i/o
+        scheduling class - before any workers start, so that they inherit
+        both.  Linux has no /proc interface for setting the i/o priority,
+        so that's done through the ioprio_set syscall - and is skipped with
+        a warning where it isn't available.
+    """
+    if nice:
+        os.nice(nice)
+        logger.info('cpu priority lowered by %d' % nice)
+    if ioprio_class:
+        syscall_number = IOPRIO_SYSCALLS.get(platform.machine())
+        if not sys.platform.startswith('linux') or syscall_number is None:
+            logger.warning('cannot set ioprio on %s %s' % (sys.platform, platform.machine()))
+            return
+        libc = ctypes.CDLL(None, use_errno=True)
+        value = IOPRIO_CLASSES[ioprio_class] << 13 | ioprio_level
+        # IOPRIO_WHO_PROCESS = 1, and 0 is this process:
+        if libc.syscall(syscall_number, 1, 0, value) != 0:
+            logger.warning('cannot set ioprio: %s' % os.strerror(ctypes.get_errno()))
+        else:
+            logger.info('ioprio set to %s level %d' % (ioprio_class, ioprio_level))
+
+
+
+class Plan(object):
+    """ Estimates what compressing a list of files would take - for the
+        --plan mode.
+
+        Files are grouped by policy, codec & level.  A random sample of up
+        to sample_files from each group - kept by reservoir sampling, so
+        the list of files is never held - has its first sample_bytes
+        compressed in memory to measure the ratio & speed, which are then
+        applied to the group's total bytes.  Wall time assumes the workers
+        are kept busy, up to one per cpu.
+    """
+
+    def __init__(self, workers=None, sample_files=20, sample_bytes=1024 * 1024, max_files=None):
+        self.workers      = workers or multiprocessing.cpu_count()
+        self.sample_files = sample_files
+        self.sample_bytes = sample_bytes
+        self.max_files    = max_files
+        self.scan_seconds = 0.0
+        self.groups       = {}
+        self.random       = random.Random(0)
+
+    def add(self, fn, size, policy_name, codec_name, level):
+        group = self.groups.setdefault((policy_name, codec_name, level),
+                                       {'files': 0, 'bytes': 0, 'samples': [],
+                                        'out_bytes': None, 'seconds': None})
+        group['files'] += 1
+        group['bytes'] += size
+        if len(group['samples']) < self.sample_files:
+            group['samples'].append(fn)
+        else:
+            i = self.random.randint(0, group['files'] - 1)
+            if i < self.sample_files:
+                group['samples'][i] = fn
+
+    def estimate(self):
+        for (policy_name, codec_name, level), group in self.groups.items():
+            codec      = CODECS[codec_name]
+            sample_in  = sample_out = 0
+            seconds    = 0.0
+            for fn in group['samples']:
+                try:
+                    sample = read_sample(fn, self.sample_bytes)
+                except (IOError, OSError):
+                    continue
+                start_time  = _perf_counter()
+                sample_out += len(codec.compress(sample, level))
+                seconds    += _perf_counter() - start_time
+                sample_in  += len(sample)
+            if sample_in:
+                group['out_bytes'] = int(group['bytes'] * sample_out / float(sample_in))
+                group['seconds']   = group['bytes'] * seconds / float(sample_in)
+            else:           # nothing readable - assume no savings
+                group['out_bytes'] = group['bytes']
+                group['seconds']   = 0.0
+
+    def get_totals(self):
+        """ Returns (files, bytes in, estimated bytes out, estimated seconds).
+        """
+        groups  = self.groups.values()
+        seconds = sum(group['seconds'] for group in groups)
+        return (sum(group['files'] for group in groups),
+                sum(group['bytes'] for group in groups),
+                sum(group['out_bytes'] for group in groups),
+                self.scan_seconds + seconds / min(self.workers, multiprocessing.cpu_count()))
+
+    def format(self):
+        """ Returns the plan as a list of lines.
+        """
+        lines = ['%-20s %-6s %5s %10s %12s %12s %7s'
+                 % ('policy', 'codec', 'level', 'files', 'MB in', 'est MB out', 'ratio')]
+        for (policy_name, codec_name, level), group in sorted(self.groups.items(),
+                                                              key=lambda item: str(item[0])):
+            lines.append('%-20.20s %-6s %5s %10d %12.1f %12.1f %7.3f'
+                         % (policy_name, codec_name, CODECS[codec_name].get_level(level),
+                            group['files'], group['bytes'] / 1048576.0,
+                            group['out_bytes'] / 1048576.0,
+                            group['out_bytes'] / float(group['bytes'] or 1)))
+        files, bytes_in, bytes_out, seconds = self.get_totals()
+        lines.append('total: %d files, %.1f MB in, est %.1f MB out - frees est %.1f MB'
+                     % (files, bytes_in / 1048576.0, bytes_out / 1048576.0,
+                        (bytes_in - bytes_out) / 1048576.0))
+        lines.append('est wall time: %.1f seconds with %d workers (scan took %.1f seconds)'
+                     % (seconds, self.workers, self.scan_seconds))
+        if self.max_files and files > self.max_files:
+            lines.append('at max_files of %d this takes %d runs'
+                         % (self.max_files, -(-files // self.max_files)))
+        return lines
+
+
+
+def read_sample(fn, size):
+    """ Returns the first size bytes of fn without changing its atime - which
+        would otherwise push it past min_age_days on the next run.  Opens with
+        O_NOATIME where the os allows it (the file's owner or root on linux),
+        otherwise restores the atime & mtime after reading.
+    """
+    stat_result = os.stat(fn)
+    fd = None
+    if O_NOATIME:
+        try:
+            fd = os.open(fn, os.O_RDONLY | O_NOATIME)
+        except OSError:                 # EPERM if not the owner
+            fd = None
+    restore = fd is None
+    if fd is None:
+        fd = os.open(fn, os.O_RDONLY)
+    try:
+        with os.fdopen(fd, 'rb') as f:
+            sample = f.read(size)
+    finally:
+        if restore:
+            try:
+                os.utime(fn, (stat_result.st_atime, stat_result.st_mtime))
+            except OSError:
+                pass
+    return sample
+
+
+
+class Codec(object):
+    """ A compression codec: its file suffix, level range and how to
+        compress with it.  Codecs other than gzip are driven through their
+        module's incremental compressor object.
+
+        Inputs:
+           - name          - used in config, ex: 'xz'
+           - suffix        - added to compressed file names, ex: '.xz'
+           - min_level, max_level, default_level
+           - make_compressor - function taking a level and returning an
+                               object with compress(data) & flush() methods
+           - decompress    - function taking one complete compressed stream
+                             and returning the data - used to extract from
+                             bundles
+    """
+
+    def __init__(self, name, suffix, min_level, max_level, default_level,
+                 make_compressor=None, decompress=None):
+        self.name            = name
+        self.suffix          = suffix
+        self.min_level       = min_level
+        self.max_level       = max_level
+        self.default_level   = default_level
+        self.make_compressor = make_compressor
+        self.decompress      = decompress
+
+    def get_level(self, compress_level):
+        """ Returns the level clamped to this codec's range.
+        """
+        if compress_level is None:
+            return self.default_level
+        return max(self.min_level, min(self.max_level, compress_level))
+
+    def open(self, fn, outfile, compress_level, stat_result):
+        """ Returns a writable file object that compresses into outfile.
+        """
+        return _CompressorWriter(outfile, self.make_compressor(self.get_level(compress_level)))
+
+    def compress(self, data, compress_level):
+        """ Returns data compressed in one shot - used for sampling.
+        """
+        compressor = self.make_compressor(self.get_level(compress_level))
+        return compressor.compress(data) + compressor.flush()
+
+    def compress_stream(self, data, compress_level):
+        """ Returns data compressed as one complete stream in the codec's
+            file format - streams can be concatenated into one valid file.
+        """
+        compressor = self.make_compressor(self.get_level(compress_level))
+        return compressor.compress(data) + compressor.flush()
+
+    def __repr__(self):
+        return 'Codec(%r)' % self.name
+
+
+
+class GzipCodec(Codec):
+
+    def __init__(self):
+        Codec.__init__(self, 'gzip', '.gz', 1, 9, 6,
+                       lambda level: zlib.compressobj(level, zlib.DEFLATED, 31),
+                       lambda data: zlib.decompress(data, 47))
+
+    def open(self, fn, outfile, compress_level, stat_result):
+        return gzip.GzipFile(filename=os.path.basename(fn), mode='wb',
+                             compresslevel=self.get_level(compress_level), fileobj=outfile,
+                             mtime=stat_result.st_mtime)
+
+    def compress(self, data, compress_level):
+        return zlib.compress(data, self.get_level(compress_level))
+
+
+
+class _CompressorWriter(object):
+    """ A minimal writable file object that feeds a compressor object.
+    """
+
+    def __init__(self, outfile, compressor):
+        self.outfile    = outfile
+        self.compressor = compressor
+
+    def write(self, data):
+        self.outfile.write(self.compressor.compress(data))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.outfile.write(self.compressor.flush())
+
+
+
+# codec name: Codec - only those whose modules are installed:
+CODECS = {}
+
+# the suffixes of every codec's output - whether installed or not:
+COMPRESSED_SUFFIXES = ['.gz', '.bz2', '.xz', '.zst', '.lz4']
+
+
+def register_codec(codec):
+    CODECS[codec.name] = codec
+    if codec.suffix not in COMPRESSED_SUFFIXES:
+        COMPRESSED_SUFFIXES.append(codec.suffix)
+
+
+register_codec(GzipCodec())
+register_codec(Codec('bz2', '.bz2', 1, 9, 9, bz2.BZ2Compressor, bz2.decompress))
+if lzma:
+    register_codec(Codec('xz', '.xz', 0, 9, 6, lambda level: lzma.LZMACompressor(preset=level),
+                         lzma.decompress))
+if zstandard:
+    register_codec(Codec('zstd', '.zst', 1, 22, 3,
+                         lambda level: zstandard.ZstdCompressor(level=level).compressobj(),
+                         lambda data: zstandard.ZstdDecompressor().decompressobj().decompress(data)))
+if lz4_frame:
+    register_codec(Codec('lz4', '.lz4', 0, 16, 0,
+                         lambda level: _Lz4Compressor(level),
+                         lz4_frame.decompress))
+
+
+
+class _Lz4Compressor(object):
+    """ Adapts lz4's frame compressor to the compress/flush interface.
+    """
+
+    def __init__(self, level):
+        self.compressor = lz4_frame.LZ4FrameCompressor(compression_level=level)
+        self.started    = False
+
+    def compress(self, data):
+        header = b''
+        if not self.started:
+            header, self.started = self.compressor.begin(), True
+        return header + self.compressor.compress(data)
+
+    def flush(self):
+        header = b'' if self.started else self.compressor.begin()
+        return header + self.compressor.flush()
+
+
+
+class Bundler(object):
+    """ Groups small files into bundles - tar archives written by
+        write_bundle - by directory, codec & level, and optionally by the
+        hour or day of their mtime.  A group of just one file isn't worth a
+        bundle, so it's returned to be compressed on its own.  Groups within
+        the dir still being scanned can be kept open across calls to
+        get_tasks - so a dir isn't split into a bundle per batch.
+
+        Archives are named bundle-[<window>-]<run time>-<seq>.tar<suffix>
+        within the files' dir, so neither later runs nor later windows ever
+        reuse a name.
+    """
+
+    def __init__(self, block_size=BUNDLE_BLOCK_SIZE):
+        self.block_size = block_size
+        self.run_label  = time.strftime('%Y%m%dT%H%M%S')
+        self.seq        = 0
+        self.groups     = {}
+
+    def add(self, entry, policy, codec_name, level):
+        window_format = BUNDLE_WINDOWS[policy.bundle_window]
+        window = None
+        if window_format:
+            mtime  = entry.stat(follow_symlinks=False).st_mtime
+            window = time.strftime(window_format, time.localtime(mtime))
+        key = (os.path.dirname(entry.path), window, codec_name, level)
+        self.groups.setdefault(key, []).append(entry.name)
+
+    def get_tasks(self, open_dir=None):
+        """ Returns (bundle tasks, single file tasks) for the files added
+            since the last call - except for those within open_dir, the dir
+            still being scanned, which are kept until a later call.
+        """
+        bundle_tasks = []
+        single_tasks = []
+        open_groups  = {}
+        if open_dir is not None:
+            open_dir = os.path.normpath(open_dir)
+        for key, names in sorted(self.groups.items(), key=lambda item: str(item[0])):
+            dir_name, window, codec_name, level = key
+            if open_dir is not None and os.path.normpath(dir_name) == open_dir:
+                open_groups[key] = names
+                continue
+            if len(names) == 1:
+                single_tasks.append((os.path.join(dir_name, names[0]), codec_name, level))
+                continue
+            self.seq += 1
+            archive_name = 'bundle-%s%s-%d.tar%s' % ('%s-' % window if window else '',
+                                                     self.run_label, self.seq,
+                                                     CODECS[codec_name].suffix)
+            bundle_tasks.append((dir_name, names, codec_name, level, archive_name, self.block_size))
+        self.groups = open_groups
+        return bundle_tasks, single_tasks
+
+
+
+class _BlockWriter(object):
+    """ Writes data as a series of independently compressed streams of about
+        block_size bytes each.  Concatenated, the streams are a valid file
+        of the codec's format - and any block can be decompressed by itself.
+    """
+
+    def __init__(self, outfile, codec, compress_level, block_size):
+        self.outfile        = outfile
+        self.codec          = codec
+        self.compress_level = compress_level
+        self.block_size     = block_size
+        self.blocks         = []        # (offset, length) of each compressed block
+        self.buffer         = []
+        self.buffer_len     = 0
+        self.in_bytes       = 0
+        self.out_bytes      = 0
+
+    def write(self, data):
+        """ Buffers data and returns its (block, offset within the block).
+        """
+        position = (len(self.blocks), self.buffer_len)
+        self.buffer.append(data)
+        self.buffer_len += len(data)
+        self.in_bytes   += len(data)
+        return position
+
+    def end_member(self):
+        if self.buffer_len >= self.block_size:
+            self.flush()
+
+    def flush(self):
+        if not self.buffer_len:
+            return
+        data = self.codec.compress_stream(b''.join(self.buffer), self.compress_level)
+        self.outfile.write(data)
+        _throttle.write(len(data))
+        self.blocks.append((self.out_bytes, len(data)))
+        self.out_bytes  += len(data)
+        self.buffer     = []
+        self.buffer_len = 0
+
+
+
+def write_bundle(task):
+    """ Writes files into a tar archive compressed in blocks, plus a sidecar
+        json index of where each member is.  Takes a tuple of (dir, file
+        names, codec, compress_level, archive name, block size) so that it
+        can be used by pools.  Returns (archive fqfn, fns, bytes in, bytes
+        out, error message or None) rather than raising.
+
+        The archive is fsynced and renamed into place, then its index is too,
+        and only then are the originals removed - so a crash leaves either
+        the originals or a complete bundle.
+    """
+    dir_name, names, codec_name, compress_level, archive_name, block_size = task
+    codec        = CODECS[codec_name]
+    archive_fqfn = os.path.join(dir_name, archive_name)
+    fns          = [os.path.join(dir_name, name) for name in names]
+    temp_fqfns   = []
+    try:
+        fd, temp_fqfn = tempfile.mkstemp(dir=dir_name, prefix='.%s.' % archive_name, suffix='.tmp')
+        temp_fqfns.append(temp_fqfn)
+        members = []
+        with os.fdopen(fd, 'wb') as outfile:
+            writer = _BlockWriter(outfile, codec, compress_level, block_size)
+            for name, fn in zip(names, fns):
+                stat_result = os.stat(fn)
+                with open(fn, 'rb') as infile:
+                    data = infile.read()
+                _throttle.read(len(data))
+                info       = tarfile.TarInfo(name)
+                info.size  = len(data)
+                info.mtime = int(stat_result.st_mtime)
+                info.mode  = stat_result.st_mode & 0o7777
+                header     = info.tobuf(tarfile.PAX_FORMAT)
+                block, offset = writer.write(header)
+                writer.write(data)
+                writer.write(tarfile.NUL * (-len(data) % tarfile.BLOCKSIZE))
+                writer.end_member()
+                members.append({'name':   name,
+                                'size':   len(data),
+                                'mtime':  stat_result.st_mtime,
+                                'mode':   info.mode,
+                                'block':  block,
+                                'offset': offset + len(header)})
+            # end-of-archive marker, padded out to a full record:
+            writer.write(tarfile.NUL * (2 * tarfile.BLOCKSIZE))
+            writer.write(tarfile.NUL * (-writer.in_bytes % tarfile.RECORDSIZE))
+            writer.flush()
+            outfile.flush()
+            os.fsync(outfile.fileno())
+        os.rename(temp_fqfn, archive_fqfn)
+        temp_fqfns.remove(temp_fqfn)
+
+        fd, temp_fqfn = tempfile.mkstemp(dir=dir_name, prefix='.%s.' % archive_name, suffix='.tmp')
+        temp_fqfns.append(temp_fqfn)
+        with os.fdopen(fd, 'w') as outfile:
+            json.dump({'archive': archive_name,
+                       'codec':   codec_name,
+                       'blocks':  writer.blocks,
+                       'members': members}, outfile)
+            outfile.flush()
+            os.fsync(outfile.fileno())
+        os.rename(temp_fqfn, archive_fqfn + BUNDLE_INDEX_SUFFIX)
+        temp_fqfns.remove(temp_fqfn)
+        _fsync_dir(dir_name)
+
+        for fn in fns:
+            os.remove(fn)
+        return (archive_fqfn, fns, writer.in_bytes, writer.out_bytes, None)
+    except (IOError, OSError) as e:
+        return (archive_fqfn, fns, 0, 0, str(e))
+    finally:
+        for temp_fqfn in temp_fqfns:
+            try:
+                os.remove(temp_fqfn)
+            except OSError:
+                pass
+
+
+
+def _fsync_dir(dir_name):
+    """ Makes renames within the dir durable - where the os supports it.
+    """
+    try:
+        fd = os.open(dir_name, os.O_RDONLY)
+    except OSError:
+        return
+    try:
+        os.fsync(fd)
+    except OSError:
+        pass
+    finally:
+        os.close(fd)
+
+
+
+def extract_from_bundle(archive_fqfn, name):
+    """ Returns the contents of one file from a bundle - decompressing only
+        the block that holds it, found through the bundle's index.
+        Raises KeyError if the bundle doesn't hold the file.
+    """
+    with open(archive_fqfn + BUNDLE_INDEX_SUFFIX) as f:
+        bundle_index = json.load(f)
+    for member in bundle_index['members']:
+        if member['name'] == name:
+            break
+    else:
+        raise KeyError(name)
+    offset, length = bundle_index['blocks'][member['block']]
+    with open(archive_fqfn, 'rb') as f:
+        f.seek(offset)
+        block = CODECS[bundle_index['codec']].decompress(f.read(length))
+    return block[member['offset']:member['offset'] + member['size']]
+
+
+
+class AutoTuner(object):
+    """ Picks a codec & level for a file by compressing a sample of it with
+        each candidate and measuring the speed & ratio.
+
+        With min_mbps, the best-compressing candidate that's at least that
+        fast wins.  With max_ratio (compressed / original size), the fastest
+        candidate that compresses at least that well wins.  If no candidate
+        meets the target, the fastest - or best-compressing - is used.
+
+        Choices are cached by key (ex: the policy & file extension), so
+        only the first file of each kind is sampled.
+    """
+
+    candidates = [('lz4', 0), ('zstd', 1), ('gzip', 1), ('zstd', 3), ('gzip', 6),
+                  ('zstd', 9), ('gzip', 9), ('bz2', 9), ('xz', 1), ('zstd', 19), ('xz', 6)]
+
+    def __init__(self, min_mbps=None, max_ratio=None, sample_bytes=4 * 1024 * 1024):
+        if min_mbps is None and max_ratio is None:
+            min_mbps = 20
+        self.min_mbps     = min_mbps
+        self.max_ratio    = max_ratio
+        self.sample_bytes = sample_bytes
+        self.choices      = {}
+
+    def choose(self, fn, key=None):
+        """ Returns (codec name, level) for the file.
+        """
+        if key is not None and key in self.choices:
+            return self.choices[key]
+        try:
+            sample = read_sample(fn, self.sample_bytes)
+        except (IOError, OSError):
+            return ('gzip', None)
+        if not sample:
+            return ('gzip', None)
+        results = []
+        for codec_name, level in self.candidates:
+            if codec_name not in CODECS:
+                continue
+            start_time = _perf_counter()
+            compressed = CODECS[codec_name].compress(sample, level)
+            seconds    = max(_perf_counter() - start_time, 1e-9)
+            results.append((codec_name, level, len(sample) / 1048576.0 / seconds,
+                            len(compressed) / float(len(sample))))
+        choice = self._pick(results)
+        logger.debug('auto-tune chose %s level %s for %s' % (choice[0], choice[1], fn))
+        if key is not None:
+            self.choices[key] = choice
+        return choice
+
+    def _pick(self, results):
+        """ Takes a list of (codec name, level, MB/s, ratio) tuples.
+        """
+        if self.min_mbps is not None:
+            fast_enough = [result for result in results if result[2] >= self.min_mbps]
+            if fast_enough:
+                best = min(fast_enough, key=lambda result: result[3])
+            else:
+                best = max(results, key=lambda result: result[2])
+        else:
+            small_enough = [result for result in results if result[3] <= self.max_ratio]
+            if small_enough:
+                best = max(small_enough, key=lambda result: result[2])
+            else:
+                best = min(results, key=lambda result: result[3])
+        return best[0], best[1]
+
+
+
+def compress_file(task):
+    """ Compresses a file to <fn><codec suffix> atomically, then removes the
+        original.  An existing <fn><codec suffix> is never overwritten - the
+        file is left as it is and reported as failed.  Takes a tuple of (fn,
+        codec, compress_level, chunk_size) so that it can be used by pools.
+        Returns (fn, bytes in, bytes out, error message or None) rather than
+        raising, so one failure doesn't stop a batch.
+    """
+    fn, codec_name, compress_level, chunk_size = task
+    codec     = CODECS[codec_name]
+    suffix    = codec.suffix
+    temp_fqfn = None
+    try:
+        if os.path.lexists(fn + suffix):
+            return (fn, 0, 0, 'compressed file already exists: %s' % (fn + suffix))
+        stat_result = os.stat(fn)
+        fd, temp_fqfn = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(fn)),
+                                         prefix='.%s.' % os.path.basename(fn),
+                                         suffix='%s.tmp' % suffix)
+        with os.fdopen(fd, 'wb') as outfile:
+            written = 0
+            with open(fn, 'rb') as infile:
+                with codec.open(fn, outfile, compress_level, stat_result) as codec_file:
+                    while True:
+                        data = infile.read(chunk_size)
+                        _throttle.read(len(data))
+                        if not data:
+                            break
+                        codec_file.write(data)
+                        _throttle.write(outfile.tell() - written)
+                        written = outfile.tell()
+            out_bytes = outfile.tell()
+            _throttle.write(out_bytes - written)
+        os.chmod(temp_fqfn, stat_result.st_mode & 0o7777)
+        os.utime(temp_fqfn, (stat_result.st_atime, stat_result.st_mtime))
+        # unlike a rename, a link fails rather than replace a file created since:
+        os.link(temp_fqfn, fn + suffix)
+        os.remove(temp_fqfn)
+        temp_fqfn = None
+        os.remove(fn)
+        return (fn, stat_result.st_size, out_bytes, None)
+    except (IOError, OSError) as e:
+        return (fn, 0, 0, str(e))
+    finally:
+        if temp_fqfn:
+            try:
+                os.remove(temp_fqfn)
+            except OSError:
+                pass
 
 
 
@@ -136,13 +1767,6 @@ def abbreviate(fn):
         return fn
 
 
-def get_file_times(file_name):
-    time_epoch  = os.path.getatime(file_name)
-    time_string = time.strftime('%Y-%m-%d %H:%M:%S %Z', time.gmtime(time_epoch))
-    return time_epoch, time_string
-
-
-
 def setup_logging(log_to_console, log_level):
     """This is a helper function to keep the bulk of the LogManager and
        these comments out of the main().
@@ -155,17 +1779,23 @@ def setup_logging(log_to_console, log_level):
             & message
           - an exceptionhook to log any uncaught exceptions
           - log dir creation if necessary
+          - coalescing of repeated messages - such as those from JobCheck
+            while it waits for a lock
+          - a buffer of the most recent debug messages that only gets written
+            to the log if an error occurs
 
        LogManager accepts arguments for the log_dir, but if not provided it will
        use the app_name to look up the cache dir using the XDG standard.  On linux:
           - $HOME/.cache/<APP_NAME>/log
     """
-    global logger
-    cl_logger  = log.LogManager(app_name=APP_NAME,
+    global logger, log_man
+    log_man    = log.LogManager(app_name=APP_NAME,
                                 log_name=__name__,
-                                log_to_console=log_to_console)
-    logger     = cl_logger.logger
-    logger.setLevel(log_level or 'DEBUG')
+                                log_to_console=log_to_console,
+                                coalesce=True,
+                                debug_buffer=1000)
+    logger     = log_man.logger
+    log_man.set_level(log_level or 'DEBUG')
 
 
 
@@ -184,7 +1814,9 @@ def setup_config(args):
 
        The order determines the precidence.  Since args are added after the
        config file any matching items will result in args overriding the
-       config file.
+       config file.  Each add is kept as a separate layer, and an explicit
+       priority can be passed to any add to override the ordering.
+       config.get_source(key) reports which layer a value came from.
 
        Validation is performed using validictory.  This is optional, but
        recommended.  All config items are stored in two places:  one
@@ -203,18 +1835,170 @@ def setup_config(args):
           - https://readthedocs.org/projects/validictory/
        Note that any validation tool can be easily used with the dictionaries.
     """
+    policy_schema = {'type': 'object',
+                     'properties': {
+                       'name':           {'required': False, 'type': 'string'},
+                       'dirs':           {'type': 'array', 'items': {'type': 'string'}},
+                       'include':        {'required': False, 'type': ['array', 'null'],
+                                          'items': {'type': 'string'}},
+                       'exclude':        {'required': False, 'type': ['array', 'null'],
+                                          'items': {'type': 'string'}},
+                       'extensions':     {'required': False, 'type': ['array', 'null'],
+                                          'items': {'type': 'string'}},
+                       'min_age_days':   {'required': False, 'type': 'number', 'minimum': 0},
+                       'min_size':       {'required': False, 'type': ['integer', 'null'],
+                                          'minimum': 0},
+                       'max_size':       {'required': False, 'type': ['integer', 'null'],
+                                          'minimum': 0},
+                       'recursive':      {'required': False, 'type': 'boolean'},
+                       'codec':          {'required': False, 'enum': sorted(CODECS) + ['auto']},
+                       'compress_level': {'required': False, 'type': ['integer', 'null'],
+                                          'minimum': 0, 'maximum': 22},
+                       'bundle_max_size': {'required': False, 'type': ['integer', 'null'],
+                                           'minimum': 0},
+                       'bundle_window':  {'required': False, 'enum': sorted(BUNDLE_WINDOWS)}},
+                     'additionalProperties': False}
     config_schema = {'type': 'object',
                      'properties': {
-                       'dir':       {'required': True,
-                                     'type':     'string'},
+                       'dir':       {'required': False,
+                                     'type':     ['string', 'null']},
                        'log_level': {'enum': ['DEBUG','INFO','WARNING','ERROR','CRITICAL']} ,
                        'config_fqfn': {'required': False,
                                        'type':     'string'},
                        'log_to_console': {'required': False,
-                                          'type':     'boolean'} },
+                                          'type':     'boolean'},
+                       'min_age_days': {'required': False,
+                                        'type':     'number',
+                                        'minimum':  0},
+                       'extensions':   {'required': False,
+                                        'type':     ['array', 'null'],
+                                        'items':    {'type': 'string'}},
+                       'recursive':    {'required': False,
+                                        'type':     'boolean'},
+                       'include':      {'required': False,
+                                        'type':     ['array', 'null'],
+                                        'items':    {'type': 'string'}},
+                       'exclude':      {'required': False,
+                                        'type':     ['array', 'null'],
+                                        'items':    {'type': 'string'}},
+                       'min_size':     {'required': False,
+                                        'type':     ['integer', 'null'],
+                                        'minimum':  0},
+                       'max_size':     {'required': False,
+                                        'type':     ['integer', 'null'],
+                                        'minimum':  0},
+                       'codec':        {'required': False,
+                                        'enum':     sorted(CODECS) + ['auto']},
+                       'bundle_max_size': {'required': False,
+                                           'type':     ['integer', 'null'],
+                                           'minimum':  0},
+                       'bundle_window':  {'required': False,
+                                          'enum':     sorted(BUNDLE_WINDOWS)},
+                       'auto_min_mbps':  {'required': False,
+                                          'type':     ['number', 'null'],
+                                          'minimum':  0},
+                       'auto_max_ratio': {'required': False,
+                                          'type':     ['number', 'null'],
+                                          'minimum':  0},
+                       'auto_sample_mb': {'required': False,
+                                          'type':     'number',
+                                          'minimum':  0.01},
+                       'policies':     {'required': False,
+                                        'type':     ['array', 'null'],
+                                        'items':    policy_schema},
+                       'state_index':  {'required': False,
+                                        'type':     'boolean'},
+                       'state_index_fqfn': {'required': False,
+                                            'type':     ['string', 'null']},
+                       'checkpoint':   {'required': False,
+                                        'type':     'boolean'},
+                       'checkpoint_fqfn': {'required': False,
+                                           'type':     ['string', 'null']},
+                       'batch_size':   {'required': False,
+                                        'type':     'integer',
+                                        'minimum':  1},
+                       'plan':         {'required': False,
+                                        'type':     'boolean'},
+                       'plan_sample_files': {'required': False,
+                                             'type':     'integer',
+                                             'minimum':  1},
+                       'time_budget_minutes': {'required': False,
+                                               'type':     ['number', 'null'],
+                                               'minimum':  0},
+                       'max_bytes':    {'required': False,
+                                        'type':     ['integer', 'null'],
+                                        'minimum':  1},
+                       'max_files':    {'required': False,
+                                        'type':     ['integer', 'null'],
+                                        'minimum':  1},
+                       'compress_workers':   {'required': False,
+                                              'type':     ['integer', 'null'],
+                                              'minimum':  1},
+                       'compress_processes': {'required': False,
+                                              'type':     'boolean'},
+                       'compress_level':     {'required': False,
+                                              'type':     ['integer', 'null'],
+                                              'minimum':  0,
+                                              'maximum':  22},
+                       'adaptive_workers':   {'required': False,
+                                              'type':     'boolean'},
+                       'read_mbps':    {'required': False,
+                                        'type':     ['number', 'null'],
+                                        'minimum':  0.01},
+                       'write_mbps':   {'required': False,
+                                        'type':     ['number', 'null'],
+                                        'minimum':  0.01},
+                       'max_iops':     {'required': False,
+                                        'type':     ['number', 'null'],
+                                        'minimum':  1},
+                       'nice':         {'required': False,
+                                        'type':     ['integer', 'null'],
+                                        'minimum':  0,
+                                        'maximum':  19},
+                       'ioprio_class': {'required': False,
+                                        'enum':     sorted(IOPRIO_CLASSES) + [None]},
+                       'ioprio_level': {'required': False,
+                                        'type':     'integer',
+                                        'minimum':  0,
+                                        'maximum':  7} },
                      'additionalProperties': False
                     }
     config = conf.ConfigManager(config_schema)
+    config.add_defaults({'dir':                None,
+                         'policies':           None,
+                         'include':            None,
+                         'exclude':            None,
+                         'min_age_days':       3,
+                         'min_size':           None,
+                         'max_size':           None,
+                         'extensions':         None,
+                         'recursive':          False,
+                         'codec':              'gzip',
+                         'bundle_max_size':    None,
+                         'bundle_window':      'dir',
+                         'auto_min_mbps':      None,
+                         'auto_max_ratio':     None,
+                         'auto_sample_mb':     4,
+                         'max_files':          MAX_FILES,
+                         'max_bytes':          None,
+                         'state_index':        True,
+                         'state_index_fqfn':   None,
+                         'checkpoint':         True,
+                         'checkpoint_fqfn':    None,
+                         'batch_size':         100,
+                         'time_budget_minutes': None,
+                         'plan':               False,
+                         'plan_sample_files':  20,
+                         'compress_workers':   None,
+                         'compress_processes': False,
+                         'compress_level':     None,
+                         'adaptive_workers':   False,
+                         'read_mbps':          None,
+                         'write_mbps':         None,
+                         'max_iops':           None,
+                         'nice':               None,
+                         'ioprio_class':       None,
+                         'ioprio_level':       7})
     config.add_file(app_name=APP_NAME,
                     config_fqfn=args.config_fqfn,
                     config_fn='main.yml')
@@ -264,9 +2048,9 @@ def exit_if_suppressed():
        convention:
             $HOME/.config/<APP_NAME>/suppress/name-<APP_NAME>.suppress
 
-       Note that this function could be called at checkpoints by this program, in
-       order to identify that it should shut-down gracefully in the middle of long-
-       running processes.
+       The suppcheck is returned so that process_all_the_files can check it
+       again between batches, and shut-down gracefully in the middle of a long
+       run - leaving a checkpoint for the next run to resume from.
     """
 
     suppcheck  = supp.SuppressCheck(app_name=APP_NAME)
@@ -275,6 +2059,7 @@ def exit_if_suppressed():
         sys.exit(0)
     else:
         logger.info('SuppCheck has passed')
+        return suppcheck
 
 
 
@@ -300,6 +2085,59 @@ def get_args():
     parser.add_argument('--log-level',
                         choices=['debug','info','warning','error', 'critical'])
     parser.add_argument('--config-fqfn')
+    parser.add_argument('--recursive',
+                        action='store_true',
+                        default=None,
+                        help='also compress files within subdirectories')
+    parser.add_argument('--max-files',
+                        type=int,
+                        help='maximum number of files to compress in one run')
+    parser.add_argument('--no-state-index',
+                        action='store_false',
+                        default=None,
+                        dest='state_index',
+                        help='rescan everything - without reading or updating the state index')
+    parser.add_argument('--batch-size',
+                        type=int,
+                        help='number of files to compress between checkpoints')
+    parser.add_argument('--time-budget-minutes',
+                        type=float,
+                        help='stop after the batch that passes this many minutes')
+    parser.add_argument('--no-checkpoint',
+                        action='store_false',
+                        default=None,
+                        dest='checkpoint',
+                        help='always scan from the top dirs - without a checkpoint')
+    parser.add_argument('--plan',
+                        action='store_true',
+                        default=None,
+                        help='print the files, bytes & time a run would take - without changing anything')
+    parser.add_argument('--compress-workers',
+                        type=int,
+                        help='number of files to compress at once - defaults to the cpu count')
+    parser.add_argument('--compress-processes',
+                        action='store_true',
+                        default=None,
+                        help='compress with a pool of processes rather than threads')
+    parser.add_argument('--adaptive-workers',
+                        action='store_true',
+                        default=None,
+                        help='adapt the number of busy workers to the measured throughput')
+    parser.add_argument('--read-mbps',
+                        type=float,
+                        help='limit reads to this many MB per second')
+    parser.add_argument('--write-mbps',
+                        type=float,
+                        help='limit writes to this many MB per second')
+    parser.add_argument('--max-iops',
+                        type=float,
+                        help='limit reads & writes to this many per second')
+    parser.add_argument('--nice',
+                        type=int,
+                        help='lower the cpu priority by this much')
+    parser.add_argument('--ioprio-class',
+                        choices=sorted(IOPRIO_CLASSES),
+                        help='i/o scheduling class - idle only uses otherwise idle disk time')
     parser.add_argument('--console-log',
                         action='store_true',
                         default=True,
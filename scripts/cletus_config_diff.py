@@ -0,0 +1,110 @@
+#!/usr/bin/env  python
+""" Cletus_config_diff.py reports how a config change would affect the
+    config a program actually sees - before it's rolled out.
+
+    Both the old and new configs are loaded through the same layering -
+    the files in the order given, then optionally environmental variables
+    with a prefix - and merged.  Then the merged configs are compared, and
+    the new one is validated against the schema.  Each change is reported
+    with the layer it came from, along with any schema errors within it.
+
+    Usage:
+        cletus_config_diff.py --old server.yml app.yml conf.d
+                              --new server.yml new/app.yml conf.d
+                              [--schema schema.yml] [--env-prefix APP] [--json]
+
+    Exit codes:
+        0 - the new config is valid
+        1 - the new config fails the schema
+        2 - invalid arguments or unreadable files
+
+    See the file "LICENSE" for the full license governing use of this file.
+    Copyright 2013, 2014, 2015, 2016 Ken Farmer
+"""
+from __future__ import absolute_import
+from __future__ import print_function
+
+import sys
+import os
+import json
+import argparse
+
+import yaml
+
+# only here to allow running out of dev
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import cletus.cletus_config as conf
+
+
+
+def main():
+    args = get_args()
+
+    try:
+        schema     = load_schema(args.schema_fqfn)
+        old_config = load_config(schema, args.old_paths, args.env_prefix)
+        new_config = load_config(schema, args.new_paths, args.env_prefix)
+    except (IOError, OSError, ValueError, yaml.YAMLError) as e:
+        print('error: %s' % e, file=sys.stderr)
+        return 2
+
+    config_diff = old_config.diff(new_config)
+
+    if args.json:
+        print(json.dumps(config_diff.to_dict(), indent=2, sort_keys=True, default=repr))
+    else:
+        for line in config_diff.format():
+            print(line)
+        print('%d changes, %d errors' % (len(config_diff), len(config_diff.errors)))
+
+    return 0 if config_diff.is_valid() else 1
+
+
+
+def load_schema(schema_fqfn):
+    if not schema_fqfn:
+        return None
+    with open(schema_fqfn) as f:
+        return yaml.safe_load(f)
+
+
+
+def load_config(schema, paths, env_prefix):
+    """ Returns a ConfigManager with the files, directories & globs in paths
+        added in order - followed by prefixed environmental variables.
+    """
+    config = conf.ConfigManager(schema)
+    config.add_files(paths)
+    if env_prefix:
+        config.add_env_vars(prefix=env_prefix)
+    return config
+
+
+
+def get_args():
+    parser = argparse.ArgumentParser(description='Compares two merged configs '
+                                     'and validates the new one against the schema')
+    parser.add_argument('--old',
+                        nargs='+',
+                        required=True,
+                        dest='old_paths',
+                        help='old config files, directories or globs - lowest priority first')
+    parser.add_argument('--new',
+                        nargs='+',
+                        required=True,
+                        dest='new_paths',
+                        help='new config files, directories or globs - lowest priority first')
+    parser.add_argument('--schema',
+                        dest='schema_fqfn',
+                        help='yaml or json validictory schema')
+    parser.add_argument('--env-prefix',
+                        help='also apply <prefix>__<key> environmental variables')
+    parser.add_argument('--json',
+                        action='store_true',
+                        help='print the diff as json')
+    return parser.parse_args()
+
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -45,7 +45,8 @@ setup(name             = 'cletus'          ,
             'Operating System :: POSIX'                                  ,
             'Topic :: Utilities'
             ],
-      scripts          = ['scripts/cletus_archiver.py'],
+      scripts          = ['scripts/cletus_archiver.py',
+                          'scripts/cletus_config_diff.py'],
       install_requires = REQUIREMENTS,
       packages         = find_packages(),
      )